@@ -8,7 +8,9 @@ app = create_app()
 # When running app.py module as main program Python assigns
 #   hard-coded string "__main__" to the __name__ variable
 # If this is the case the application is run with below
-#   defined parameters
+#   defined parameters by development server of Flask (single process);
+#   in production the application is served by gunicorn
+#   ('gunicorn app:app', see gunicorn.conf.py)
 if __name__ == '__main__':
     app.run(host=os.environ.get('IP'),
             port=int(os.environ.get('PORT')),
@@ -0,0 +1,2 @@
+# Benchmarks of the application - run against local MongoDB server
+#   or in-memory database (see README.md)
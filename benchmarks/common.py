@@ -0,0 +1,43 @@
+# Helpers shared by the benchmarks - generated texts and summaries
+#   of measured durations
+import random
+
+
+# Words used for generating texts; the first words are the most frequent
+#   ones (frequency of words in texts roughly follows Zipf's law)
+WORDS = ('flight aircraft airline airport pilot cabin crew runway takeoff '
+         'landing approach boarding passenger ticket lounge terminal gate '
+         'delay weather turbulence cockpit engine wing fuselage cargo fleet '
+         'route hub alliance boeing airbus embraer bombardier dreamliner '
+         'jumbo widebody narrowbody regional charter lowcost business '
+         'economy premium upgrade miles loyalty checkin baggage security '
+         'customs visa layover connection transatlantic pacific polar '
+         'overnight redeye spotter livery hangar maintenance simulator '
+         'radar tower clearance altitude cruise descent holding diversion '
+         'deicing pushback taxi apron jetbridge catering galley purser '
+         'captain firstofficer navigator dispatcher controller').split()
+
+
+# Function for generating text of given number of words
+def text(length, rng=random):
+    return ' '.join(WORDS[min(int(rng.paretovariate(1.2)) - 1,
+                              len(WORDS) - 1)]
+                    if rng.random() < 0.7 else rng.choice(WORDS)
+                    for _ in range(length))
+
+
+# Function for computing percentile of sorted list of values
+def percentile(values, percent):
+    index = min(int(round(percent / 100 * (len(values) - 1))),
+                len(values) - 1)
+    return values[index]
+
+
+# Function for summarizing measured durations (in seconds) as milliseconds
+def summary(durations):
+    durations = sorted(durations)
+    return {'count': len(durations),
+            'p50_ms': round(percentile(durations, 50) * 1000, 2),
+            'p95_ms': round(percentile(durations, 95) * 1000, 2),
+            'p99_ms': round(percentile(durations, 99) * 1000, 2),
+            'max_ms': round(durations[-1] * 1000, 2)}
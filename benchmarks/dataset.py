@@ -0,0 +1,132 @@
+# Generator of synthetic benchmark data - users, posts (texts made
+#   of aviation vocabulary) and post pictures stored in file storage
+# Data are generated by seeded random generator, so as the same arguments
+#   produce the same dataset in every run
+# Application modules are imported by the functions, as the application
+#   reads its configuration from environment when it is imported
+import io
+import random
+from datetime import datetime, timedelta
+
+from benchmarks.common import text
+
+
+# Password of all generated users (users log in as
+#   'user<number>@example.com')
+PASSWORD = 'benchmark'
+
+
+# Function for dropping all collections written by the application
+def reset(db):
+    for collection in ('posts', 'users', 'fs.files', 'fs.chunks',
+                       'image_jobs', 'mail_outbox'):
+        db.drop_collection(collection)
+
+
+# Function for generating 'count' users
+# Password is hashed only once, as hashing is deliberately slow
+# Returns list of user documents
+def seed_users(db, count, batch_size=1000):
+    from werkzeug.security import generate_password_hash
+    password = generate_password_hash(PASSWORD)
+    users = [{'first_name': 'author',
+              'last_name': str(i),
+              'username': 'user{}'.format(i),
+              'email': 'user{}@example.com'.format(i),
+              'password': password,
+              'post_count': 0} for i in range(count)]
+    for start in range(0, count, batch_size):
+        db.users.insert_many(users[start:start + batch_size])
+    return users
+
+
+# Function for generating JPEG image of given size - noise over random
+#   colour, so as images differ and compress like photos
+def jpeg(size, rng=random):
+    from PIL import Image
+    colour = tuple(rng.randrange(256) for _ in range(3))
+    noise = Image.effect_noise(size, 40).convert('RGB')
+    image = Image.blend(Image.new('RGB', size, colour), noise, 0.3)
+    data = io.BytesIO()
+    image.save(data, 'JPEG', quality=85)
+    return data.getvalue()
+
+
+# Function for generating 'count' post pictures; pictures are processed
+#   like uploaded pictures (all widths, original format and WebP) and
+#   saved to file storage of the application (needs application context)
+# Returns list of (picture filename, list of variants)
+def seed_pictures(count, size=(1200, 800), rng=random):
+    from werkzeug.datastructures import FileStorage
+    from flyhighblog.posts.utils import post_picture
+    pictures = []
+    for i in range(count):
+        upload = FileStorage(io.BytesIO(jpeg(size, rng)),
+                             filename='picture{}.jpg'.format(i))
+        pictures.append(post_picture(upload))
+    return pictures
+
+
+# Function for generating 'count' posts of randomly chosen 'users' with
+#   randomly chosen 'pictures' (posts without picture if there are none)
+# Posts carry author snapshot if 'snapshot' is True (see
+#   POST_AUTHOR_SNAPSHOT); post counts of users are updated
+def seed_posts(db, count, users, pictures=(), snapshot=False,
+               batch_size=1000, rng=random):
+    from pymongo import UpdateOne
+    from flyhighblog.posts.utils import post_excerpt
+    from flyhighblog.main.utils import author_snapshot
+    now = datetime.utcnow()
+    counts = {}
+    for start in range(0, count, batch_size):
+        batch = []
+        for i in range(start, min(start + batch_size, count)):
+            user = rng.choice(users)
+            picture, variants = rng.choice(pictures) if pictures \
+                else (None, None)
+            content = text(rng.randint(80, 400), rng)
+            post = {'title': text(rng.randint(3, 8), rng),
+                    'content': content,
+                    'excerpt': post_excerpt(content),
+                    'date_posted': now - timedelta(minutes=i),
+                    'picture': picture,
+                    'picture_variants': variants}
+            if snapshot:
+                post['author'] = user['_id']
+                post['author_snapshot'] = author_snapshot(user)
+            else:
+                post['author'] = str(user['_id'])
+            batch.append(post)
+            counts[user['_id']] = counts.get(user['_id'], 0) + 1
+        db.posts.insert_many(batch)
+
+    updates = [UpdateOne({'_id': user_id}, {'$set': {'post_count': count}})
+               for user_id, count in counts.items()]
+    if updates:
+        db.users.bulk_write(updates, ordered=False)
+
+
+# Function for seeding database of the application with generated data
+# Returns description of the dataset (numbers of documents and size
+#   of stored files)
+def seed(app, users, posts, pictures, seed=1):
+    from flyhighblog import mongo
+    rng = random.Random(seed)
+    with app.app_context():
+        reset(mongo.db)
+        user_docs = seed_users(mongo.db, users)
+        picture_list = seed_pictures(pictures, rng=rng)
+        seed_posts(mongo.db, posts, user_docs, picture_list,
+                   snapshot=app.config['POST_AUTHOR_SNAPSHOT'], rng=rng)
+        return describe(mongo.db)
+
+
+# Function for describing dataset present in database
+def describe(db):
+    stored = list(db.fs.files.aggregate(
+        [{'$group': {'_id': None, 'count': {'$sum': 1},
+                     'bytes': {'$sum': '$length'}}}]))
+    return {'users': db.users.count_documents({}),
+            'posts': db.posts.count_documents({}),
+            'files': stored[0]['count'] if stored else 0,
+            'file_bytes': stored[0]['bytes'] if stored else 0}
@@ -0,0 +1,393 @@
+# Benchmark of the main endpoints of the application
+# Seeds benchmark database with generated users, posts and pictures (see
+#   dataset.py) and measures latency (p50/p95/p99), throughput and number
+#   of MongoDB commands per request of:
+#   - index - home page (pages 1-3)
+#   - user - posts of a user
+#   - post - page of a post
+#   - file - stored picture
+#   - login - successful login
+#   - create_post - new post with picture (picture is queued for
+#     processing and not processed, as no image worker is running)
+# Requests are sent through Flask test client to the application created
+#   by create_app() or over HTTP to a running application (--url; it must
+#   use the benchmark database); MongoDB commands are counted by query
+#   instrumentation of the application ('Server-Timing' header)
+# Page and image caches are switched off unless --cache is given, so as
+#   every request reaches the database
+# Usage:
+#   python -m benchmarks.endpoints --users 100 --posts 10000 \
+#       --pictures 50 --requests 500 --output endpoints.json
+#   python -m benchmarks.endpoints --in-memory       (requires mongomock)
+#   python -m benchmarks.endpoints --url http://localhost:5000 \
+#       --concurrency 8 --no-seed
+#   python -m benchmarks.endpoints --compare endpoints.json
+# Benchmark database is dropped and seeded again unless --no-seed is given
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import text, summary
+from benchmarks.dataset import PASSWORD, seed, describe, jpeg
+
+
+# Measured endpoints and their expected responses - status and redirect
+#   location (failed login and post creation are not redirected to home
+#   page)
+HOME = ('/', '/index')
+ENDPOINTS = {'index': {(200, None)},
+             'user': {(200, None)},
+             'post': {(200, None)},
+             'file': {(200, None)},
+             'login': {(302, path) for path in HOME},
+             'create_post': {(302, path) for path in HOME}}
+
+
+# Requests sent through Flask test client; each thread has its own
+#   clients (anonymous and logged in)
+class TestClientTransport:
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def client(self, logged_in):
+        key = 'user' if logged_in else 'anonymous'
+        client = getattr(self.local, key, None)
+        if client is None:
+            client = self.app.test_client()
+            if logged_in:
+                client.post('/login', data={'email': logged_in,
+                                            'password': PASSWORD})
+            setattr(self.local, key, client)
+        return client
+
+    # Sending request; returns status, path of redirect location,
+    #   duration and number of MongoDB commands (None if not counted)
+    def send(self, method, path, data=None, files=None, logged_in=None,
+             fresh=False):
+        client = self.app.test_client() if fresh \
+            else self.client(logged_in)
+        if files:
+            data = dict(data, **{name: (io.BytesIO(content), filename)
+                                 for name, (content, filename)
+                                 in files.items()})
+        started = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        response.get_data()
+        duration = time.perf_counter() - started
+        response.close()
+        return (response.status_code, location(response.headers), duration,
+                query_count(response.headers))
+
+
+# Redirects are measured as responses, not followed
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+# Requests sent over HTTP to running application; each thread has its own
+#   cookies (anonymous and logged in); forms are submitted with CSRF
+#   token of the form page, which is requested before measuring
+class HTTPTransport:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.local = threading.local()
+
+    def opener(self, logged_in):
+        key = 'user' if logged_in else 'anonymous'
+        opener = getattr(self.local, key, None)
+        if opener is None:
+            opener = self.new_opener()
+            if logged_in:
+                self.open(opener, 'POST', '/login',
+                          self.form(opener, '/login',
+                                    {'email': logged_in,
+                                     'password': PASSWORD}))
+            setattr(self.local, key, opener)
+        return opener
+
+    def new_opener(self):
+        return urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar()), NoRedirect)
+
+    # Form data with CSRF token taken from the form page
+    def form(self, opener, path, data):
+        _, _, page = self.open(opener, 'GET', path)
+        marker = b'name="csrf_token" type="hidden" value="'
+        if marker in page:
+            start = page.index(marker) + len(marker)
+            token = page[start:page.index(b'"', start)].decode()
+            data = dict(data, csrf_token=token)
+        return data
+
+    def open(self, opener, method, path, data=None, files=None):
+        headers = {}
+        body = None
+        if files:
+            body, content_type = multipart(data, files)
+            headers['Content-Type'] = content_type
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+        request = urllib.request.Request(self.url + path, data=body,
+                                         headers=headers, method=method)
+        try:
+            with opener.open(request) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.headers, error.read()
+
+    def send(self, method, path, data=None, files=None, logged_in=None,
+             fresh=False):
+        opener = self.new_opener() if fresh else self.opener(logged_in)
+        if method == 'POST':
+            data = self.form(opener, path, data)
+        started = time.perf_counter()
+        status, headers, _ = self.open(opener, method, path, data, files)
+        return (status, location(headers), time.perf_counter() - started,
+                query_count(headers))
+
+
+# Number of MongoDB commands of request reported in 'Server-Timing' header
+#   (None if query instrumentation is switched off)
+def query_count(headers):
+    match = re.search(r'db;dur=[0-9.]+;desc="(\d+) queries"',
+                      headers.get('Server-Timing') or '')
+    return int(match.group(1)) if match else None
+
+
+# Path of redirect location of response (None if not redirected)
+def location(headers):
+    if headers.get('Location') is None:
+        return None
+    return urllib.parse.urlsplit(headers['Location']).path
+
+
+# Function for encoding form data and files as multipart/form-data
+def multipart(data, files):
+    boundary = 'benchmark{:032x}'.format(random.getrandbits(128))
+    body = io.BytesIO()
+    for name, value in data.items():
+        body.write('--{}\r\nContent-Disposition: form-data; name="{}"'
+                   '\r\n\r\n{}\r\n'.format(boundary, name, value).encode())
+    for name, (content, filename) in files.items():
+        body.write('--{}\r\nContent-Disposition: form-data; name="{}"; '
+                   'filename="{}"\r\nContent-Type: image/jpeg\r\n\r\n'
+                   .format(boundary, name, filename).encode())
+        body.write(content + b'\r\n')
+    body.write('--{}--\r\n'.format(boundary).encode())
+    return body.getvalue(), 'multipart/form-data; boundary=' + boundary
+
+
+# Targets of requests (users, posts, files) pulled from seeded database
+def load_targets(app):
+    from flyhighblog import mongo
+    with app.app_context():
+        users = [user for user in mongo.db.users.find(
+            {}, {'username': 1, 'email': 1, 'post_count': 1})]
+        posts = [str(post['_id']) for post in mongo.db.posts.find(
+            {}, {'_id': 1}, limit=10000)]
+        files = sorted({variant['filename'] for post in mongo.db.posts.find(
+            {'picture_variants': {'$ne': None}}, {'picture_variants': 1},
+            limit=1000) for variant in post['picture_variants']})
+    return {'users': users, 'posts': posts, 'files': files}
+
+
+# Function for generating request of an endpoint
+# Returns keyword arguments of 'send' method of transports
+def make_request(endpoint, targets, rng, upload):
+    if endpoint == 'index':
+        page = rng.choice((1, 1, 1, 2, 3))
+        return {'method': 'GET', 'path': '/?page={}'.format(page)}
+    if endpoint == 'user':
+        user = rng.choice(targets['users'])
+        return {'method': 'GET', 'path': '/user/' + user['username']}
+    if endpoint == 'post':
+        return {'method': 'GET',
+                'path': '/post/' + rng.choice(targets['posts'])}
+    if endpoint == 'file':
+        return {'method': 'GET',
+                'path': '/file/' + rng.choice(targets['files'])}
+    if endpoint == 'login':
+        return {'method': 'POST', 'path': '/login', 'fresh': True,
+                'data': {'email': rng.choice(targets['users'])['email'],
+                         'password': PASSWORD}}
+    return {'method': 'POST', 'path': '/post/new',
+            'data': {'title': text(rng.randint(3, 8), rng),
+                     'content': text(rng.randint(80, 400), rng)},
+            'files': {'picture': (upload, 'picture.jpg')},
+            'logged_in': targets['users'][0]['email']}
+
+
+# Function for measuring one endpoint - 'count' requests sent by
+#   'concurrency' threads after 'warmup' unmeasured requests
+def measure(transport, endpoint, targets, count, concurrency, warmup,
+            upload, seed=1):
+    rng = random.Random(seed)
+    requests = [make_request(endpoint, targets, rng, upload)
+                for _ in range(count + warmup)]
+    for request in requests[:warmup]:
+        transport.send(**request)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        started = time.perf_counter()
+        results = list(executor.map(lambda request: transport.send(**request),
+                                    requests[warmup:]))
+        elapsed = time.perf_counter() - started
+
+    result = summary([duration for _, _, duration, _ in results])
+    result['errors'] = sum(1 for status, path, _, _ in results
+                           if (status, path) not in ENDPOINTS[endpoint])
+    result['throughput_rps'] = round(len(results) / elapsed, 1)
+    queries = [count for _, _, _, count in results if count is not None]
+    if queries:
+        result['queries_mean'] = round(sum(queries) / len(queries), 2)
+        result['queries_max'] = max(queries)
+    else:
+        result['queries_mean'] = result['queries_max'] = None
+    return result
+
+
+# Function for printing comparison of results with results of earlier run
+def compare(results, baseline):
+    print('\nCompared with {}:'.format(baseline.get('revision') or
+                                       baseline.get('date')))
+    for endpoint, result in results['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(endpoint)
+        if not before:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p95_ms', 'throughput_rps', 'queries_mean'):
+            if before.get(key) and result.get(key) is not None:
+                changes.append('{} {:+.0f}%'.format(
+                    key, (result[key] / before[key] - 1) * 100))
+        print('{:<12} {}'.format(endpoint, '  '.join(changes)))
+
+
+# Git revision of the benchmarked code (None outside of git repository)
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark main endpoints of the application.')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--pictures', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Measured requests per endpoint.')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--mongo-uri', default=os.environ.get(
+        'BENCHMARK_MONGO_URI',
+        'mongodb://localhost:27017/flyhigh_benchmark'))
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Use in-memory database (mongomock).')
+    parser.add_argument('--url', help='Benchmark running application.')
+    parser.add_argument('--cache', action='store_true',
+                        help='Keep page and image caches switched on.')
+    parser.add_argument('--author-snapshot', action='store_true',
+                        help='Seed and create posts with author snapshot.')
+    parser.add_argument('--no-seed', action='store_true')
+    parser.add_argument('--output')
+    parser.add_argument('--compare', help='Results of earlier run.')
+    args = parser.parse_args(argv)
+    endpoints = args.endpoints.split(',')
+    for endpoint in endpoints:
+        if endpoint not in ENDPOINTS:
+            parser.error('unknown endpoint: ' + endpoint)
+    if args.in_memory and (args.url or args.no_seed):
+        parser.error('in-memory database cannot be shared or kept')
+
+    if args.in_memory:
+        from benchmarks.memory import use_in_memory_database
+        use_in_memory_database()
+
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    from flyhighblog import create_app, mongo
+    from flyhighblog.config import Config
+    from flyhighblog.indexes import ensure_indexes
+    settings = {'MONGO_URI': args.mongo_uri,
+                'WTF_CSRF_ENABLED': False,
+                'MONGO_ENSURE_INDEXES': False,
+                # MongoDB commands are not monitored in memory
+                'QUERY_INSTRUMENTATION': not args.in_memory,
+                'SERVER_TIMING': True,
+                'SLOW_REQUEST_MS': 0,
+                # Uploaded pictures and e-mails are only queued
+                'IMAGE_QUEUE_THREADS': 0,
+                'MAIL_OUTBOX_THREADS': 0,
+                'POST_AUTHOR_SNAPSHOT': (args.author_snapshot or
+                                         Config.POST_AUTHOR_SNAPSHOT)}
+    if not args.cache:
+        settings.update(PAGE_CACHE_SIZE=0, IMAGE_CACHE_MAX_BYTES=0,
+                        IMAGE_CACHE_MAX_ITEM_BYTES=0, IMAGE_CACHE_DIR=None)
+    app = create_app(type('BenchmarkConfig', (Config,), settings))
+
+    if not args.no_seed:
+        started = time.perf_counter()
+        dataset = seed(app, args.users, args.posts, args.pictures)
+        elapsed = time.perf_counter() - started
+        print('Seeded {users} users, {posts} posts and {files} files '
+              'in {elapsed:.1f} s'.format(elapsed=elapsed, **dataset),
+              file=sys.stderr)
+    if not args.in_memory:
+        with app.app_context():
+            ensure_indexes()
+    with app.app_context():
+        dataset = describe(mongo.db)
+
+    targets = load_targets(app)
+    if not targets['files'] and 'file' in endpoints:
+        endpoints.remove('file')
+    transport = HTTPTransport(args.url) if args.url \
+        else TestClientTransport(app)
+    upload = jpeg((1200, 800), random.Random(1))
+
+    results = {'benchmark': 'endpoints',
+               'date': datetime.utcnow().isoformat(timespec='seconds'),
+               'revision': revision(),
+               'settings': {key: value for key, value in vars(args).items()
+                            if key not in ('output', 'compare')},
+               'dataset': dataset,
+               'endpoints': {}}
+    for endpoint in endpoints:
+        result = measure(transport, endpoint, targets, args.requests,
+                         args.concurrency, args.warmup, upload)
+        results['endpoints'][endpoint] = result
+        print('{:<12} p50 {:>8} ms  p95 {:>8} ms  p99 {:>8} ms  '
+              '{:>7} req/s  queries {}  errors {}'.format(
+                  endpoint, result['p50_ms'], result['p95_ms'],
+                  result['p99_ms'], result['throughput_rps'],
+                  result['queries_mean'], result['errors']))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
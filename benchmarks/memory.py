@@ -0,0 +1,37 @@
+# In-memory stand-in for MongoDB server (mongomock), so as benchmarks
+#   can be run without database server
+# Results are useful for comparing application code (rendering, image
+#   processing) only - database costs, text search and MongoDB command
+#   monitoring are not available in memory
+# mongomock is not thread-safe - a few of concurrent requests may fail
+import flask_pymongo
+from flask import abort
+
+
+# Function for making application (PyMongo) use in-memory database;
+#   must be called before the application is created
+def use_in_memory_database():
+    try:
+        import mongomock
+        import mongomock.gridfs
+    except ImportError:
+        raise SystemExit('In-memory database requires mongomock '
+                         '(pip install mongomock)')
+
+    # GridFS readers accept mongomock collections
+    mongomock.gridfs.enable_gridfs_integration()
+
+    # Collection method added by Flask-PyMongo
+    def find_one_or_404(self, *args, **kwargs):
+        document = self.find_one(*args, **kwargs)
+        if document is None:
+            abort(404)
+        return document
+
+    mongomock.collection.Collection.find_one_or_404 = find_one_or_404
+
+    # One client is shared by all the clients the application creates,
+    #   so as the data are kept when the client is created again (e.g.
+    #   by worker forked from preloaded application)
+    client = mongomock.MongoClient()
+    flask_pymongo.MongoClient = lambda *args, **kwargs: client
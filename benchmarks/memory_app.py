@@ -0,0 +1,41 @@
+# Application with in-memory database served by serving benchmark (see
+#   serving.py) when there is no MongoDB server
+# Application is created and seeded when the module is imported; gunicorn
+#   with preloaded application seeds the database once in master process
+#   and all the workers inherit copy of the data (data written by one
+#   worker are not seen by the others)
+# Size of the dataset is read from environment (BENCHMARK_USERS,
+#   BENCHMARK_POSTS, BENCHMARK_PICTURES) and the dataset with targets of
+#   requests is written to BENCHMARK_TARGETS file
+# Usage:
+#   gunicorn --preload benchmarks.memory_app:app
+#   python -m benchmarks.memory_app            (development server)
+import os
+import json
+
+from benchmarks.memory import use_in_memory_database
+from benchmarks.dataset import seed
+from benchmarks.endpoints import load_targets
+
+
+# Function for creating the application with seeded in-memory database
+def create_memory_app():
+    use_in_memory_database()
+    from flyhighblog import create_app
+    app = create_app()
+    dataset = seed(app, int(os.environ.get('BENCHMARK_USERS', 100)),
+                   int(os.environ.get('BENCHMARK_POSTS', 10000)),
+                   int(os.environ.get('BENCHMARK_PICTURES', 50)))
+    if os.environ.get('BENCHMARK_TARGETS'):
+        with open(os.environ['BENCHMARK_TARGETS'], 'w') as f:
+            json.dump({'dataset': dataset, 'targets': load_targets(app)}, f,
+                      default=str)
+    return app
+
+
+app = create_memory_app()
+
+if __name__ == '__main__':
+    app.run(host=os.environ.get('IP'),
+            port=int(os.environ.get('PORT')),
+            debug=False)
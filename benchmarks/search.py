@@ -0,0 +1,93 @@
+# Benchmark of post search
+# Seeds benchmark database with given number of posts (random titles and
+#   content made of aviation vocabulary) and measures latency of search
+#   queries and of whole search pages
+# Usage:
+#   python -m benchmarks.search --posts 100000 --queries 200 \
+#       --mongo-uri mongodb://localhost:27017/flyhigh_benchmark \
+#       --output search.json
+# Benchmark database is dropped and seeded again unless --no-seed is given
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+from benchmarks.common import summary
+from benchmarks.dataset import reset, seed_users, seed_posts
+
+
+# Search terms measured by the benchmark - frequent, medium and rare words
+#   and phrases of two words
+QUERIES = ['flight', 'airport', 'boeing', 'dreamliner', 'deicing',
+           'purser', 'controller', 'pilot cabin', 'airbus widebody',
+           'polar route', 'jetbridge', 'spotter livery']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark post search.')
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--mongo-uri', default=os.environ.get(
+        'BENCHMARK_MONGO_URI',
+        'mongodb://localhost:27017/flyhigh_benchmark'))
+    parser.add_argument('--no-seed', action='store_true')
+    parser.add_argument('--output')
+    args = parser.parse_args(argv)
+
+    # Application reads database from environment when it is imported
+    os.environ['MONGO_URI'] = args.mongo_uri
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['PAGE_CACHE_SIZE'] = '0'
+    from flyhighblog import create_app, mongo
+    from flyhighblog.indexes import ensure_indexes
+    from flyhighblog.main.utils import search_posts
+
+    app = create_app()
+    with app.app_context():
+        if not args.no_seed:
+            started = time.perf_counter()
+            reset(mongo.db)
+            users = seed_users(mongo.db, 50)
+            seed_posts(mongo.db, args.posts, users, rng=random.Random(1))
+            print('Seeded {} posts in {:.1f} s'.format(
+                args.posts, time.perf_counter() - started), file=sys.stderr)
+        ensure_indexes()
+
+    random.seed(1)
+    results = {'posts': args.posts, 'queries': {}, 'pages': []}
+    client = app.test_client()
+    for terms in QUERIES:
+        durations = []
+        for _ in range(max(args.queries // len(QUERIES), 1)):
+            page = random.choice((1, 1, 1, 2, 3))
+            url = '/search?q={}&page={}'.format(terms, page)
+            with app.test_request_context(url):
+                started = time.perf_counter()
+                found = search_posts(terms, per_page=5)
+                durations.append(time.perf_counter() - started)
+        results['queries'][terms] = dict(summary(durations),
+                                         results=found['total'])
+
+        # Whole page - search, author data and rendering
+        started = time.perf_counter()
+        client.get('/search?q={}'.format(terms))
+        results['pages'].append(time.perf_counter() - started)
+
+    for terms, result in results['queries'].items():
+        print('{:<20} {:>6} results  p50 {:>7} ms  p95 {:>7} ms  '
+              'p99 {:>7} ms'.format(terms, result['results'],
+                                    result['p50_ms'], result['p95_ms'],
+                                    result['p99_ms']))
+    results['pages'] = summary(results['pages'])
+    print('Search pages: p50 {p50_ms} ms, p95 {p95_ms} ms'.format(
+        **results['pages']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+# Benchmark of serving modes - throughput of the application served by:
+#   - development - development server of Flask ('python app.py', one
+#     process with a thread per request)
+#   - gunicorn - production server ('gunicorn app:app' configured by
+#     gunicorn.conf.py, worker processes with threads)
+#   with increasing number of concurrent clients
+# Each server is started as a subprocess on a free local port and its
+#   endpoints are measured over HTTP as in endpoints benchmark (see
+#   endpoints.py); the benchmark database is seeded once and used by both
+#   servers; page and image caches are switched off unless --cache is given
+# With --in-memory the servers run benchmarks/memory_app.py instead of
+#   app.py - each server seeds its own in-memory database (gunicorn loads
+#   the application before forking its workers, so as all the workers
+#   inherit the data); results then show serving of application code only
+#   without database costs
+# Usage:
+#   python -m benchmarks.serving --workers 4 --threads 4 \
+#       --concurrency 1,8,32 --requests 500 --output serving.json
+#   python -m benchmarks.serving --in-memory   (requires mongomock)
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+from benchmarks.dataset import jpeg
+from benchmarks.endpoints import (ENDPOINTS, HTTPTransport, measure,
+                                  load_targets, revision)
+
+
+# Folder of the application (app.py, gunicorn.conf.py)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Measured servers
+SERVERS = ('development', 'gunicorn')
+
+# Settings of the served application (environment variables) - uploaded
+#   pictures and e-mails are only queued, slow requests are not logged
+SERVER_SETTINGS = {'SECRET_KEY': os.environ.get('SECRET_KEY', 'benchmark'),
+                   'MONGO_ENSURE_INDEXES': '0',
+                   'SLOW_REQUEST_MS': '0',
+                   'IMAGE_QUEUE_THREADS': '0',
+                   'MAIL_OUTBOX_THREADS': '0'}
+NO_CACHE_SETTINGS = {'PAGE_CACHE_SIZE': '0',
+                     'IMAGE_CACHE_MAX_BYTES': '0',
+                     'IMAGE_CACHE_MAX_ITEM_BYTES': '0'}
+
+
+# Free local port for a server
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Function for starting a server (subprocess); output of the server is
+#   written to 'log' file
+def start_server(name, module, env, log, preload=False):
+    if name == 'development':
+        command = [sys.executable, '-m', module]
+    else:
+        # Entry point of 'gunicorn' script, so as gunicorn of the running
+        #   Python environment is used
+        command = [sys.executable, '-c',
+                   'from gunicorn.app.wsgiapp import run; run()',
+                   '--config', os.path.join(ROOT, 'gunicorn.conf.py'),
+                   module + ':app']
+        if preload:
+            command.append('--preload')
+    return subprocess.Popen(command, cwd=ROOT, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+# Function for waiting until server responds to home page
+def wait_for_server(process, url, timeout, log):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            with urllib.request.urlopen(url + '/', timeout=5):
+                return
+        except urllib.error.HTTPError:
+            return
+        except OSError:
+            time.sleep(0.5)
+    log.seek(0)
+    raise SystemExit('Server did not start:\n' +
+                     log.read().decode('utf-8', 'replace')[-2000:])
+
+
+# Function for stopping server
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compare throughput of development server and gunicorn.')
+    parser.add_argument('--servers', default=','.join(SERVERS))
+    parser.add_argument('--workers', type=int,
+                        help='Worker processes of gunicorn (default: '
+                             'gunicorn.conf.py).')
+    parser.add_argument('--threads', type=int,
+                        help='Threads per worker of gunicorn (default: '
+                             'gunicorn.conf.py).')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--pictures', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Measured requests per endpoint and '
+                             'concurrency.')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument('--endpoints', default='index,post,file,login')
+    parser.add_argument('--mongo-uri', default=os.environ.get(
+        'BENCHMARK_MONGO_URI',
+        'mongodb://localhost:27017/flyhigh_benchmark'))
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Use in-memory database (mongomock).')
+    parser.add_argument('--cache', action='store_true',
+                        help='Keep page and image caches switched on.')
+    parser.add_argument('--startup-timeout', type=int, default=300)
+    parser.add_argument('--output')
+    args = parser.parse_args(argv)
+    servers = args.servers.split(',')
+    for server in servers:
+        if server not in SERVERS:
+            parser.error('unknown server: ' + server)
+    endpoints = args.endpoints.split(',')
+    for endpoint in endpoints:
+        if endpoint not in ENDPOINTS:
+            parser.error('unknown endpoint: ' + endpoint)
+    concurrency_levels = [int(level) for level in args.concurrency.split(',')]
+
+    env = dict(os.environ, MONGO_URI=args.mongo_uri, IP='127.0.0.1',
+               **SERVER_SETTINGS)
+    if not args.cache:
+        env.update(NO_CACHE_SETTINGS)
+    if args.workers:
+        env['WEB_CONCURRENCY'] = str(args.workers)
+    if args.threads:
+        env['GUNICORN_THREADS'] = str(args.threads)
+
+    if args.in_memory:
+        module = 'benchmarks.memory_app'
+        # MongoDB commands are not monitored in memory
+        env.update(QUERY_INSTRUMENTATION='0',
+                   BENCHMARK_USERS=str(args.users),
+                   BENCHMARK_POSTS=str(args.posts),
+                   BENCHMARK_PICTURES=str(args.pictures))
+    else:
+        module = 'app'
+        os.environ.update(MONGO_URI=args.mongo_uri, **SERVER_SETTINGS)
+        from flyhighblog import create_app, mongo
+        from flyhighblog.indexes import ensure_indexes
+        from benchmarks.dataset import seed, describe
+        app = create_app()
+        started = time.perf_counter()
+        seed(app, args.users, args.posts, args.pictures)
+        print('Seeded in {:.1f} s'.format(time.perf_counter() - started),
+              file=sys.stderr)
+        with app.app_context():
+            ensure_indexes()
+            dataset = describe(mongo.db)
+        targets = load_targets(app)
+
+    upload = jpeg((1200, 800), random.Random(1))
+    results = {'benchmark': 'serving',
+               'date': datetime.utcnow().isoformat(timespec='seconds'),
+               'revision': revision(),
+               'settings': {key: value for key, value in vars(args).items()
+                            if key != 'output'},
+               'dataset': None,
+               'servers': {}}
+    for server in servers:
+        port = free_port()
+        url = 'http://127.0.0.1:{}'.format(port)
+        server_env = dict(env, PORT=str(port))
+        with tempfile.TemporaryDirectory() as folder, \
+                tempfile.TemporaryFile() as log:
+            if args.in_memory:
+                server_env['BENCHMARK_TARGETS'] = os.path.join(
+                    folder, 'targets.json')
+            process = start_server(server, module, server_env, log,
+                                   preload=args.in_memory)
+            try:
+                wait_for_server(process, url, args.startup_timeout, log)
+                if args.in_memory:
+                    with open(server_env['BENCHMARK_TARGETS']) as f:
+                        data = json.load(f)
+                    dataset, targets = data['dataset'], data['targets']
+                results['dataset'] = dataset
+
+                results['servers'][server] = {}
+                for concurrency in concurrency_levels:
+                    levels = results['servers'][server][concurrency] = {}
+                    for endpoint in endpoints:
+                        if endpoint == 'file' and not targets['files']:
+                            continue
+                        result = measure(HTTPTransport(url), endpoint,
+                                         targets, args.requests, concurrency,
+                                         args.warmup, upload)
+                        levels[endpoint] = result
+                        print('{:<12} {:>4} clients  {:<12} p50 {:>8} ms  '
+                              'p95 {:>8} ms  {:>7} req/s  errors {}'.format(
+                                  server, concurrency, endpoint,
+                                  result['p50_ms'], result['p95_ms'],
+                                  result['throughput_rps'],
+                                  result['errors']))
+            finally:
+                stop_server(process)
+
+    # Throughput of gunicorn relative to development server
+    if set(SERVERS) <= set(results['servers']):
+        print('\nThroughput of gunicorn / development server:')
+        for concurrency in concurrency_levels:
+            ratios = []
+            for endpoint, result in \
+                    results['servers']['gunicorn'][concurrency].items():
+                before = results['servers']['development'][concurrency].get(
+                    endpoint)
+                if before and before['throughput_rps']:
+                    ratios.append('{} {:.2f}x'.format(
+                        endpoint,
+                        result['throughput_rps'] / before['throughput_rps']))
+            print('{:>4} clients  {}'.format(concurrency, '  '.join(ratios)))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# Measurement of peak memory used by processing of uploaded post picture
+# Large JPEG picture (6000x4000 by default) is processed by post_picture
+#   (decoding at reduced scale, resizing to all widths and storing the
+#   variants) in a fresh process and increase of peak RSS of the process
+#   (ru_maxrss) is compared with --max-mb and with full decode and resize
+#   of the same picture; bitmaps are allocated by Pillow outside of Python
+#   heap, so as they are not seen by tracemalloc
+# Each measurement runs in its own process after a small picture has been
+#   processed, so as imports and encoders are not counted; the picture is
+#   generated by another process, as peak RSS of parent process is
+#   inherited by processes it starts
+# Exits with status 1 if processing of the picture exceeds --max-mb
+# Usage:
+#   python -m benchmarks.upload_memory --max-mb 40
+#   python -m benchmarks.upload_memory --in-memory  (requires mongomock)
+#   python -m benchmarks.upload_memory --size 8000x6000 --max-mb 60
+import io
+import os
+import sys
+import json
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from benchmarks.dataset import jpeg
+
+
+# Peak RSS of current process in MB (ru_maxrss is in bytes on macOS and
+#   in kilobytes elsewhere)
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024
+
+
+# Function for measuring one mode in current process (run by main in
+#   subprocess) - 'upload' processes the picture by post_picture, 'full'
+#   decodes it at full size and resizes it to the widest variant
+# Returns increase of peak RSS in MB
+def measure(mode, path, in_memory):
+    from PIL import Image
+    from werkzeug.datastructures import FileStorage
+    with open(path, 'rb') as f:
+        data = f.read()
+    small = jpeg((1200, 800), random.Random(1))
+
+    if mode == 'full':
+        from flyhighblog.posts.utils import POST_PICTURE_WIDTHS
+        width = max(POST_PICTURE_WIDTHS)
+
+        def process(content):
+            image = Image.open(io.BytesIO(content))
+            image.load()
+            image.resize((width, image.size[1] * width // image.size[0]))
+
+        process(small)
+        baseline = peak_rss_mb()
+        process(data)
+        return peak_rss_mb() - baseline
+
+    if in_memory:
+        from benchmarks.memory import use_in_memory_database
+        use_in_memory_database()
+    from flyhighblog import create_app
+    from flyhighblog.posts.utils import post_picture
+    app = create_app()
+    with app.app_context():
+        post_picture(FileStorage(io.BytesIO(small), filename='small.jpg'))
+        baseline = peak_rss_mb()
+        post_picture(FileStorage(io.BytesIO(data), filename='large.jpg'))
+        return peak_rss_mb() - baseline
+
+
+# Function for running one step (generating the picture or measuring one
+#   mode) in a fresh process
+# Returns result printed by the step
+def run_step(step, path, args, env):
+    command = [sys.executable, '-m', 'benchmarks.upload_memory',
+               '--step', step, '--picture', path, '--size', args.size]
+    if args.in_memory:
+        command.append('--in-memory')
+    output = subprocess.check_output(command, env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure peak memory of processing uploaded picture.')
+    parser.add_argument('--size', default='6000x4000',
+                        help='Size of the picture (WIDTHxHEIGHT).')
+    parser.add_argument('--max-mb', type=float, default=40,
+                        help='Maximum increase of peak RSS in MB.')
+    parser.add_argument('--mongo-uri', default=os.environ.get(
+        'BENCHMARK_MONGO_URI',
+        'mongodb://localhost:27017/flyhigh_benchmark'))
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Use in-memory database (mongomock).')
+    parser.add_argument('--step', choices=('generate', 'upload', 'full'),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--picture', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    width, height = (int(value) for value in args.size.split('x'))
+
+    if args.step == 'generate':
+        with open(args.picture, 'wb') as f:
+            f.write(jpeg((width, height), random.Random(1)))
+        print(json.dumps(os.path.getsize(args.picture)))
+        return
+    if args.step:
+        print(json.dumps(measure(args.step, args.picture, args.in_memory)))
+        return
+
+    # Application reads its configuration from environment; pictures are
+    #   processed synchronously by measured process and nothing is cached
+    env = dict(os.environ, MONGO_URI=args.mongo_uri,
+               SECRET_KEY=os.environ.get('SECRET_KEY', 'benchmark'),
+               MONGO_ENSURE_INDEXES='0', MONGO_MIGRATE_DATA='0',
+               IMAGE_CACHE_MAX_BYTES='0', IMAGE_CACHE_MAX_ITEM_BYTES='0',
+               IMAGE_MAX_PIXELS=str(max(width * height,
+                                        40000000)))
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'picture.jpg')
+        run_step('generate', path, args, env)
+        upload = run_step('upload', path, args, env)
+        full = run_step('full', path, args, env)
+
+    print('{}x{} JPEG: upload processing +{:.1f} MB peak RSS, full decode '
+          '+{:.1f} MB (limit {:.0f} MB)'.format(width, height, upload, full,
+                                                args.max_mb))
+    if upload > args.max_mb:
+        raise SystemExit('Peak memory of upload processing exceeds '
+                         '{:.0f} MB'.format(args.max_mb))
+
+
+if __name__ == '__main__':
+    main()
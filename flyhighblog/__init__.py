@@ -1,19 +1,61 @@
 # Importing Flask application framework
 from flask import Flask
+# Importing middleware reading client address from proxy headers
+from werkzeug.middleware.proxy_fix import ProxyFix
 # Importing tools for interacting with MongoDB
 from flask_pymongo import PyMongo
 # Importing flask-mail
 from flask_mail import Mail
+# Importing tool for Image processing
+from PIL import Image
 # Importing application config details
 from flyhighblog.config import Config
+# Importing caches of rendered pages and images
+from flyhighblog.cache import PageCache, ImageCache
+# Importing storage of uploaded files
+from flyhighblog.filestore import FileStore
+# Importing queue of background image processing jobs
+from flyhighblog.jobs import ImageQueue
+# Importing outbox of e-mails sent in background
+from flyhighblog.outbox import MailOutbox
+# Importing instrumentation of MongoDB queries
+from flyhighblog.instrumentation import QueryInstrumentation
+# Importing exporter of application metrics
+from flyhighblog.metrics import Metrics
+# Importing profiler of requests
+from flyhighblog.profiler import RequestProfiler
 
 
 # Setting the PyMongo application object
 mongo = PyMongo()
 
+# Setting the instrumentation of MongoDB queries
+query_instrumentation = QueryInstrumentation()
+
+# Setting the exporter of application metrics
+metrics_exporter = Metrics()
+
+# Setting the profiler of requests
+request_profiler = RequestProfiler()
+
 # Setting the flask-mail application object
 mail = Mail()
 
+# Setting the outbox of e-mails sent in background
+mail_outbox = MailOutbox()
+
+# Setting the storage of uploaded files
+file_store = FileStore()
+
+# Setting the cache of rendered public pages
+page_cache = PageCache()
+
+# Setting the cache of images stored in database
+image_cache = ImageCache()
+
+# Setting the queue of background image processing jobs
+image_queue = ImageQueue()
+
 
 # Creating app with all the required parameters
 def create_app(config_class=Config):
@@ -22,14 +64,51 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     
     # Importing application config details
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
+
+    # Reading client address and scheme from headers set by trusted
+    #   proxies (e.g. Heroku router) in front of the application
+    if app.config['PROXY_FIX_HOPS']:
+        app.wsgi_app = ProxyFix(app.wsgi_app,
+                                x_for=app.config['PROXY_FIX_HOPS'],
+                                x_proto=app.config['PROXY_FIX_HOPS'])
 
-    # Initializing mongo application object
-    mongo.init_app(app)
+    # Initializing instrumentation of MongoDB queries and mongo
+    #   application object (with connection pool settings and listener
+    #   of MongoDB commands)
+    query_instrumentation.init_app(app)
+    mongo.init_app(app, **mongo_client_options(app))
+
+    # Initializing exporter of application metrics ('/metrics')
+    metrics_exporter.init_app(app)
+
+    # Initializing profiler of requests (including 'flask profiler ...'
+    #   commands); must be initialized after instrumentation of queries,
+    #   so as queries are recorded when profile is saved
+    request_profiler.init_app(app)
     
     # Initializing flask-mail application object
     mail.init_app(app)
 
+    # Initializing outbox of e-mails (including 'flask outbox ...'
+    #   commands)
+    mail_outbox.init_app(app)
+
+    # Initializing storage of uploaded files
+    file_store.init_app(app)
+
+    # Initializing caches of rendered public pages and images
+    page_cache.init_app(app)
+    image_cache.init_app(app)
+
+    # Initializing queue of background image processing jobs
+    #   (including 'flask images ...' commands)
+    image_queue.init_app(app)
+
+    # Pillow refuses to open images far over pixel budget (decompression
+    #   bomb protection) even if they are not checked by the application
+    Image.MAX_IMAGE_PIXELS = app.config['IMAGE_MAX_PIXELS']
+
     # Importing particular routes.py files from respective subfolders
     #   in flyhighblog folder (Blueprint)
     from flyhighblog.main.routes import main
@@ -41,4 +120,53 @@ def create_app(config_class=Config):
     app.register_blueprint(users)
     app.register_blueprint(errors)
 
+    # Registering index management commands ('flask indexes ...')
+    #   and creating indexes on application start (if enabled)
+    from flyhighblog.indexes import indexes_cli, ensure_indexes_on_startup
+    app.cli.add_command(indexes_cli)
+    if app.config['MONGO_ENSURE_INDEXES']:
+        ensure_indexes_on_startup(app)
+
+    # Completing data of documents created by earlier versions of the
+    #   application on application start (if enabled)
+    from flyhighblog.migrations import migrate_data_on_startup
+    if app.config['MONGO_MIGRATE_DATA']:
+        migrate_data_on_startup(app)
+
+    # Registering maintenance commands of stored files ('flask storage ...')
+    from flyhighblog.storage import storage_cli
+    app.cli.add_command(storage_cli)
+
     return app
+
+
+# Function for getting options of MongoDB client from application config -
+#   connection pool size, timeouts (0 = no timeout) and listener of
+#   MongoDB commands
+def mongo_client_options(app):
+    return {
+        'maxPoolSize': app.config['MONGO_MAX_POOL_SIZE'],
+        'minPoolSize': app.config['MONGO_MIN_POOL_SIZE'],
+        'connectTimeoutMS': app.config['MONGO_CONNECT_TIMEOUT_MS'],
+        'serverSelectionTimeoutMS':
+            app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+        'socketTimeoutMS': app.config['MONGO_SOCKET_TIMEOUT_MS'] or None,
+        'waitQueueTimeoutMS':
+            app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'] or None,
+        'event_listeners': query_instrumentation.event_listeners,
+    }
+
+
+# Function for preparing worker process forked from process which already
+#   created the application (e.g. gunicorn with preload_app, see
+#   gunicorn.conf.py)
+# MongoDB client is not fork-safe - connections and monitoring threads of
+#   the parent process must not be used by the worker, therefore worker
+#   creates its own client (client of the parent is not closed, as closing
+#   it would end sessions on connections shared with the parent)
+# Background threads of image queue and mail outbox are not copied by
+#   fork, so as they are started again by the worker on first use
+def init_worker(app):
+    mongo.init_app(app, **mongo_client_options(app))
+    image_queue.threads = []
+    mail_outbox.threads = []
@@ -0,0 +1,417 @@
+# Importing os to have access to sytem-based functions and variables
+import os
+# Importing tools for hashing rendered pages (ETag)
+import hashlib
+# Importing JSON encoder for metadata of images cached on disk
+import json
+# Importing time functions for cache expiry
+import time
+# Importing ordered dictionary for keeping least recently used order
+from collections import OrderedDict
+# Importing decorator preserving view function attributes
+from functools import wraps
+# Importing lock for sharing cache between threads
+from threading import Lock
+# Importing functions for manipulating dates
+from datetime import datetime, timezone
+# Importing required flask methods and functions
+from flask import current_app, request, session, make_response
+# Importing helper for validating filenames
+from werkzeug.utils import secure_filename
+# Importing MongoDB return options
+from pymongo import ReturnDocument
+# Importing recording of cache lookups
+from flyhighblog.metrics import cache_lookup
+
+
+# Least recently used (LRU) cache shared by threads of a worker
+# When the cache is full (more than 'max_entries' entries or more than
+#   'max_bytes' bytes as measured by 'sizeof'), least recently used
+#   entries are discarded; None means no limit
+# Entries expire after 'ttl' seconds (never if None)
+class LRUCache:
+    def __init__(self, max_entries=256, ttl=None, max_bytes=None,
+                 sizeof=len):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Returning cached value (None if not cached or expired)
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None \
+                    and time.monotonic() >= entry[1]:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # Saving value to cache
+    # Value bigger than the whole cache is not saved
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (value, expires, size)
+            self.size += size
+            while ((self.max_entries is not None
+                    and len(self.entries) > self.max_entries)
+                   or (self.max_bytes is not None
+                       and self.size > self.max_bytes)):
+                self._remove(next(iter(self.entries)))
+
+    # Removing value from cache
+    def delete(self, key):
+        with self.lock:
+            self._remove(key)
+
+    # Removing all values from cache
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    # Cache statistics
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'bytes': self.size,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+    # Removing entry; lock must be held by the caller
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+# Generation of cached data shared by all workers (processes) by means
+#   of document in 'cache_generations' collection
+# Invalidation increases the generation in database; each worker compares
+#   generation of its cached data with database at most every
+#   CACHE_SYNC_INTERVAL seconds (on every check if 0), so as data changed
+#   by another worker (or by 'flask ...' command) are not served from
+#   cache for longer than the interval
+class CacheGeneration:
+    def __init__(self, name):
+        self.name = name
+        # Generation of cached data (None = not known yet)
+        self.generation = None
+        self.checked = None
+        self.lock = Lock()
+
+    # Collection of generations
+    @property
+    def generations(self):
+        from flyhighblog import mongo
+        return mongo.db.cache_generations
+
+    # Checking if cached data are still current; returns False if data
+    #   were invalidated since the last check (cache must be cleared)
+    def is_current(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.checked is not None and now - self.checked < \
+                    current_app.config['CACHE_SYNC_INTERVAL']:
+                return True
+            # Other threads use cached data until the check is done
+            self.checked = now
+        document = self.generations.find_one({'_id': self.name})
+        generation = document['generation'] if document else 0
+        with self.lock:
+            current = generation == self.generation
+            self.generation = generation
+        return current
+
+    # Invalidating cached data of all the workers
+    def invalidate(self):
+        document = self.generations.find_one_and_update(
+            {'_id': self.name}, {'$inc': {'generation': 1}}, upsert=True,
+            return_document=ReturnDocument.AFTER)
+        with self.lock:
+            self.generation = document['generation']
+            self.checked = time.monotonic()
+
+
+# Cache of rendered public pages
+# Only pages displayed to anonymous users without flash messages are
+#   cached, so as logged users always see their own navbar
+# Cached pages are served with strong ETag, so as browsers and proxies
+#   can revalidate them and receive 304 Not Modified
+# Each worker has its own cache; invalidation is shared by all the
+#   workers (see CacheGeneration)
+# Page rendered while the cache was cleared (e.g. post edited during
+#   rendering) is not cached, as it may show data from before the change
+class PageCache:
+    def __init__(self):
+        self.cache = LRUCache()
+        self.generation = CacheGeneration('pages')
+        # Number of times the cache was cleared by this worker
+        self.clears = 0
+        self.lock = Lock()
+
+    # Setting cache parameters from application config
+    def init_app(self, app):
+        self.cache = LRUCache(max_entries=app.config['PAGE_CACHE_SIZE'],
+                              ttl=app.config['PAGE_CACHE_TTL'])
+
+    # Checking if current request can be served from cache
+    def is_cacheable(self):
+        return (current_app.config['PAGE_CACHE_SIZE'] > 0
+                and request.method == 'GET'
+                and 'user_id' not in session
+                and '_flashes' not in session)
+
+    # Decorator for caching rendered page of a view
+    # Cache key consists of URL path and sorted URL arguments
+    def cached(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not self.is_cacheable():
+                return view(*args, **kwargs)
+
+            # Pages rendered before another worker invalidated the cache
+            #   are discarded
+            if not self.generation.is_current():
+                self.clear()
+
+            key = (request.path,
+                   tuple(sorted(request.args.items(multi=True))))
+            page = self.cache.get(key)
+            cache_lookup('page', page is not None)
+            if page is None:
+                clears = self.clears
+                response = make_response(view(*args, **kwargs))
+                # Error pages, redirects and pages which generated flash
+                #   messages are not cached
+                if response.status_code != 200 or not self.is_cacheable():
+                    return response
+                body = response.get_data()
+                page = (body, response.mimetype,
+                        hashlib.sha1(body).hexdigest())
+                with self.lock:
+                    if self.clears == clears:
+                        self.cache.set(key, page)
+
+            body, mimetype, etag = page
+            response = current_app.response_class(body, mimetype=mimetype)
+            response.set_etag(etag)
+            # Browsers need to revalidate the page before using it
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+        return wrapper
+
+    # Removing all cached pages (in all the workers); called after data
+    #   displayed on public pages (posts, user details) are written
+    #   to database
+    def invalidate(self):
+        if current_app.config['PAGE_CACHE_SIZE'] > 0:
+            self.generation.invalidate()
+        self.clear()
+
+    # Removing all cached pages of this worker
+    def clear(self):
+        with self.lock:
+            self.clears += 1
+            self.cache.clear()
+
+
+# Least recently used (LRU) cache of files in a local directory
+# When the directory holds more than 'max_bytes' bytes, least recently
+#   used files are deleted
+# Directory can be shared by several workers; each worker keeps its own
+#   index of cached files, which is loaded from directory on start
+class DiskCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Loading files already present in directory, least recently
+        #   used first
+        files = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.endswith(('.json',
+                                                            '.tmp')):
+                stat = entry.stat()
+                files.append((stat.st_atime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+
+    # Returning cached data and metadata (None if not cached)
+    def get(self, key):
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path + '.json') as f:
+                meta = json.load(f)
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return data, meta
+
+    # Saving data and metadata to directory
+    # Files are written to temporary file first and then renamed, so as
+    #   other workers never read incomplete file
+    def set(self, key, data, meta):
+        if len(data) > self.max_bytes:
+            return
+        path = os.path.join(self.directory, key)
+        tmp_suffix = '.{}.tmp'.format(os.getpid())
+        with open(path + tmp_suffix, 'wb') as f:
+            f.write(data)
+        os.replace(path + tmp_suffix, path)
+        with open(path + '.json' + tmp_suffix, 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.json' + tmp_suffix, path + '.json')
+
+        with self.lock:
+            self.size -= self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    # Removing file from directory
+    def delete(self, key):
+        with self.lock:
+            self._remove(key)
+
+    # Removing file; lock must be held by the caller
+    # Files might have been already removed by another worker
+    def _remove(self, key):
+        self.size -= self.entries.pop(key, 0)
+        for path in (key, key + '.json'):
+            try:
+                os.remove(os.path.join(self.directory, path))
+            except FileNotFoundError:
+                pass
+
+
+# Cache of images served by /file/<filename>
+# Images are kept in memory (up to IMAGE_CACHE_MAX_BYTES bytes) and
+#   optionally on local disk (in IMAGE_CACHE_DIR, up to
+#   IMAGE_CACHE_DISK_MAX_BYTES bytes), so as frequently displayed images
+#   are served without reading them from MongoDB
+# Images bigger than IMAGE_CACHE_MAX_ITEM_BYTES are not cached and are
+#   always streamed from database
+# Image deleted by another worker (or process) is removed only from its
+#   cache, therefore cached image which was not checked for more than
+#   IMAGE_CACHE_REVALIDATE_INTERVAL seconds is served only if its file
+#   still exists in file storage
+# Cached image is dictionary with 'data', 'content_type', 'etag',
+#   'upload_date' and 'checked' (time of the last check)
+class ImageCache:
+    def __init__(self):
+        self.memory = LRUCache(max_entries=None, max_bytes=0,
+                               sizeof=lambda image: len(image['data']))
+        self.disk = None
+        self.max_item_bytes = 0
+        self.revalidate_interval = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Setting cache parameters from application config
+    def init_app(self, app):
+        self.max_item_bytes = app.config['IMAGE_CACHE_MAX_ITEM_BYTES']
+        self.revalidate_interval = \
+            app.config['IMAGE_CACHE_REVALIDATE_INTERVAL']
+        self.memory = LRUCache(max_entries=None,
+                               max_bytes=app.config['IMAGE_CACHE_MAX_BYTES'],
+                               sizeof=lambda image: len(image['data']))
+        if app.config['IMAGE_CACHE_DIR']:
+            self.disk = DiskCache(app.config['IMAGE_CACHE_DIR'],
+                                  app.config['IMAGE_CACHE_DISK_MAX_BYTES'])
+
+    # Checking if image of given filename and size can be cached
+    # Filenames are used as names of files on disk, therefore only
+    #   secure filenames are accepted
+    def is_cacheable(self, filename, length):
+        return (length <= self.max_item_bytes
+                and secure_filename(filename) == filename)
+
+    # Returning cached image (None if not cached)
+    def get(self, filename):
+        image = self.memory.get(filename)
+        if image is None and self.disk is not None \
+                and secure_filename(filename) == filename:
+            cached = self.disk.get(filename)
+            if cached is not None:
+                data, meta = cached
+                image = dict(meta, data=data,
+                             upload_date=datetime.utcfromtimestamp(
+                                 meta['upload_date']))
+                # Image found on disk is moved to memory
+                self.memory.set(filename, image)
+        if image is not None and time.time() - image.get('checked', 0) >= \
+                self.revalidate_interval:
+            from flyhighblog import file_store
+            if file_store.find(filename) is None:
+                self.delete(filename)
+                image = None
+            else:
+                image['checked'] = time.time()
+        with self.lock:
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        cache_lookup('image', image is not None)
+        return image
+
+    # Saving image to cache
+    def set(self, filename, image):
+        if not self.is_cacheable(filename, len(image['data'])):
+            return
+        image['checked'] = time.time()
+        self.memory.set(filename, image)
+        if self.disk is not None:
+            meta = {'content_type': image['content_type'],
+                    'etag': image['etag'],
+                    'upload_date': image['upload_date'].replace(
+                        tzinfo=timezone.utc).timestamp(),
+                    'checked': image['checked']}
+            self.disk.set(filename, image['data'], meta)
+
+    # Removing image from cache; called when file is deleted from database
+    def delete(self, filename):
+        self.memory.delete(filename)
+        if self.disk is not None and secure_filename(filename) == filename:
+            self.disk.delete(filename)
+
+    # Cache statistics (hits and misses of memory and disk together)
+    def stats(self):
+        memory = self.memory.stats()
+        with self.lock:
+            return {'entries': memory['entries'],
+                    'bytes': memory['bytes'],
+                    'disk_entries': len(self.disk.entries) if self.disk
+                    else 0,
+                    'disk_bytes': self.disk.size if self.disk else 0,
+                    'hits': self.hits,
+                    'misses': self.misses}
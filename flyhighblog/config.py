@@ -16,10 +16,161 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY')
     MONGO_DBNAME = os.getenv('DB_NAME')
     MONGO_URI = os.getenv('MONGO_URI')
+    # Creating required indexes on application start
+    #   (can be switched off and done by 'flask indexes ensure' instead)
+    MONGO_ENSURE_INDEXES = os.getenv('MONGO_ENSURE_INDEXES', '1') == '1'
+    # Completing data of documents created by earlier versions of the
+    #   application (e.g. post counts of users) on application start
+    #   (see migrations.py)
+    MONGO_MIGRATE_DATA = os.getenv('MONGO_MIGRATE_DATA', '1') == '1'
+    # Connection pool of MongoDB client (per process) - maximum and
+    #   minimum number of connections (maximum should not be lower than
+    #   number of threads of application server worker) and timeouts in
+    #   milliseconds of connecting, of selecting server, of waiting for
+    #   database response and of waiting for free connection (0 = no
+    #   timeout); options override options given in MONGO_URI
+    MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+    MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+    MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS',
+                                                  20000))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get(
+        'MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000))
+    MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS',
+                                                 0))
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get(
+        'MONGO_WAIT_QUEUE_TIMEOUT_MS', 0))
+    # Recording MongoDB commands of each request (see instrumentation.py),
+    #   reporting them in 'Server-Timing' response header and logging
+    #   requests slower than SLOW_REQUEST_MS milliseconds (0 = off) with
+    #   their SLOW_REQUEST_COMMANDS slowest commands to SLOW_REQUEST_LOG
+    #   file (application log if not set)
+    QUERY_INSTRUMENTATION = os.getenv('QUERY_INSTRUMENTATION', '1') == '1'
+    SERVER_TIMING = os.getenv('SERVER_TIMING', '1') == '1'
+    SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 1000))
+    SLOW_REQUEST_COMMANDS = int(os.environ.get('SLOW_REQUEST_COMMANDS', 5))
+    SLOW_REQUEST_LOG = os.environ.get('SLOW_REQUEST_LOG')
+    # Exporting application metrics at '/metrics' in Prometheus format
+    #   (see metrics.py) to clients with bearer token METRICS_TOKEN
+    #   (without the token only in debug mode)
+    METRICS = os.getenv('METRICS', '0') == '1'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # Profiling of requests (see profiler.py) - requests from addresses
+    #   in PROFILER_ALLOW (comma separated) or with token generated by
+    #   'flask profiler token' are profiled and their profiles are saved
+    #   to PROFILER_DIR; 'sampling' mode samples stacks every
+    #   PROFILER_INTERVAL milliseconds (flamegraph folded stacks),
+    #   'deterministic' mode records all function calls (cProfile)
+    PROFILER = os.getenv('PROFILER', '0') == '1'
+    PROFILER_DIR = os.environ.get('PROFILER_DIR', 'profiles')
+    PROFILER_MODE = os.environ.get('PROFILER_MODE', 'sampling')
+    PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL', 5))
+    PROFILER_ALLOW = [address for address in
+                      os.environ.get('PROFILER_ALLOW', '').split(',')
+                      if address]
+    PROFILER_TOKEN_MAX_AGE = int(os.environ.get('PROFILER_TOKEN_MAX_AGE',
+                                                3600))
+    # Number of proxies in front of the application (Heroku router = 1)
+    #   whose X-Forwarded-For and X-Forwarded-Proto headers are trusted,
+    #   so as address of the client (e.g. for PROFILER_ALLOW) is used
+    #   instead of address of the proxy; 0 = headers are ignored
+    PROXY_FIX_HOPS = int(os.environ.get('PROXY_FIX_HOPS', 0))
     # Setting email parameters
-    MAIL_SERVER = 'smtp.gmail.com'
-    MAIL_PORT = 465
+    # Mail server can be replaced by local SMTP sink in development
+    #   ('flask outbox smtp-sink'; MAIL_SERVER=localhost, MAIL_PORT=1025,
+    #   MAIL_USE_SSL=0)
+    MAIL_SERVER = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
+    MAIL_PORT = int(os.environ.get('MAIL_PORT', 465))
     MAIL_USE_TLS = False
-    MAIL_USE_SSL = True
+    MAIL_USE_SSL = os.getenv('MAIL_USE_SSL', '1') == '1'
     MAIL_USERNAME = os.environ.get('EMAIL_USER')
     MAIL_PASSWORD = os.environ.get('EMAIL_PASS')
+    # Background sending of e-mails - sending e-mails outside of the
+    #   request (switched off = sending within the request), number
+    #   of sending threads per application worker (0 if e-mails are sent
+    #   only by 'flask outbox worker'), maximum number of e-mails sent over
+    #   one connection, maximum number of attempts, delay before the first
+    #   retry and maximum sending time (in seconds) and interval
+    #   of checking for new e-mails
+    MAIL_OUTBOX_ASYNC = os.getenv('MAIL_OUTBOX_ASYNC', '1') == '1'
+    MAIL_OUTBOX_THREADS = int(os.environ.get('MAIL_OUTBOX_THREADS', 1))
+    MAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('MAIL_OUTBOX_BATCH_SIZE',
+                                                50))
+    MAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('MAIL_OUTBOX_MAX_ATTEMPTS',
+                                                  5))
+    MAIL_OUTBOX_RETRY_DELAY = int(os.environ.get('MAIL_OUTBOX_RETRY_DELAY',
+                                                 30))
+    MAIL_OUTBOX_SEND_TIMEOUT = int(os.environ.get('MAIL_OUTBOX_SEND_TIMEOUT',
+                                                  300))
+    MAIL_OUTBOX_POLL_INTERVAL = int(os.environ.get(
+        'MAIL_OUTBOX_POLL_INTERVAL', 5))
+    # Number of seconds after which cached author directory (navbar)
+    #   is refreshed from database
+    AUTHORS_CACHE_TTL = int(os.environ.get('AUTHORS_CACHE_TTL', 300))
+    # Saving new posts with snapshot of author data (name, username and
+    #   profile image) and author stored as ObjectId, so as posts are
+    #   displayed without pulling their authors (existing posts are
+    #   converted by 'flask posts backfill-authors')
+    POST_AUTHOR_SNAPSHOT = os.getenv('POST_AUTHOR_SNAPSHOT', '0') == '1'
+    # Maximum number of rendered public pages kept in cache per worker
+    #   (0 switches page cache off) and number of seconds after which
+    #   cached page expires
+    PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', 256))
+    PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 60))
+    # Maximum number of seconds for which a worker serves cached pages
+    #   and author directory after they were invalidated by another worker
+    #   (0 = worker checks database on every cache lookup)
+    CACHE_SYNC_INTERVAL = float(os.environ.get('CACHE_SYNC_INTERVAL', 1))
+    # Maximum number of search results (posts) listed for search terms
+    SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 1000))
+    # Number of seconds for which browsers and proxies cache uploaded
+    #   pictures (one year)
+    FILE_CACHE_MAX_AGE = int(os.environ.get('FILE_CACHE_MAX_AGE', 31536000))
+    # Maximum size of request (uploaded pictures) in bytes - bigger
+    #   requests are rejected with 413 error before they are read
+    MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH',
+                                            16 * 1024 * 1024))
+    # Maximum number of pixels of uploaded picture (width x height) - bigger
+    #   pictures are rejected before they are decoded into memory
+    IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 40000000))
+    # File storage - backend for new uploaded files ('gridfs' or
+    #   'filesystem'), directory of 'filesystem' backend, internal location
+    #   of the directory in nginx (files are sent by nginx by means
+    #   of X-Accel-Redirect header) or sending files by front server
+    #   by means of X-Sendfile header (Apache, lighttpd)
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'gridfs')
+    STORAGE_DIR = os.getenv('STORAGE_DIR')
+    STORAGE_ACCEL_REDIRECT = os.getenv('STORAGE_ACCEL_REDIRECT')
+    USE_X_SENDFILE = os.getenv('USE_X_SENDFILE', '0') == '1'
+    # Storing each unique image (e.g. the same photo uploaded to several
+    #   posts) only once - images are named by hash of their content
+    IMAGE_STORAGE_DEDUP = os.getenv('IMAGE_STORAGE_DEDUP', '1') == '1'
+    # Image cache - maximum size of images cached in memory per worker,
+    #   maximum size of one cached image, number of seconds after which
+    #   cached image is checked to still exist in storage (deleted by
+    #   another worker), optional local directory for caching images
+    #   on disk and its maximum size (in bytes)
+    IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES',
+                                               64 * 1024 * 1024))
+    IMAGE_CACHE_MAX_ITEM_BYTES = int(os.environ.get(
+        'IMAGE_CACHE_MAX_ITEM_BYTES', 2 * 1024 * 1024))
+    IMAGE_CACHE_REVALIDATE_INTERVAL = int(os.environ.get(
+        'IMAGE_CACHE_REVALIDATE_INTERVAL', 60))
+    IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR')
+    IMAGE_CACHE_DISK_MAX_BYTES = int(os.environ.get(
+        'IMAGE_CACHE_DISK_MAX_BYTES', 1024 * 1024 * 1024))
+    # Background image processing - processing uploaded images outside
+    #   of the request (switched off = processing within the request),
+    #   number of processing threads per application worker (0 if images
+    #   are processed only by 'flask images worker'), maximum number
+    #   of attempts, delay before the first retry and maximum processing
+    #   time of a job (in seconds) and interval of checking for new jobs
+    IMAGE_QUEUE_ASYNC = os.getenv('IMAGE_QUEUE_ASYNC', '1') == '1'
+    IMAGE_QUEUE_THREADS = int(os.environ.get('IMAGE_QUEUE_THREADS', 1))
+    IMAGE_QUEUE_MAX_ATTEMPTS = int(os.environ.get('IMAGE_QUEUE_MAX_ATTEMPTS',
+                                                  3))
+    IMAGE_QUEUE_RETRY_DELAY = int(os.environ.get('IMAGE_QUEUE_RETRY_DELAY',
+                                                 5))
+    IMAGE_QUEUE_JOB_TIMEOUT = int(os.environ.get('IMAGE_QUEUE_JOB_TIMEOUT',
+                                                 300))
+    IMAGE_QUEUE_POLL_INTERVAL = int(os.environ.get(
+        'IMAGE_QUEUE_POLL_INTERVAL', 2))
@@ -18,6 +18,12 @@ def error_403(error):
     return render_template('errors/403.html',  title='403 error'), 403
 
 
+# 413 error page route - uploaded file exceeds MAX_CONTENT_LENGTH
+@errors.app_errorhandler(413)
+def error_413(error):
+    return render_template('errors/413.html',  title='413 error'), 413
+
+
 # 500 error page route
 @errors.app_errorhandler(500)
 def error_500(error):
@@ -0,0 +1,249 @@
+# Importing os to have access to sytem-based functions and variables
+import os
+# Importing tools for spreading files into directories
+import hashlib
+# Importing functions for manipulating dates
+from datetime import datetime
+# Importing tool for guessing MIME type of files
+from mimetypes import guess_type
+# Importing binary type of MongoDB documents
+from bson.binary import Binary
+# Importing Tools for working with MongoDB ObjectIds
+from bson.objectid import ObjectId
+# Importing GridFS reader of stored files
+from gridfs.grid_file import GridOut
+# Importing MongoDB errors
+from pymongo.errors import DuplicateKeyError
+
+
+# Size of GridFS chunks (GridFS default)
+CHUNK_SIZE = 255 * 1024
+
+
+# Stored file opened for reading - file object of the backend (with
+#   'read', 'seek' and 'close' methods) with attributes of the file
+#   taken from its document
+class StoredFile:
+    def __init__(self, fileobj, document):
+        self.fileobj = fileobj
+        self.filename = document['filename']
+        self.length = document['length']
+        self.content_type = document.get('contentType')
+        self.upload_date = document['uploadDate']
+        self.chunk_size = document.get('chunkSize', CHUNK_SIZE)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+# Backend storing file data in GridFS chunks (fs.chunks)
+class GridFSBackend:
+    name = 'gridfs'
+    # Fields of file document specific to the backend
+    fields = ('chunkSize',)
+
+    @property
+    def chunks(self):
+        from flyhighblog import mongo
+        return mongo.db.fs.chunks
+
+    # Function for writing data of a file (read from 'fileobj') - data are
+    #   inserted in batches of chunks, so as the file is never held
+    #   in memory as a whole
+    # Returns fields to be saved to the file document
+    def write(self, document, fileobj):
+        length = 0
+        batch = []
+        while True:
+            data = fileobj.read(CHUNK_SIZE)
+            if data:
+                batch.append({'files_id': document['_id'],
+                              'n': length // CHUNK_SIZE,
+                              'data': Binary(data)})
+                length += len(data)
+            if batch and (not data or len(batch) >= 16):
+                self.chunks.insert_many(batch)
+                batch = []
+            if not data:
+                break
+        return {'length': length, 'chunkSize': CHUNK_SIZE}
+
+    # Function for opening file for reading
+    def open(self, document):
+        from flyhighblog import mongo
+        return GridOut(mongo.db.fs, file_document=document)
+
+    # Function for deleting data of files
+    def discard(self, documents):
+        file_ids = [document['_id'] for document in documents]
+        if file_ids:
+            self.chunks.delete_many({'files_id': {'$in': file_ids}})
+
+    # GridFS files are always sent by application
+    def offload(self, document, response):
+        return False
+
+
+# Backend storing file data in local (or network mounted) directory
+# Files are spread into two levels of subdirectories (e.g. 'ab/cd/') by
+#   hash of their _id, so as no directory holds too many files
+# Files can be sent by the front proxy instead of the application:
+#   - if STORAGE_ACCEL_REDIRECT is set (e.g. '/stored-files/'), response
+#     carries 'X-Accel-Redirect' header with the path of the file under
+#     this internal location (nginx)
+#   - if USE_X_SENDFILE is switched on, response carries 'X-Sendfile'
+#     header with absolute path of the file (Apache, lighttpd)
+class FileSystemBackend:
+    name = 'filesystem'
+    # Fields of file document specific to the backend
+    fields = ('storage', 'path')
+
+    def __init__(self, directory, accel_redirect=None, x_sendfile=False):
+        self.directory = directory
+        self.accel_redirect = accel_redirect
+        self.x_sendfile = x_sendfile
+
+    # Path of a file relative to the storage directory
+    def path(self, document):
+        digest = hashlib.md5(str(document['_id']).encode()).hexdigest()
+        _, ext = os.path.splitext(document['filename'])
+        return '/'.join((digest[:2], digest[2:4],
+                         str(document['_id']) + ext.lower()))
+
+    # Function for writing data of a file (read from 'fileobj')
+    # Data are written to temporary file first and then renamed, so as
+    #   incomplete file is never served
+    # Returns fields to be saved to the file document
+    def write(self, document, fileobj):
+        path = self.path(document)
+        full_path = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        length = 0
+        with open(full_path + '.tmp', 'wb') as f:
+            while True:
+                data = fileobj.read(CHUNK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+                length += len(data)
+        os.replace(full_path + '.tmp', full_path)
+        return {'length': length, 'storage': self.name, 'path': path}
+
+    # Function for opening file for reading
+    def open(self, document):
+        return open(os.path.join(self.directory, document['path']), 'rb')
+
+    # Function for deleting data of files
+    # Files might have been already deleted (e.g. by interrupted deletion)
+    def discard(self, documents):
+        for document in documents:
+            try:
+                os.remove(os.path.join(self.directory, document['path']))
+            except FileNotFoundError:
+                pass
+
+    # Function for handing sending of file over to the front proxy
+    # Returns True if response was set up to be sent by the proxy
+    def offload(self, document, response):
+        if self.accel_redirect:
+            response.headers['X-Accel-Redirect'] = \
+                self.accel_redirect.rstrip('/') + '/' + document['path']
+        elif self.x_sendfile:
+            response.headers['X-Sendfile'] = os.path.abspath(
+                os.path.join(self.directory, document['path']))
+        else:
+            return False
+        response.content_length = document['length']
+        return True
+
+
+# Storage of uploaded files
+# Every file is described by a document in fs.files collection (filename,
+#   length, content type, upload date and custom attributes) regardless
+#   of the backend holding its data, so as files are found, referenced
+#   and deleted in the same way in all backends; documents of files
+#   stored in GridFS are standard GridFS documents
+# New files are saved to the backend given by STORAGE_BACKEND ('gridfs' or
+#   'filesystem' - directory STORAGE_DIR); files saved earlier are read
+#   from the backend they were saved to (see 'flask storage migrate')
+class FileStore:
+    def __init__(self):
+        self.backends = {'gridfs': GridFSBackend()}
+        self.backend = self.backends['gridfs']
+
+    # Setting storage parameters from application config
+    def init_app(self, app):
+        self.backends = {'gridfs': GridFSBackend()}
+        if app.config['STORAGE_DIR']:
+            self.backends['filesystem'] = FileSystemBackend(
+                app.config['STORAGE_DIR'],
+                accel_redirect=app.config['STORAGE_ACCEL_REDIRECT'],
+                x_sendfile=app.config['USE_X_SENDFILE'])
+        self.backend = self.backends[app.config['STORAGE_BACKEND']]
+
+    # Collection of file documents
+    @property
+    def files(self):
+        from flyhighblog import mongo
+        return mongo.db.fs.files
+
+    # Function for saving new file
+    # 'attributes' are saved to the file document (e.g. _id or hash)
+    # Raises DuplicateKeyError if the document violates unique index
+    #   (data of the file are deleted)
+    # Returns _id of saved file
+    def save(self, filename, fileobj, **attributes):
+        document = {'_id': ObjectId(),
+                    'filename': filename,
+                    'contentType': guess_type(filename)[0],
+                    'uploadDate': datetime.utcnow()}
+        document.update(attributes)
+        document.update(self.backend.write(document, fileobj))
+        try:
+            self.files.insert_one(document)
+        except DuplicateKeyError:
+            self.backend.discard([document])
+            raise
+        return document['_id']
+
+    # Function for finding document of the latest version of a file
+    #   by filename (None if not found)
+    def find(self, filename):
+        return self.files.find_one({'filename': filename},
+                                   sort=[('uploadDate', -1)])
+
+    # Function for finding document of a file by _id (None if not found)
+    def get(self, file_id):
+        return self.files.find_one({'_id': file_id})
+
+    # Function for opening file (given by its document) for reading
+    # Returns StoredFile
+    def open(self, document):
+        return StoredFile(self.backend_of(document).open(document), document)
+
+    # Function for handing sending of file over to the front proxy
+    # Returns True if response was set up to be sent by the proxy
+    def offload(self, document, response):
+        return self.backend_of(document).offload(document, response)
+
+    # Function for deleting files given by list of _ids
+    # Documents are deleted first, so as a file is never visible with
+    #   its data missing; GridFS chunks are deleted also for files whose
+    #   documents are already missing (e.g. interrupted deletion)
+    def delete(self, file_ids):
+        documents = list(self.files.find({'_id': {'$in': file_ids}},
+                                         {'storage': 1, 'path': 1}))
+        self.files.delete_many({'_id': {'$in': file_ids}})
+        found = {document['_id'] for document in documents}
+        self.discard(documents + [{'_id': file_id} for file_id in file_ids
+                                  if file_id not in found])
+
+    # Function for deleting data of files whose documents were deleted
+    def discard(self, documents):
+        for name, backend in self.backends.items():
+            backend.discard([document for document in documents
+                             if document.get('storage', 'gridfs') == name])
+
+    # Backend holding data of a file
+    def backend_of(self, document):
+        return self.backends[document.get('storage', 'gridfs')]
@@ -0,0 +1,284 @@
+# Importing os to have access to sytem-based functions and variables
+import os
+# Importing in-memory binary buffer
+import io
+# Importing tools for hashing stored images
+import hashlib
+# Importing functions for manipulating dates
+from datetime import datetime
+# Importing tool for guessing MIME type of files
+from mimetypes import guess_type
+# Importing required flask methods and functions
+from flask import url_for, current_app
+# Importing uploaded file type
+from werkzeug.datastructures import FileStorage
+# Importing field validation error
+from wtforms.validators import ValidationError
+# Importing tool for Image processing
+from PIL import Image
+# Importing MongoDB return options and errors
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+# Importing variables from other application packages
+from flyhighblog import mongo, image_cache, file_store
+
+
+# Widths of post picture variants - browsers pick the smallest variant
+#   sufficient for the displayed size (e.g. small card on mobile device)
+# The widest variant in original format is the main post picture
+POST_PICTURE_WIDTHS = (320, 640, 1000)
+
+# Size of profile image and pixel densities of its variants
+#   (2x variant is used by high density displays)
+PROFILE_IMAGE_SIZE = 125
+PROFILE_IMAGE_DENSITIES = (1, 2)
+
+# Extension of WebP variants created next to variants in original format
+WEBP_EXT = '.webp'
+
+
+# Error raised for uploaded image with more pixels than IMAGE_MAX_PIXELS
+class ImageTooLarge(ValueError):
+    pass
+
+
+# Function for opening uploaded image and checking its dimensions
+# Only the image header is read, the image is decoded later (when
+#   resized), so as images over pixel budget (IMAGE_MAX_PIXELS) are
+#   rejected before they are decoded into memory
+def open_image(upload):
+    image = Image.open(upload)
+    width, height = image.size
+    if width * height > current_app.config['IMAGE_MAX_PIXELS']:
+        raise ImageTooLarge('Image {}x{} exceeds {} pixels'.format(
+            width, height, current_app.config['IMAGE_MAX_PIXELS']))
+    return image
+
+
+# Function for decoding JPEG image at reduced scale (1/2, 1/4 or 1/8),
+#   so as the decoded bitmap is not much bigger than the largest size
+#   needed ('width' x 'height', height None = given by aspect ratio)
+# Other formats are decoded at full size
+def draft_image(image, width, height=None):
+    if image.format != 'JPEG':
+        return
+    if height is None:
+        height = max(1, image.size[1] * width // image.size[0])
+    image.draft(image.mode, (width, height))
+
+
+# Form field validator rejecting files which are not images
+#   or which exceed pixel budget (IMAGE_MAX_PIXELS)
+class ImageWithinBudget:
+    def __init__(self, message=None):
+        self.message = message
+
+    def __call__(self, form, field):
+        if not isinstance(field.data, FileStorage) or not field.data:
+            return
+        try:
+            open_image(field.data)
+        except ImageTooLarge:
+            raise ValidationError(self.message or
+                                  'Image is too large. Maximum is {:.0f} '
+                                  'megapixels.'.format(
+                                      current_app.config['IMAGE_MAX_PIXELS']
+                                      / 1000000))
+        except (OSError, Image.DecompressionBombError):
+            raise ValidationError('File is not a valid image.')
+        finally:
+            # Uploaded file is read again when saved
+            field.data.seek(0)
+
+
+# Function for resizing image to given width - aspect ratio kept
+def resize_to_width(image, width):
+    wpercent = (width/float(image.size[0]))
+    hsize = int((float(image.size[1])*float(wpercent)))
+    return image.resize((width, hsize), Image.ANTIALIAS)
+
+
+# Function for resizing image so as it fits into square of given size
+#   - aspect ratio kept
+def resize_to_fit(image, size):
+    image = image.copy()
+    image.thumbnail((size, size))
+    return image
+
+
+# Function for encoding image into memory buffer and saving it
+#   to file storage - no temporary file is written
+# Format of the image is given by filename extension
+# If IMAGE_STORAGE_DEDUP is switched on, the image is saved under the
+#   SHA-256 hash of its encoded bytes instead of given filename, so as the
+#   same image (e.g. re-uploaded press photo) is stored only once
+#   (see save_shared_file)
+# Returns dictionary with 'filename', 'file_id' (_id in fs.files), 'width',
+#   'height', 'size' (encoded size in bytes), 'mime' (MIME type) and
+#   'sha256' (only deduplicated images) of saved file
+def store_image(image, filename):
+    _, ext = os.path.splitext(filename)
+    buffer = io.BytesIO()
+    image.save(buffer, format=Image.registered_extensions()[ext.lower()])
+    size = buffer.tell()
+
+    # Save encoded image to file storage
+    buffer.seek(0)
+    digest = None
+    if current_app.config['IMAGE_STORAGE_DEDUP']:
+        digest = hashlib.sha256(buffer.getvalue()).hexdigest()
+        file_id, filename = save_shared_file(digest + ext.lower(), digest,
+                                             buffer)
+    else:
+        file_id = file_store.save(filename, buffer)
+
+    variant = {'filename': filename,
+               'file_id': file_id,
+               'width': image.size[0],
+               'height': image.size[1],
+               'size': size,
+               'mime': guess_type(filename)[0]}
+    if digest is not None:
+        variant['sha256'] = digest
+    return variant
+
+
+# Function for saving file shared by several documents - file is saved
+#   only if file with the same hash is not stored yet, otherwise number
+#   of references ('refs' in fs.files) of stored file is increased
+# Uniqueness of hashes is guaranteed by unique index (see indexes.py);
+#   if the same file is saved concurrently, the other file wins and
+#   data written by this attempt are deleted (see FileStore.save)
+# Time of the last reference ('referenced') is recorded, so as storage
+#   garbage collection does not delete file which is being re-used
+# Returns _id and filename of stored file
+def save_shared_file(filename, digest, buffer):
+    while True:
+        stored = mongo.db.fs.files.find_one_and_update(
+            {'sha256': digest},
+            {'$inc': {'refs': 1}, '$set': {'referenced': datetime.utcnow()}},
+            projection={'filename': 1})
+        if stored is not None:
+            return stored['_id'], stored['filename']
+
+        buffer.seek(0)
+        try:
+            file_id = file_store.save(filename, buffer, sha256=digest,
+                                      refs=1)
+        except DuplicateKeyError:
+            continue
+        return file_id, filename
+
+
+# Function for ingesting uploaded image - image is decoded once, resized
+#   to all required sizes and each size is encoded in original format
+#   and as WebP and saved to file storage
+# 'sizes' is list of (suffix, resize, extra) tuples - filename suffix of
+#   the size, function resizing decoded image and dictionary of extra
+#   information saved with each variant of the size
+# 'decode_size' is (width, height) of the largest size needed (height
+#   None = given by aspect ratio); JPEG images are decoded at reduced
+#   scale close to it (see draft_image)
+# Files are named '<basename><suffix><extension>'
+# Returns list of variants (see store_image)
+def ingest_image(upload, basename, sizes, decode_size):
+    _, ext = os.path.splitext(upload.filename)
+    image = open_image(upload)
+    draft_image(image, *decode_size)
+    variants = []
+    for suffix, resize, extra in sizes:
+        resized = resize(image)
+        for variant_ext in (ext, WEBP_EXT):
+            variant = store_image(resized, basename + suffix + variant_ext)
+            variant.update(extra)
+            variants.append(variant)
+    return variants
+
+
+# Function for deleting images from file storage (and image cache)
+# 'files' is list of dictionaries with 'filename' and 'file_id' (see
+#   store_image); files saved without 'file_id' (before file ids were
+#   recorded) are looked up by filename
+# Deduplicated files (with 'sha256') are deleted only when they are not
+#   referenced by any other document
+# Files are deleted by _id in bulk (see FileStore.delete); files which
+#   are not found in database are skipped
+def delete_images(files):
+    file_ids = []
+    filenames = []
+    released = []
+    for file in files:
+        if file.get('sha256'):
+            document = release_shared_file(file['file_id'])
+            if document is None:
+                continue
+            released.append(document)
+        elif file.get('file_id'):
+            file_ids.append(file['file_id'])
+        else:
+            filenames.append(file['filename'])
+        # Deleting file from image cache
+        image_cache.delete(file['filename'])
+
+    if filenames:
+        file_ids += [image['_id'] for image in mongo.db.fs.files.find(
+            {'filename': {'$in': filenames}}, {'_id': 1})]
+    if file_ids:
+        file_store.delete(file_ids)
+    file_store.discard(released)
+
+
+# Function for releasing reference to shared file (see save_shared_file)
+# File document is deleted if the file is not referenced anymore (and it
+#   was not referenced again meanwhile); the deleted document is returned,
+#   so as data of the file can be deleted (None if file is still used)
+def release_shared_file(file_id):
+    stored = mongo.db.fs.files.find_one_and_update(
+        {'_id': file_id}, {'$inc': {'refs': -1}},
+        projection={'refs': 1}, return_document=ReturnDocument.AFTER)
+    if stored is None or stored['refs'] > 0:
+        return None
+    return mongo.db.fs.files.find_one_and_delete(
+        {'_id': file_id, 'refs': {'$lte': 0}},
+        projection={'storage': 1, 'path': 1})
+
+
+# Function for finding filename of main file of an image - variant
+#   in original format (extension) with given attributes
+#   (e.g. width=1000)
+def main_variant(variants, ext, **attributes):
+    for variant in variants:
+        _, variant_ext = os.path.splitext(variant['filename'])
+        if variant_ext.lower() == ext.lower() and all(
+                variant.get(key) == value
+                for key, value in attributes.items()):
+            return variant['filename']
+
+
+# Function for listing all files of an image - main file and its variants
+# Main file is one of the variants, except for images uploaded before
+#   variants were created
+def image_files(filename, variants):
+    files = list(variants or [])
+    if filename not in (variant['filename'] for variant in files):
+        files.insert(0, {'filename': filename})
+    return files
+
+
+# Function for generating 'srcset' attribute of <img> and <source> tags
+# Variants in WebP format are selected if 'webp' is True, variants
+#   in original format otherwise
+# Variants with pixel density use density descriptors (e.g. '2x'),
+#   other variants use width descriptors (e.g. '640w')
+def image_srcset(variants, webp=False):
+    srcset = []
+    for variant in variants or []:
+        if (variant['mime'] == 'image/webp') != webp:
+            continue
+        if 'density' in variant:
+            descriptor = '{}x'.format(variant['density'])
+        else:
+            descriptor = '{}w'.format(variant['width'])
+        srcset.append('{} {}'.format(
+            url_for('main.file', filename=variant['filename']), descriptor))
+    return ', '.join(srcset)
@@ -0,0 +1,206 @@
+# Importing click for defining command line commands
+import click
+# Importing Flask command line helpers
+from flask.cli import with_appcontext
+# Importing MongoDB index definition and errors
+from pymongo import IndexModel
+from pymongo.errors import PyMongoError, ConnectionFailure
+# Importing variables from other application packages
+from flyhighblog import mongo
+
+
+# Indexes required by the application
+# Each collection has a list of indexes defined as (name, keys, options)
+# GridFS indexes keep their default names, so as they match the indexes
+#   created by GridFS itself
+INDEXES = {
+    'posts': [
+        # Home feed - sorting by date (numbered and cursor pagination)
+        ('posts_date_posted', [('date_posted', -1), ('_id', -1)], {}),
+        # Author pages - filtering by author and sorting by date
+        ('posts_author_date_posted',
+         [('author', 1), ('date_posted', -1), ('_id', -1)], {}),
+        # Search - text index of title and content (words in title are
+        #   more relevant)
+        ('posts_text', [('title', 'text'), ('content', 'text')],
+         {'weights': {'title': 5, 'content': 1}}),
+    ],
+    'users': [
+        # Login, password reset and unique e-mail constraint
+        ('users_email_unique', [('email', 1)], {'unique': True}),
+        # Author pages and unique username constraint
+        ('users_username_unique', [('username', 1)], {'unique': True}),
+        # Author directory in navbar - sorting by first name
+        ('users_first_name', [('first_name', 1)], {}),
+    ],
+    'image_jobs': [
+        # Background image processing - claiming the oldest queued job
+        ('image_jobs_state_created', [('state', 1), ('created', 1)], {}),
+    ],
+    'mail_outbox': [
+        # Background e-mail sending - claiming the oldest queued e-mails
+        ('mail_outbox_state_created', [('state', 1), ('created', 1)], {}),
+    ],
+    'fs.files': [
+        # Serving and deleting files by filename
+        ('filename_1_uploadDate_1', [('filename', 1), ('uploadDate', 1)], {}),
+        # Deduplicated images - each image (hash) is stored only once
+        ('fs_files_sha256_unique', [('sha256', 1)],
+         {'unique': True,
+          'partialFilterExpression': {'sha256': {'$exists': True}}}),
+    ],
+    'fs.chunks': [
+        # Reading and deleting chunks of a file
+        ('files_id_1_n_1', [('files_id', 1), ('n', 1)], {'unique': True}),
+    ],
+}
+
+
+# Indexes created (or found already existing) by this process, as
+#   (collection, name)
+built_indexes = set()
+
+
+# Function for checking if index was created by this process; when it was
+#   not (creating indexes on start is switched off or it failed), the
+#   application does not rely on the index (e.g. unique indexes of users)
+def index_built(collection, name):
+    return (collection, name) in built_indexes
+
+
+# Function for creating all the indexes required by the application
+# Creating an index which already exists is a no-op, so the function
+#   can be run repeatedly (e.g. on every application start)
+# Each index is created separately, so as index which cannot be built
+#   (e.g. unique index over duplicated data) does not prevent the other
+#   indexes from being created; unavailable database stops the function
+#   (ConnectionFailure is raised)
+# Returns dictionaries with list of created index names per collection
+#   and with error per index which could not be created
+def ensure_indexes():
+    created = {}
+    failed = {}
+    for collection, indexes in INDEXES.items():
+        created[collection] = []
+        for name, keys, options in indexes:
+            try:
+                mongo.db[collection].create_indexes(
+                    [IndexModel(keys, name=name, **options)])
+            except ConnectionFailure:
+                raise
+            except PyMongoError as error:
+                built_indexes.discard((collection, name))
+                failed.setdefault(collection, {})[name] = str(error)
+            else:
+                built_indexes.add((collection, name))
+                created[collection].append(name)
+    return created, failed
+
+
+# Function for counting documents which prevent unique index from being
+#   built - number of key values shared by several documents
+def duplicate_keys(collection, keys, options):
+    pipeline = []
+    if 'partialFilterExpression' in options:
+        pipeline.append({'$match': options['partialFilterExpression']})
+    pipeline += [
+        {'$group': {'_id': {field.replace('.', '_'): '$' + field
+                            for field, _ in keys},
+                    'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$count': 'duplicates'}]
+    result = list(mongo.db[collection].aggregate(pipeline))
+    return result[0]['duplicates'] if result else 0
+
+
+# Function for comparing required indexes with indexes present in database
+# Returns dictionary per collection with:
+#   'missing' - required indexes not present in database (unique indexes
+#     with number of duplicated keys which prevent them from being built)
+#   'extra' - indexes present in database but not required by application
+#   'unused' - indexes not used since the server start (as per $indexStats)
+def index_report():
+    report = {}
+    for collection, indexes in INDEXES.items():
+        required = {name for name, _, _ in indexes}
+        existing = {index['name']
+                    for index in mongo.db[collection].list_indexes()}
+
+        # Index usage statistics are not available on all deployments
+        #   (e.g. without clusterMonitor privileges)
+        try:
+            stats = mongo.db[collection].aggregate([{'$indexStats': {}}])
+            unused = sorted(stat['name'] for stat in stats
+                            if stat['name'] != '_id_'
+                            and stat['accesses']['ops'] == 0)
+        except PyMongoError:
+            unused = None
+
+        missing = []
+        for name, keys, options in indexes:
+            if name in existing:
+                continue
+            if options.get('unique'):
+                name = '{} ({} duplicated keys)'.format(
+                    name, duplicate_keys(collection, keys, options))
+            missing.append(name)
+
+        report[collection] = {
+            'missing': missing,
+            'extra': sorted(existing - required - {'_id_'}),
+            'unused': unused,
+        }
+    return report
+
+
+# Function for creating indexes on application start
+# Database being unavailable must not prevent application from starting,
+#   therefore errors are only logged; indexes which could not be created
+#   are logged as errors (application then checks uniqueness of users
+#   itself, see users/forms.py)
+def ensure_indexes_on_startup(app):
+    with app.app_context():
+        try:
+            _, failed = ensure_indexes()
+        except PyMongoError as error:
+            app.logger.warning('Indexes could not be created: %s', error)
+            return
+    for collection, errors in failed.items():
+        for name, error in errors.items():
+            app.logger.error("Index %s of %s could not be created (see "
+                             "'flask indexes report'): %s", name,
+                             collection, error)
+
+
+# Command line commands for index management
+# Usage: 'flask indexes ensure' and 'flask indexes report'
+@click.group('indexes')
+def indexes_cli():
+    """Manage MongoDB indexes."""
+
+
+@indexes_cli.command('ensure')
+@with_appcontext
+def ensure_command():
+    """Create missing indexes."""
+    created, failed = ensure_indexes()
+    for collection, names in created.items():
+        click.echo('{}: {}'.format(collection, ', '.join(names) or '-'))
+        for name, error in failed.get(collection, {}).items():
+            click.echo('  {} failed: {}'.format(name, error))
+    if failed:
+        raise SystemExit(1)
+
+
+@indexes_cli.command('report')
+@with_appcontext
+def report_command():
+    """Report missing, extra and unused indexes."""
+    for collection, report in index_report().items():
+        click.echo(collection)
+        for key in ('missing', 'extra', 'unused'):
+            if report[key] is None:
+                value = 'n/a'
+            else:
+                value = ', '.join(report[key]) or '-'
+            click.echo('  {}: {}'.format(key, value))
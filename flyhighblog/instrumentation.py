@@ -0,0 +1,198 @@
+# Importing time functions for measuring requests
+import time
+# Importing logging for query and slow request logs
+import logging
+# Importing tool for picking the slowest commands
+import heapq
+# Importing thread-local storage of request statistics
+from threading import local
+# Importing required flask methods and functions
+from flask import request
+# Importing MongoDB command monitoring
+from pymongo import monitoring
+
+
+# Commands of MongoDB driver itself (connection handshake, sessions),
+#   which are not counted
+DRIVER_COMMANDS = {'isMaster', 'ismaster', 'hello', 'ping', 'endSessions',
+                   'saslStart', 'saslContinue', 'getnonce', 'authenticate'}
+
+# Command fields left out of logged commands - session data and inserted
+#   documents (e.g. chunks of uploaded files), which can be large
+OMITTED_FIELDS = {'lsid', '$db', '$clusterTime', '$readPreference',
+                  'txnNumber', 'documents'}
+
+# Command fields logged with their values; values of all the other fields
+#   (filters, updates, pipelines) are replaced by '?', so as user data
+#   (e.g. e-mail addresses or password hashes) are never logged
+PLAIN_FIELDS = {'sort', 'projection', 'limit', 'skip', 'batchSize', 'hint',
+                'ordered', 'multi', 'upsert'}
+
+# Maximum length of logged command
+COMMAND_LOG_LENGTH = 300
+
+# Loggers of per-request query statistics (debug level) and of slow
+#   requests (warning level)
+query_logger = logging.getLogger('flyhighblog.queries')
+slow_logger = logging.getLogger('flyhighblog.slow_requests')
+
+
+# Function for getting shape of a value from MongoDB command - field names
+#   and operators are kept, values are replaced by '?' (lists are shortened
+#   to their first item)
+def command_shape(value, plain=False):
+    if isinstance(value, dict):
+        return {key: command_shape(item, plain or key in PLAIN_FIELDS)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [command_shape(item, plain) for item in value[:1]]
+    return value if plain else '?'
+
+
+# Function for formatting MongoDB command for log - name of command,
+#   collection and shape of the command
+def format_command(name, command):
+    fields = {key: value for key, value in command.items() if key != name}
+    return '{} {} {}'.format(name, command.get(name),
+                             command_shape(fields))[:COMMAND_LOG_LENGTH]
+
+
+# MongoDB commands of one request
+class RequestQueries:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        # Total time of commands in database (seconds)
+        self.duration = 0.0
+        # Finished commands - (duration, name, command)
+        self.commands = []
+        # Commands sent to database and not finished yet by request id
+        self.pending = {}
+
+    # Time since the request started (seconds)
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    # The slowest commands of the request
+    def slowest(self, number):
+        return heapq.nlargest(number, self.commands, key=lambda c: c[0])
+
+
+# Listener of MongoDB commands recording commands sent by the thread
+#   of current request (commands of background threads are ignored)
+class QueryListener(monitoring.CommandListener):
+    def __init__(self, state):
+        self.state = state
+
+    def started(self, event):
+        queries = getattr(self.state, 'queries', None)
+        if queries is not None and event.command_name not in DRIVER_COMMANDS:
+            queries.pending[event.request_id] = {
+                key: value for key, value in event.command.items()
+                if key not in OMITTED_FIELDS}
+
+    def succeeded(self, event):
+        self.finish(event)
+
+    def failed(self, event):
+        self.finish(event)
+
+    def finish(self, event):
+        queries = getattr(self.state, 'queries', None)
+        if queries is None:
+            return
+        command = queries.pending.pop(event.request_id, None)
+        if command is None:
+            return
+        duration = event.duration_micros / 1e6
+        queries.count += 1
+        queries.duration += duration
+        queries.commands.append((duration, event.command_name, command))
+
+
+# Instrumentation of MongoDB queries
+# MongoDB commands of each request are recorded (number of commands, time
+#   spent in database and the slowest commands) and reported:
+#   - in 'Server-Timing' response header (SERVER_TIMING), which is
+#     displayed by browser developer tools
+#   - in debug log ('flyhighblog.queries' logger)
+#   - in slow request log - requests slower than SLOW_REQUEST_MS
+#     milliseconds are logged with their slowest commands
+#     ('flyhighblog.slow_requests' logger, SLOW_REQUEST_LOG file)
+# Commands are recorded by listener registered with MongoDB client,
+#   therefore instrumentation must be initialized before PyMongo
+# Commands run while response is streamed (e.g. reading chunks of stored
+#   files) are not included in 'Server-Timing' header
+class QueryInstrumentation:
+    def __init__(self):
+        self.app = None
+        self.state = local()
+        self.listener = QueryListener(self.state)
+        # Listeners to be registered with MongoDB client
+        self.event_listeners = []
+
+    # Setting instrumentation parameters from application config
+    def init_app(self, app):
+        self.app = app
+        if not app.config['QUERY_INSTRUMENTATION']:
+            self.event_listeners = []
+            return
+        self.event_listeners = [self.listener]
+        app.before_request(self.start_request)
+        app.after_request(self.add_server_timing)
+        app.teardown_request(self.finish_request)
+
+        if app.config['SLOW_REQUEST_LOG'] and not any(
+                getattr(handler, 'baseFilename', None) ==
+                app.config['SLOW_REQUEST_LOG']
+                for handler in slow_logger.handlers):
+            handler = logging.FileHandler(app.config['SLOW_REQUEST_LOG'])
+            handler.setFormatter(logging.Formatter(
+                '[%(asctime)s] %(message)s'))
+            slow_logger.addHandler(handler)
+
+    # Commands recorded for current request (None outside of request)
+    def current(self):
+        return getattr(self.state, 'queries', None)
+
+    def start_request(self):
+        self.state.queries = RequestQueries()
+
+    # Adding query statistics to response
+    def add_server_timing(self, response):
+        queries = self.current()
+        if queries is not None and self.app.config['SERVER_TIMING']:
+            response.headers.add(
+                'Server-Timing', 'db;dur={:.2f};desc="{} queries", '
+                'app;dur={:.2f}'.format(queries.duration * 1000,
+                                        queries.count,
+                                        queries.elapsed() * 1000))
+        return response
+
+    # Logging query statistics of finished request
+    def finish_request(self, error=None):
+        queries = self.current()
+        self.state.queries = None
+        if queries is None:
+            return
+        elapsed = queries.elapsed() * 1000
+        query_logger.debug('%s %s: %d queries, %.1f ms in database, '
+                           '%.1f ms total', request.method, path(),
+                           queries.count, queries.duration * 1000, elapsed)
+
+        threshold = self.app.config['SLOW_REQUEST_MS']
+        if threshold and elapsed >= threshold:
+            lines = ['Slow request {} {} ({:.1f} ms, {} queries, {:.1f} ms '
+                     'in database)'.format(request.method, path(),
+                                           elapsed, queries.count,
+                                           queries.duration * 1000)]
+            for duration, name, command in queries.slowest(
+                    self.app.config['SLOW_REQUEST_COMMANDS']):
+                lines.append('  {:.1f} ms {}'.format(
+                    duration * 1000, format_command(name, command)))
+            slow_logger.warning('\n'.join(lines))
+
+
+# Path of current request including query string
+def path():
+    return request.full_path.rstrip('?')
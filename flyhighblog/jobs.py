@@ -0,0 +1,273 @@
+# Importing time functions for polling and retry delays
+import time
+# Importing functions for manipulating dates
+from datetime import datetime, timedelta
+# Importing threads for processing jobs in background
+from threading import Thread, Event, Lock
+# Importing click for defining command line commands
+import click
+# Importing Flask command line helpers
+from flask.cli import with_appcontext
+# Importing error raised for missing uploaded originals
+from gridfs import NoFile
+# Importing Tools for working with MongoDB ObjectIds
+from bson.objectid import ObjectId
+# Importing MongoDB sort order and document return options
+from pymongo import ASCENDING, ReturnDocument
+# Importing metric of image processing
+from flyhighblog.metrics import IMAGE_PROCESSING
+
+
+# Queue of background jobs processing uploaded images
+# Request saves uploaded original to database and creates a job; the job
+#   is processed by background threads of the application worker
+#   (IMAGE_QUEUE_THREADS) or by a dedicated worker process
+#   ('flask images worker'), so as the request is not blocked by resizing
+# Jobs are stored in 'image_jobs' collection, so as they survive restart
+#   of the worker; job which is not finished in IMAGE_QUEUE_JOB_TIMEOUT
+#   seconds (e.g. worker crashed) is picked up again
+# Failed jobs are retried with increasing delay up to
+#   IMAGE_QUEUE_MAX_ATTEMPTS times; job which fails permanently is logged
+#   and passed to failure handler of its kind, so as the target document
+#   does not wait for the image forever
+# If IMAGE_QUEUE_ASYNC is switched off, jobs are processed immediately
+#   within the request
+class ImageQueue:
+    def __init__(self):
+        self.app = None
+        self.handlers = {}
+        self.failure_handlers = {}
+        self.threads = []
+        self.lock = Lock()
+        self.wakeup = Event()
+
+    # Setting queue parameters from application config
+    def init_app(self, app):
+        self.app = app
+        app.cli.add_command(images_cli)
+
+    # Decorator for registering function processing jobs of given kind
+    # Function is called with the job document and the uploaded original
+    #   (file-like object with 'filename' attribute)
+    def handler(self, kind):
+        def decorator(function):
+            self.handlers[kind] = function
+            return function
+        return decorator
+
+    # Decorator for registering function called when job of given kind
+    #   fails permanently
+    # Function is called with the job document and the error
+    def failure_handler(self, kind):
+        def decorator(function):
+            self.failure_handlers[kind] = function
+            return function
+        return decorator
+
+    # Collection of jobs
+    @property
+    def jobs(self):
+        from flyhighblog import mongo
+        return mongo.db.image_jobs
+
+    # Function for creating new job
+    # Uploaded original is saved to file storage; 'target' is _id of the
+    #   document (post, user) the processed image belongs to
+    # 'job_id' can be generated by the caller in advance, so as it can be
+    #   saved to the target document before the job is processed
+    # If the job cannot be created (e.g. saving of the original failed),
+    #   failure handler of its kind is called before the error is raised,
+    #   so as the target document does not wait for a job which does not
+    #   exist (original saved without job is deleted by 'flask storage gc')
+    # Returns _id of the job
+    def enqueue(self, kind, target, upload, job_id=None):
+        from flyhighblog import file_store
+        job_id = job_id or ObjectId()
+        original_fn = '{}-original-{}'.format(job_id, upload.filename)
+        now = datetime.utcnow()
+        job = {'_id': job_id,
+               'kind': kind,
+               'target': target,
+               'original': original_fn,
+               'state': 'queued',
+               'attempts': 0,
+               'created': now,
+               'run_after': now}
+        try:
+            job['original_id'] = file_store.save(original_fn, upload)
+            self.jobs.insert_one(job)
+        except Exception as error:
+            self.app.logger.warning('Image job %s (%s of %s) not created: '
+                                    '%s', job_id, kind, target, error)
+            self.handle_failure(job, error)
+            raise
+
+        if self.app.config['IMAGE_QUEUE_ASYNC']:
+            self.start()
+            self.wakeup.set()
+        else:
+            # Processing the job just created (not the oldest queued one)
+            self.process_next(job_id)
+        return job_id
+
+    # Function for claiming and processing one job - given job (if it is
+    #   queued) or the oldest job ready to be processed
+    # Returns False if there is no job ready to be processed
+    def process_next(self, job_id=None):
+        now = datetime.utcnow()
+        timeout = timedelta(
+            seconds=self.app.config['IMAGE_QUEUE_JOB_TIMEOUT'])
+
+        # Claiming the job (or the oldest queued job or job abandoned
+        #   by crashed worker); other workers cannot claim the same job
+        if job_id is not None:
+            query = {'_id': job_id, 'state': 'queued'}
+        else:
+            query = {'$or': [{'state': 'queued', 'run_after': {'$lte': now}},
+                             {'state': 'running',
+                              'started': {'$lt': now - timeout}}]}
+        job = self.jobs.find_one_and_update(
+            query,
+            {'$set': {'state': 'running', 'started': now},
+             '$inc': {'attempts': 1}},
+            sort=[('created', ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+        if job is None:
+            return False
+
+        from flyhighblog import file_store
+        started = time.perf_counter()
+        try:
+            if 'original_id' in job:
+                document = file_store.get(job['original_id'])
+            else:
+                document = file_store.find(job['original'])
+            if document is None:
+                raise NoFile('Original {} not found'.format(job['original']))
+            original = file_store.open(document)
+            self.handlers[job['kind']](job, original)
+        except Exception as error:
+            IMAGE_PROCESSING.labels(job['kind'], 'error').observe(
+                time.perf_counter() - started)
+            self.app.logger.exception('Image job %s failed', job['_id'])
+            self.retry_or_fail(job, error)
+        else:
+            IMAGE_PROCESSING.labels(job['kind'], 'success').observe(
+                time.perf_counter() - started)
+            self.delete_original(job)
+            self.jobs.delete_one({'_id': job['_id']})
+        return True
+
+    # Function for rescheduling failed job (with exponential delay) or
+    #   marking it as failed if it has no attempts left
+    # Jobs with missing original or with image over pixel budget fail
+    #   immediately, as they would fail again
+    # Failure handler of the job kind clears pending state of the target
+    #   document (e.g. post still waiting for its picture)
+    def retry_or_fail(self, job, error):
+        from flyhighblog.images import ImageTooLarge
+        from PIL import Image
+        if isinstance(error, (NoFile, ImageTooLarge,
+                              Image.DecompressionBombError)) or \
+                job['attempts'] >= self.app.config['IMAGE_QUEUE_MAX_ATTEMPTS']:
+            self.delete_original(job)
+            self.jobs.update_one({'_id': job['_id']},
+                                 {'$set': {'state': 'failed',
+                                           'error': str(error)}})
+            self.app.logger.warning('Image job %s (%s of %s) failed '
+                                    'permanently: %s', job['_id'],
+                                    job['kind'], job['target'], error)
+            self.handle_failure(job, error)
+        else:
+            delay = self.app.config['IMAGE_QUEUE_RETRY_DELAY'] * \
+                2 ** (job['attempts'] - 1)
+            self.jobs.update_one(
+                {'_id': job['_id']},
+                {'$set': {'state': 'queued',
+                          'error': str(error),
+                          'run_after': datetime.utcnow() +
+                          timedelta(seconds=delay)}})
+
+    # Function for calling failure handler of the job kind (if any)
+    def handle_failure(self, job, error):
+        if job['kind'] in self.failure_handlers:
+            try:
+                self.failure_handlers[job['kind']](job, error)
+            except Exception:
+                self.app.logger.exception(
+                    'Failure handler of image job %s failed', job['_id'])
+
+    # Function for deleting uploaded original of the job from database
+    def delete_original(self, job):
+        from flyhighblog.images import delete_images
+        delete_images([{'filename': job['original'],
+                        'file_id': job.get('original_id')}])
+
+    # Function for processing jobs until 'stop' event is set
+    # When there is no job, queue is checked again after
+    #   IMAGE_QUEUE_POLL_INTERVAL seconds (or when a job is enqueued)
+    def run(self, stop=None):
+        stop = stop or Event()
+        with self.app.app_context():
+            while not stop.is_set():
+                try:
+                    processed = self.process_next()
+                except Exception:
+                    self.app.logger.exception('Image queue error')
+                    processed = False
+                if not processed:
+                    self.wakeup.wait(
+                        self.app.config['IMAGE_QUEUE_POLL_INTERVAL'])
+                    self.wakeup.clear()
+
+    # Function for starting background threads of this worker
+    # Threads are started on first use (not in create_app), so as they
+    #   are started after application server forks its workers
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for _ in range(self.app.config['IMAGE_QUEUE_THREADS']):
+                thread = Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    # Queue statistics - number of jobs in each state
+    def stats(self):
+        counts = {'queued': 0, 'running': 0, 'failed': 0}
+        for state in self.jobs.aggregate([{'$group': {'_id': '$state',
+                                                      'count': {'$sum': 1}}}]):
+            counts[state['_id']] = state['count']
+        return counts
+
+
+# Command line commands for image queue
+# Usage: 'flask images status' and 'flask images worker'
+@click.group('images')
+def images_cli():
+    """Manage background image processing."""
+
+
+@images_cli.command('status')
+@with_appcontext
+def status_command():
+    """Show number of queued, running and failed jobs."""
+    from flyhighblog import image_queue
+    for state, count in image_queue.stats().items():
+        click.echo('{}: {}'.format(state, count))
+
+
+@images_cli.command('worker')
+@click.option('--threads', default=1, show_default=True)
+@with_appcontext
+def worker_command(threads):
+    """Process queued image jobs until interrupted."""
+    from flyhighblog import image_queue
+    image_queue.app.config['IMAGE_QUEUE_THREADS'] = threads
+    image_queue.start()
+    click.echo('Processing image jobs with {} thread(s)'.format(threads))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
@@ -1,74 +1,88 @@
 # Importing required flask methods and functions
-from flask import render_template, request, Blueprint
-# Importing Flask pagination function
-from flask_paginate import Pagination
-# Importing Tools for working with MongoDB ObjectIds
-from bson.objectid import ObjectId
+from flask import render_template, Blueprint, request
 # Importing variables from other application packages
-from flyhighblog import mongo
-from flyhighblog.main.utils import get_items
+from flyhighblog import page_cache
+from flyhighblog.images import image_srcset
+from flyhighblog.main.utils import (paginate_posts, search_posts,
+                                    add_author_data, get_authors,
+                                    send_stored_file)
 
 
 # Creating Blueprint object
 main = Blueprint('main', __name__)
 
 
-# Setting new variable to the context of templates - and can be used
-#   in the base.html.
+# Setting new variable to the context of all templates (of all blueprints)
+#   - can be used in the base.html.
 # users_all variable is used to generate list of authors for navbar
-@main.context_processor
+# Author directory is cached, so as rendering navbar does not need
+#   any database query
+@main.app_context_processor
 def context_processor():
-    # Users data is pulled from database and sorted by their first name
-    users = mongo.db.users.find().sort('first_name')
-    # Converting MongoDB object to list of dictionaries
-    users = [dict(user) for user in users]
-    return dict(users_all=users)
+    return dict(users_all=get_authors())
+
+
+# Making function for generating 'srcset' attribute of responsive images
+#   available in all templates
+@main.app_template_global()
+def srcset(variants, webp=False):
+    return image_srcset(variants, webp=webp)
 
 
 # Index route - listing all posts
+# Page is cached for anonymous users
 @main.route('/')
 @main.route('/index')
+@page_cache.cached
 def index():
-    # Posts data is pulled from database and sorted by date in descending
-    #   order
-    posts = mongo.db.posts.find().sort('date_posted', -1)
-
-    # Converting MongoDB object to list of dictionaries
-    posts = [dict(post) for post in posts]
+    # Posts of the requested page (numbered or cursor mode) are pulled
+    #   from database and sorted by date in descending order
+    posts_page = paginate_posts({}, per_page=5)
+    posts = posts_page['posts']
 
     # Amending list of dictionaries so as it contains required user
-    #   specific data
-    for post in posts:
-        user = mongo.db.users.find_one({'_id': ObjectId(post['author'])})
-        post['first_name'] = user['first_name'].title()
-        post['last_name'] = user['last_name'].title()
-        post['username'] = user['username']
-
-    # Pagination parameters
-    page = int(request.args.get('page', 1))
-    per_page = 5
-    offset = (page - 1) * per_page
-
-    total = len(posts)
-
-    pagination_posts = get_items(posts, offset=offset, per_page=per_page)
-
-    # Pagination options - refer to https://pythonhosted.org/Flask-paginate/
-    pagination = Pagination(page=page, per_page=per_page, total=total,
-                            css_framework='bootstrap4', inner_window=1,
-                            outer_window=0)
+    #   specific data (all authors are pulled in one query)
+    add_author_data(posts)
 
     # Rendering index.html template with list of all posts pulled from MongoDB
     # 'title' variable customizes web-page title
     return render_template('index.html',
-                           posts=pagination_posts,
-                           page=page,
-                           per_page=per_page,
-                           pagination=pagination,
+                           posts=posts,
+                           pagination=posts_page['pagination'],
+                           newer_cursor=posts_page['newer_cursor'],
+                           older_cursor=posts_page['older_cursor'],
                            title='Home')
 
 
-# Retrieve file from database based on filename
+# Search route - listing posts matching search terms, the most relevant
+#   first
+# Page is cached for anonymous users
+@main.route('/search')
+@page_cache.cached
+def search():
+    # Search terms are limited in length, as every term is looked up
+    #   in the text index
+    terms = request.args.get('q', '').strip()[:100]
+
+    results = None
+    posts = []
+    if terms:
+        results = search_posts(terms, per_page=5)
+        posts = results['posts']
+        # Amending list of dictionaries so as it contains required user
+        #   specific data (all authors are pulled in one query)
+        add_author_data(posts)
+
+    return render_template('search.html',
+                           posts=posts,
+                           terms=terms,
+                           total=results['total'] if results else 0,
+                           pagination=results['pagination'] if results
+                           else None,
+                           title='Search')
+
+
+# Retrieve file from file storage based on filename
 @main.route('/file/<filename>')
 def file(filename):
-    return mongo.send_file(filename)
+    return send_stored_file(filename)
@@ -1,3 +1,441 @@
-# Function for filtering records by pagination parameters
-def get_items(items, offset, per_page):
-    return items[offset: offset + per_page]
+# Importing functions for manipulating dates
+from datetime import datetime
+# Importing time functions for cache expiry
+import time
+# Importing lock for sharing cache between threads
+from threading import Lock
+# Importing required flask methods and functions
+from flask import request, abort, current_app
+# Importing helper for streaming files in WSGI responses
+from werkzeug.wsgi import wrap_file
+# Importing Flask pagination function
+from flask_paginate import Pagination
+# Importing Tools for working with MongoDB ObjectIds
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+# Importing MongoDB bulk write operation
+from pymongo import UpdateOne
+# Importing variables from other application packages
+from flyhighblog import mongo, image_cache, file_store
+from flyhighblog.metrics import FILE_BYTES, cache_lookup
+from flyhighblog.cache import CacheGeneration
+
+
+# Order of posts in all post lists - newest first, ties broken by _id
+#   so as the order is stable for both numbered and cursor pagination
+POSTS_SORT = [('date_posted', -1), ('_id', -1)]
+
+# Post fields displayed in lists of posts - full content of posts
+#   is not pulled from database
+POSTS_LIST_PROJECTION = {'title': 1, 'excerpt': 1, 'date_posted': 1,
+                         'picture': 1, 'picture_variants': 1, 'author': 1,
+                         'author_snapshot': 1}
+
+# Author fields copied to posts (author snapshot, see POST_AUTHOR_SNAPSHOT)
+AUTHOR_SNAPSHOT_FIELDS = ('first_name', 'last_name', 'username',
+                          'profile_img', 'profile_img_variants')
+
+# Date format used in pagination cursors
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+# Order of search results - the most relevant first (text index score,
+#   title words weigh more than content words), ties broken by date
+SEARCH_SORT = [('score', {'$meta': 'textScore'}), ('date_posted', -1),
+               ('_id', -1)]
+
+
+# Function for pulling one page of documents from a MongoDB collection
+# Skipping, limiting and counting are done by the database so as the cost
+#   of the page view depends on page size and not on collection size
+# Only fields listed in 'projection' are pulled (all if None)
+# If 'total' (number of matching documents) is known, it is not counted
+def get_page(collection, query, sort, page, per_page, projection=None,
+             total=None):
+    offset = max(page - 1, 0) * per_page
+
+    # Only documents of the requested page are transferred from database
+    items = collection.find(query, projection).sort(sort) \
+                      .skip(offset).limit(per_page)
+
+    # Converting MongoDB object to list of dictionaries
+    items = [dict(item) for item in items]
+
+    # Unfiltered collection is counted from collection metadata;
+    #   filtered collection is counted by the database (index-backed)
+    if total is None and query:
+        total = collection.count_documents(query)
+    elif total is None:
+        total = collection.estimated_document_count()
+
+    return items, total
+
+
+# Function for creating pagination cursor from post
+# Cursor consists of post date and post _id, e.g.
+#   '20200729154512123000-5f218f0c5b7e3c2a9c1d2e3f'
+def encode_cursor(post):
+    return '{}-{}'.format(post['date_posted'].strftime(CURSOR_DATE_FORMAT),
+                          post['_id'])
+
+
+# Function for reading pagination cursor
+# If cursor is invalid, None is returned
+def decode_cursor(cursor):
+    try:
+        date, post_id = cursor.split('-')
+        return datetime.strptime(date, CURSOR_DATE_FORMAT), ObjectId(post_id)
+    except (ValueError, InvalidId, TypeError, AttributeError):
+        return None
+
+
+# Function for pulling one page of posts older ('before') or newer ('after')
+#   than the post identified by the cursor
+# Instead of skipping documents, the database seeks directly to the cursor
+#   position, so as deep pages cost the same as the first page
+# Returns posts and cursors of newer and older pages (None if there is
+#   no such page)
+# Only fields listed in 'projection' are pulled (all if None)
+def get_keyset_page(collection, query, per_page, before=None, after=None,
+                    projection=None):
+    if after:
+        date, post_id = after
+        operator, direction = '$gt', 1
+    elif before:
+        date, post_id = before
+        operator, direction = '$lt', -1
+    else:
+        date, post_id = None, None
+        operator, direction = '$lt', -1
+
+    # Filtering posts following the cursor in the (date_posted, _id) order
+    keyset_query = dict(query)
+    if date is not None:
+        keyset_query['$or'] = [{'date_posted': {operator: date}},
+                               {'date_posted': date,
+                                '_id': {operator: post_id}}]
+
+    # One document more than needed is pulled to find out if there is
+    #   yet another page in the same direction
+    items = collection.find(keyset_query, projection) \
+                      .sort([('date_posted', direction), ('_id', direction)]) \
+                      .limit(per_page + 1)
+
+    # Converting MongoDB object to list of dictionaries
+    items = [dict(item) for item in items]
+    has_more = len(items) > per_page
+    items = items[:per_page]
+
+    # Posts pulled when moving to newer posts are in ascending order
+    if after:
+        items.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = before is not None, has_more
+
+    newer_cursor = None
+    older_cursor = None
+    if items and has_newer:
+        newer_cursor = encode_cursor(items[0])
+    if items and has_older:
+        older_cursor = encode_cursor(items[-1])
+
+    return items, newer_cursor, older_cursor
+
+
+# Function for amending posts with data of their authors
+# Posts carrying author snapshot are amended from the snapshot; authors
+#   of all the other posts are pulled from database in one query
+#   (authors already pulled by the caller can be passed in 'authors'
+#   and are not queried again)
+# Posts created before excerpts were introduced get their excerpt
+#   (see add_missing_excerpts)
+def add_author_data(posts, authors=()):
+    add_missing_excerpts(posts)
+    authors = {str(author['_id']): author for author in authors}
+
+    # Pulling only those authors who are not known yet
+    author_ids = {str(post['author']) for post in posts
+                  if 'author_snapshot' not in post} - set(authors)
+    if author_ids:
+        author_ids = [ObjectId(author_id) for author_id in author_ids]
+        users = mongo.db.users.find({'_id': {'$in': author_ids}},
+                                    dict.fromkeys(AUTHOR_SNAPSHOT_FIELDS, 1))
+        for user in users:
+            authors[str(user['_id'])] = user
+
+    # Amending list of dictionaries so as it contains required user
+    #   specific data
+    for post in posts:
+        user = post.get('author_snapshot') or authors[str(post['author'])]
+        post['first_name'] = user['first_name'].title()
+        post['last_name'] = user['last_name'].title()
+        post['username'] = user['username']
+        post['profile_image'] = user.get('profile_img')
+        post['profile_image_variants'] = user.get('profile_img_variants')
+
+    return posts
+
+
+# Function for creating excerpts of posts which do not have any (posts
+#   created before excerpts were introduced and not yet completed by data
+#   migration, see migrations.py)
+# Lists of posts do not pull content of posts (see POSTS_LIST_PROJECTION),
+#   therefore content of such posts is pulled in one query; excerpts are
+#   saved, so as each post is completed only once
+def add_missing_excerpts(posts):
+    missing = [post for post in posts if 'excerpt' not in post]
+    if not missing:
+        return
+    from flyhighblog.posts.utils import post_excerpt
+    contents = {post['_id']: post.get('content', '') for post in
+                mongo.db.posts.find({'_id': {'$in': [post['_id']
+                                                     for post in missing]}},
+                                    {'content': 1})}
+    for post in missing:
+        post['excerpt'] = post_excerpt(contents.get(post['_id'], ''))
+    mongo.db.posts.bulk_write(
+        [UpdateOne({'_id': post['_id'], 'excerpt': {'$exists': False}},
+                   {'$set': {'excerpt': post['excerpt']}})
+         for post in missing], ordered=False)
+
+
+# Function for getting author snapshot (data of author saved to posts)
+#   from user document
+def author_snapshot(user):
+    return {field: user.get(field) for field in AUTHOR_SNAPSHOT_FIELDS}
+
+
+# Function for getting author fields of new post of the user
+# Author is saved as string id, or as ObjectId with author snapshot if
+#   POST_AUTHOR_SNAPSHOT is switched on
+def post_author(user_id):
+    if not current_app.config['POST_AUTHOR_SNAPSHOT']:
+        return {'author': str(user_id)}
+    user = mongo.db.users.find_one({'_id': ObjectId(user_id)},
+                                   dict.fromkeys(AUTHOR_SNAPSHOT_FIELDS, 1))
+    return {'author': user['_id'], 'author_snapshot': author_snapshot(user)}
+
+
+# Query matching all posts of the user - author of posts is saved either
+#   as string id or as ObjectId (see post_author)
+def author_query(user_id):
+    return {'author': {'$in': [str(user_id), ObjectId(user_id)]}}
+
+
+# Function for updating author snapshots of all posts of the user after
+#   user data (name, username, profile image) have been changed
+# Snapshots are taken from the current user document, so as concurrent
+#   changes of the user leave posts with the latest data
+# Snapshots are maintained only if POST_AUTHOR_SNAPSHOT is switched on
+#   (otherwise posts are displayed with data pulled from their authors)
+def update_author_snapshots(user_id):
+    if not current_app.config['POST_AUTHOR_SNAPSHOT']:
+        return
+    user = mongo.db.users.find_one({'_id': ObjectId(user_id)},
+                                   dict.fromkeys(AUTHOR_SNAPSHOT_FIELDS, 1))
+    if user is not None:
+        mongo.db.posts.update_many(
+            dict(author_query(user_id), author_snapshot={'$exists': True}),
+            {'$set': {'author_snapshot': author_snapshot(user)}})
+
+
+# Function for pulling the page of posts requested in the URL
+# Numbered pages are requested by '?page=<number>', cursor pages by
+#   '?before=<cursor>' (older posts) or '?after=<cursor>' (newer posts)
+# Total count and numbered pagination links are available only in
+#   numbered mode (in cursor mode, 'total' and 'pagination' are None)
+# If 'total' is known (e.g. post count of an author), posts are not counted
+def paginate_posts(query, per_page, total=None):
+    before = request.args.get('before')
+    after = request.args.get('after')
+
+    # Cursor mode
+    if before or after:
+        before = decode_cursor(before) if before else None
+        after = decode_cursor(after) if after else None
+        # If cursor is invalid return 404
+        if before is None and after is None:
+            abort(404)
+        posts, newer_cursor, older_cursor = get_keyset_page(
+            mongo.db.posts, query, per_page, before=before, after=after,
+            projection=POSTS_LIST_PROJECTION)
+        return dict(posts=posts, total=None, page=None, pagination=None,
+                    newer_cursor=newer_cursor, older_cursor=older_cursor)
+
+    # Numbered mode
+    page = request.args.get('page', 1, type=int)
+    posts, total = get_page(mongo.db.posts, query, POSTS_SORT,
+                            page=page, per_page=per_page,
+                            projection=POSTS_LIST_PROJECTION, total=total)
+
+    # Link to older posts in cursor mode, so as readers and crawlers
+    #   moving past the numbered pages do not need deep skips
+    older_cursor = None
+    if posts and page * per_page < total:
+        older_cursor = encode_cursor(posts[-1])
+
+    # Pagination options - refer to https://pythonhosted.org/Flask-paginate/
+    pagination = Pagination(page=page, per_page=per_page, total=total,
+                            css_framework='bootstrap4', inner_window=1,
+                            outer_window=0)
+
+    return dict(posts=posts, total=total, page=page, pagination=pagination,
+                newer_cursor=None, older_cursor=older_cursor)
+
+
+# Function for pulling one page of posts matching search terms
+# Posts are matched by text index of post title and content (see
+#   indexes.py), so as the cost of search depends on number of matching
+#   posts and not on number of all posts
+# Number of results is limited to SEARCH_MAX_RESULTS, so as common words
+#   do not make the database count and page through large part of posts
+# Returns the same dictionary as paginate_posts (numbered mode only)
+def search_posts(terms, per_page):
+    page = request.args.get('page', 1, type=int)
+    max_results = current_app.config['SEARCH_MAX_RESULTS']
+    query = {'$text': {'$search': terms}}
+
+    posts = []
+    total = mongo.db.posts.count_documents(query, limit=max_results)
+    offset = max(page - 1, 0) * per_page
+    if offset < total:
+        projection = dict(POSTS_LIST_PROJECTION,
+                          score={'$meta': 'textScore'})
+        posts = [dict(post) for post in mongo.db.posts.find(query, projection)
+                 .sort(SEARCH_SORT).skip(offset)
+                 .limit(min(per_page, total - offset))]
+
+    # Pagination options - refer to https://pythonhosted.org/Flask-paginate/
+    pagination = Pagination(page=page, per_page=per_page, total=total,
+                            css_framework='bootstrap4', inner_window=1,
+                            outer_window=0)
+
+    return dict(posts=posts, total=total, page=page, pagination=pagination,
+                newer_cursor=None, older_cursor=None)
+
+
+# Cache of author directory used for generating list of authors in navbar
+# Cache is invalidated (in all the workers, see CacheGeneration) whenever
+#   user data are written and expires after AUTHORS_CACHE_TTL seconds
+# 'version' is increased on every invalidation, so as directory pulled
+#   from database while the cache was invalidated is not cached
+authors_cache = {'authors': None, 'expires': 0, 'version': 0}
+authors_cache_lock = Lock()
+authors_generation = CacheGeneration('authors')
+
+
+# Function for getting author directory - list of authors sorted by their
+#   first name; only fields displayed in navbar are pulled from database
+# Directory is pulled from database outside of the lock, so as threads
+#   rendering other pages do not wait for the query
+def get_authors():
+    current = authors_generation.is_current()
+    with authors_cache_lock:
+        if not current:
+            authors_cache['authors'] = None
+            authors_cache['version'] += 1
+        expired = (authors_cache['authors'] is None
+                   or time.monotonic() >= authors_cache['expires'])
+        cache_lookup('authors', not expired)
+        if not expired:
+            return authors_cache['authors']
+        version = authors_cache['version']
+
+    users = mongo.db.users.find(
+        {}, {'_id': 0, 'first_name': 1, 'last_name': 1,
+             'username': 1, 'post_count': 1}).sort('first_name')
+    authors = [dict(user) for user in users]
+    with authors_cache_lock:
+        if authors_cache['version'] == version:
+            authors_cache['authors'] = authors
+            authors_cache['expires'] = (time.monotonic() +
+                                        current_app.config[
+                                            'AUTHORS_CACHE_TTL'])
+    return authors
+
+
+# Function for invalidating author directory cache; called after user data
+#   (e.g. name or username) are written to database
+def invalidate_authors():
+    authors_generation.invalidate()
+    with authors_cache_lock:
+        authors_cache['authors'] = None
+        authors_cache['version'] += 1
+
+
+# Function for sending stored file
+# Filenames of uploaded pictures are random and files are never changed
+#   (new upload creates new file), therefore files are cached by browsers
+#   and proxies for FILE_CACHE_MAX_AGE seconds as immutable
+# Files stored on disk are sent by the front proxy, if it is configured
+#   (see FileSystemBackend in filestore.py)
+# Frequently requested files are served from image cache without reading
+#   them from storage; other files are streamed chunk by chunk (never
+#   read into memory as a whole)
+# Conditional (If-None-Match) and Range requests are supported
+def send_stored_file(filename):
+    image = image_cache.get(filename)
+    if image is not None:
+        response = current_app.response_class(
+            image['data'], mimetype=image['content_type'])
+        response.headers['X-Cache'] = 'HIT'
+        source = 'cache'
+    else:
+        document = file_store.find(filename)
+        if document is None:
+            abort(404)
+        image = {'content_type': document.get('contentType'),
+                 'etag': document.get('sha256') or document.get('md5')
+                 or str(document['_id']),
+                 'upload_date': document['uploadDate']}
+
+        response = current_app.response_class(
+            mimetype=image['content_type'])
+        if file_store.offload(document, response):
+            # Data (and Range requests) are served by the front proxy
+            return count_file_bytes(
+                file_response(response, image, accept_ranges=False),
+                'proxy')
+
+        fileobj = file_store.open(document)
+        if image_cache.is_cacheable(filename, fileobj.length):
+            # Small file is read as a whole and saved to image cache
+            image['data'] = fileobj.read()
+            fileobj.close()
+            image_cache.set(filename, image)
+            response.set_data(image['data'])
+        else:
+            # Data are read by chunks when the response is sent
+            response.response = wrap_file(request.environ, fileobj,
+                                          buffer_size=fileobj.chunk_size)
+            response.direct_passthrough = True
+            response.content_length = fileobj.length
+        response.headers['X-Cache'] = 'MISS'
+        source = document.get('storage', 'gridfs')
+
+    return count_file_bytes(file_response(response, image), source)
+
+
+# Function for recording number of bytes of stored file sent in response
+#   (whole file, requested range or nothing if not modified)
+def count_file_bytes(response, source):
+    if response.status_code in (200, 206) and response.content_length:
+        FILE_BYTES.labels(source).inc(response.content_length)
+    return response
+
+
+# Function for setting caching headers of stored file response
+def file_response(response, image, accept_ranges=True):
+    response.last_modified = image['upload_date']
+    response.set_etag(image['etag'])
+    response.headers['Cache-Control'] = 'public, max-age={}, immutable' \
+        .format(current_app.config['FILE_CACHE_MAX_AGE'])
+    if not accept_ranges:
+        response = response.make_conditional(request)
+        # Proxy must not send the file with 304 Not Modified
+        if response.status_code == 304:
+            response.headers.pop('X-Accel-Redirect', None)
+            response.headers.pop('X-Sendfile', None)
+        return response
+    return response.make_conditional(request, accept_ranges=True,
+                                     complete_length=response.content_length)
@@ -0,0 +1,113 @@
+# Importing os to have access to sytem-based functions and variables
+import os
+# Importing time functions for measuring requests
+import time
+# Importing tool for comparing secrets in constant time
+import hmac
+# Importing required flask methods and functions
+from flask import request, g, abort, current_app
+# Importing Prometheus client
+from prometheus_client import (Counter, Histogram, CollectorRegistry,
+                               REGISTRY, CONTENT_TYPE_LATEST, generate_latest)
+from prometheus_client import multiprocess
+
+
+# Application metrics exported in Prometheus text format ('/metrics')
+# Metrics are recorded in memory of each process; with several worker
+#   processes (e.g. gunicorn), environment variable
+#   'prometheus_multiproc_dir' must point to an empty directory shared
+#   by the workers before the application is started - metrics are then
+#   recorded to memory-mapped files in the directory and aggregated from
+#   all the workers when they are exported
+
+# Requests - duration and number of responses per endpoint and status
+REQUEST_DURATION = Histogram(
+    'flyhigh_request_duration_seconds', 'Duration of requests',
+    ['method', 'endpoint'])
+REQUESTS = Counter(
+    'flyhigh_requests_total', 'Number of responses',
+    ['method', 'endpoint', 'status'])
+
+# Stored files - bytes sent by the application (source 'cache', 'gridfs'
+#   or 'filesystem') or by the front proxy (source 'proxy')
+FILE_BYTES = Counter(
+    'flyhigh_file_bytes_served_total', 'Bytes of stored files served',
+    ['source'])
+
+# Background image processing - duration of jobs per kind and outcome
+IMAGE_PROCESSING = Histogram(
+    'flyhigh_image_processing_seconds', 'Duration of image processing jobs',
+    ['kind', 'outcome'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+# E-mails - number of sent, retried and failed e-mails
+MAIL_MESSAGES = Counter(
+    'flyhigh_mail_messages_total', 'Number of e-mails sent from outbox',
+    ['outcome'])
+
+# Caches - lookups of page, image and author caches ('hit' or 'miss')
+CACHE_LOOKUPS = Counter(
+    'flyhigh_cache_lookups_total', 'Number of cache lookups',
+    ['cache', 'result'])
+
+
+# Exporter of metrics
+# Requests of all the blueprints (including error pages) are measured
+#   by hooks registered with the application; other metrics are recorded
+#   where the events happen (file serving, image queue, mail outbox,
+#   caches)
+# '/metrics' requires 'Authorization: Bearer <METRICS_TOKEN>' header;
+#   without METRICS_TOKEN it is accessible only when application runs
+#   in debug mode (development), so as metrics are not public
+class Metrics:
+    def __init__(self):
+        self.app = None
+
+    # Setting metrics parameters from application config
+    def init_app(self, app):
+        self.app = app
+        if not app.config['METRICS']:
+            return
+        app.before_request(self.start_request)
+        app.after_request(self.record_request)
+        app.add_url_rule('/metrics', 'metrics', self.export)
+        if not app.config['METRICS_TOKEN'] and not app.debug:
+            app.logger.warning('METRICS_TOKEN is not set, /metrics is '
+                               'accessible only in debug mode')
+
+    def start_request(self):
+        g.metrics_started = time.perf_counter()
+
+    # Recording duration and status of request
+    def record_request(self, response):
+        started = g.get('metrics_started')
+        if started is not None:
+            endpoint = request.endpoint or 'none'
+            REQUEST_DURATION.labels(request.method, endpoint).observe(
+                time.perf_counter() - started)
+            REQUESTS.labels(request.method, endpoint,
+                            response.status_code).inc()
+        return response
+
+    # View exporting metrics in Prometheus text format
+    def export(self):
+        token = current_app.config['METRICS_TOKEN']
+        if not token:
+            if not current_app.debug:
+                abort(403)
+        elif not hmac.compare_digest(
+                request.headers.get('Authorization', ''),
+                'Bearer ' + token):
+            abort(403)
+        if 'prometheus_multiproc_dir' in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return current_app.response_class(generate_latest(registry),
+                                          mimetype=CONTENT_TYPE_LATEST)
+
+
+# Function for recording lookup in a cache
+def cache_lookup(cache, hit):
+    CACHE_LOOKUPS.labels(cache, 'hit' if hit else 'miss').inc()
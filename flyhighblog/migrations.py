@@ -0,0 +1,50 @@
+# Importing functions for manipulating dates
+from datetime import datetime, timedelta
+# Importing Tools for working with MongoDB ObjectIds
+from bson.objectid import ObjectId
+# Importing MongoDB errors
+from pymongo.errors import PyMongoError
+# Importing variables from other application packages
+from flyhighblog import mongo, page_cache
+
+
+# Function for completing data of documents created before fields
+#   maintained by the application were introduced
+# Each migration first checks whether any document needs it, so as
+#   migrations are cheap once the data are complete and can be run
+#   on every application start
+def migrate_data():
+    from flyhighblog.users.utils import (initialise_post_counts,
+                                         recount_post_counts,
+                                         POST_COUNT_CLAIM_MINUTES)
+    from flyhighblog.posts.utils import backfill_post_excerpts
+    from flyhighblog.main.utils import invalidate_authors
+
+    # Post counts of users (see new_post and delete_post), including
+    #   counts whose initialisation was not completed
+    if mongo.db.users.find_one({'post_count': {'$exists': False}},
+                               {'_id': 1}):
+        initialise_post_counts()
+        invalidate_authors()
+    stale_claim = ObjectId.from_datetime(
+        datetime.utcnow() - timedelta(minutes=POST_COUNT_CLAIM_MINUTES))
+    if mongo.db.users.find_one({'post_count_claim': {'$lt': stale_claim}},
+                               {'_id': 1}):
+        recount_post_counts({'post_count_claim': {'$lt': stale_claim}})
+        invalidate_authors()
+
+    # Excerpts of posts displayed in lists of posts (see new_post)
+    if mongo.db.posts.find_one({'excerpt': {'$exists': False}}, {'_id': 1}):
+        backfill_post_excerpts()
+        page_cache.invalidate()
+
+
+# Function for running data migrations on application start
+# Database being unavailable must not prevent application from starting,
+#   therefore errors are only logged
+def migrate_data_on_startup(app):
+    with app.app_context():
+        try:
+            migrate_data()
+        except PyMongoError as error:
+            app.logger.warning('Data migration failed: %s', error)
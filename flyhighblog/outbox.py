@@ -0,0 +1,329 @@
+# Importing time functions for polling
+import time
+# Importing SMTP errors
+import smtplib
+# Importing tools for implementing local SMTP server
+import socketserver
+# Importing functions for manipulating dates
+from datetime import datetime, timedelta
+# Importing threads for sending e-mails in background
+from threading import Thread, Event, Lock
+# Importing click for defining command line commands
+import click
+# Importing Flask command line helpers
+from flask.cli import with_appcontext
+# Importing flask_mail message
+from flask_mail import Message
+# Importing Tools for working with MongoDB ObjectIds
+from bson.objectid import ObjectId
+# Importing MongoDB sort order
+from pymongo import ASCENDING
+# Importing metric of sent e-mails
+from flyhighblog.metrics import MAIL_MESSAGES
+
+
+# Outbox of e-mails sent in background
+# Request saves e-mail to 'mail_outbox' collection and e-mails are sent
+#   by background threads of the application worker (MAIL_OUTBOX_THREADS)
+#   or by a dedicated worker process ('flask outbox worker'), so as the
+#   request does not wait for (or fail because of) the mail server
+# E-mails are sent in batches of up to MAIL_OUTBOX_BATCH_SIZE e-mails over
+#   one SMTP connection
+# E-mails which could not be sent are retried with increasing delay up to
+#   MAIL_OUTBOX_MAX_ATTEMPTS times; e-mails rejected by the mail server
+#   (e.g. invalid recipient) are not retried
+# E-mail which is not sent in MAIL_OUTBOX_SEND_TIMEOUT seconds (e.g.
+#   worker crashed) is picked up again
+# If MAIL_OUTBOX_ASYNC is switched off, e-mails are sent immediately
+#   within the request
+class MailOutbox:
+    def __init__(self):
+        self.app = None
+        self.threads = []
+        self.lock = Lock()
+        self.wakeup = Event()
+
+    # Setting outbox parameters from application config
+    def init_app(self, app):
+        self.app = app
+        app.cli.add_command(outbox_cli)
+
+    # Collection of e-mails
+    @property
+    def messages(self):
+        from flyhighblog import mongo
+        return mongo.db.mail_outbox
+
+    # Function for adding e-mail (flask_mail Message) to outbox
+    # Returns _id of the e-mail
+    def enqueue(self, message):
+        now = datetime.utcnow()
+        message_id = self.messages.insert_one({
+            'subject': message.subject,
+            'sender': message.sender,
+            'recipients': message.recipients,
+            'body': message.body,
+            'html': message.html,
+            'state': 'queued',
+            'attempts': 0,
+            'created': now,
+            'run_after': now}).inserted_id
+
+        if self.app.config['MAIL_OUTBOX_ASYNC']:
+            self.start()
+            self.wakeup.set()
+        else:
+            # Sending the e-mail just added (not the oldest queued ones)
+            self.send_batch(message_id)
+        return message_id
+
+    # Function for claiming and sending one batch of e-mails - given e-mail
+    #   (if it is queued) or the oldest e-mails ready to be sent
+    # Returns number of e-mails in the batch (0 if there is no e-mail ready
+    #   to be sent)
+    def send_batch(self, message_id=None):
+        now = datetime.utcnow()
+        timeout = timedelta(
+            seconds=self.app.config['MAIL_OUTBOX_SEND_TIMEOUT'])
+
+        # Claiming the e-mail (or the oldest e-mails); e-mails claimed
+        #   by other workers meanwhile are not matched by the update
+        if message_id is not None:
+            ready = {'state': 'queued'}
+            message_ids = [message_id]
+        else:
+            ready = {'$or': [
+                {'state': 'queued', 'run_after': {'$lte': now}},
+                {'state': 'sending', 'started': {'$lt': now - timeout}}]}
+            message_ids = [message['_id'] for message in self.messages.find(
+                ready, {'_id': 1}, sort=[('created', ASCENDING)],
+                limit=self.app.config['MAIL_OUTBOX_BATCH_SIZE'])]
+            if not message_ids:
+                return 0
+        claim = ObjectId()
+        self.messages.update_many(
+            dict(ready, _id={'$in': message_ids}),
+            {'$set': {'state': 'sending', 'started': now, 'claim': claim},
+             '$inc': {'attempts': 1}})
+        pending = list(self.messages.find({'_id': {'$in': message_ids},
+                                           'claim': claim}))
+        batch_size = len(pending)
+        if not pending:
+            return 0
+
+        from flyhighblog import mail
+        try:
+            with mail.connect() as connection:
+                while pending:
+                    message = pending[0]
+                    # Only errors of the e-mail itself are handled here;
+                    #   connection errors (e.g. server disconnected) are
+                    #   handled below, as the connection cannot be used
+                    #   for the other e-mails of the batch
+                    try:
+                        connection.send(Message(
+                            subject=message['subject'],
+                            sender=message['sender'],
+                            recipients=message['recipients'],
+                            body=message['body'],
+                            html=message['html']))
+                    except (smtplib.SMTPRecipientsRefused,
+                            smtplib.SMTPSenderRefused,
+                            smtplib.SMTPDataError) as error:
+                        self.app.logger.warning('E-mail %s not sent: %s',
+                                                message['_id'], error)
+                        self.retry_or_fail(message, error,
+                                           rejected=is_rejected(error))
+                    else:
+                        MAIL_MESSAGES.labels('sent').inc()
+                        self.messages.delete_one({'_id': message['_id']})
+                    pending.pop(0)
+        except (smtplib.SMTPException, OSError) as error:
+            # Connection to mail server failed - e-mail being sent and
+            #   remaining e-mails of the batch are retried
+            self.app.logger.warning('Mail server error: %s', error)
+            for message in pending:
+                self.retry_or_fail(message, error)
+        return batch_size
+
+    # Function for rescheduling e-mail which was not sent (with exponential
+    #   delay) or marking it as failed if it was rejected or it has
+    #   no attempts left
+    def retry_or_fail(self, message, error, rejected=False):
+        if rejected or message['attempts'] >= \
+                self.app.config['MAIL_OUTBOX_MAX_ATTEMPTS']:
+            MAIL_MESSAGES.labels('failed').inc()
+            self.messages.update_one({'_id': message['_id']},
+                                     {'$set': {'state': 'failed',
+                                               'error': str(error)}})
+        else:
+            MAIL_MESSAGES.labels('retried').inc()
+            delay = self.app.config['MAIL_OUTBOX_RETRY_DELAY'] * \
+                2 ** (message['attempts'] - 1)
+            self.messages.update_one(
+                {'_id': message['_id']},
+                {'$set': {'state': 'queued',
+                          'error': str(error),
+                          'run_after': datetime.utcnow() +
+                          timedelta(seconds=delay)}})
+
+    # Function for sending e-mails until 'stop' event is set
+    # When there is no e-mail, outbox is checked again after
+    #   MAIL_OUTBOX_POLL_INTERVAL seconds (or when an e-mail is added)
+    def run(self, stop=None):
+        stop = stop or Event()
+        with self.app.app_context():
+            while not stop.is_set():
+                try:
+                    sent = self.send_batch()
+                except Exception:
+                    self.app.logger.exception('Mail outbox error')
+                    sent = 0
+                if not sent:
+                    self.wakeup.wait(
+                        self.app.config['MAIL_OUTBOX_POLL_INTERVAL'])
+                    self.wakeup.clear()
+
+    # Function for starting background threads of this worker
+    # Threads are started on first use (not in create_app), so as they
+    #   are started after application server forks its workers
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for _ in range(self.app.config['MAIL_OUTBOX_THREADS']):
+                thread = Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    # Outbox statistics - number of e-mails in each state
+    def stats(self):
+        counts = {'queued': 0, 'sending': 0, 'failed': 0}
+        for state in self.messages.aggregate(
+                [{'$group': {'_id': '$state', 'count': {'$sum': 1}}}]):
+            counts[state['_id']] = state['count']
+        return counts
+
+
+# Function for checking if e-mail was rejected by mail server (permanent
+#   error, e.g. invalid recipient), so as it is not retried
+def is_rejected(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return (isinstance(error, smtplib.SMTPResponseException)
+            and error.smtp_code >= 500)
+
+
+# Local SMTP server accepting all e-mails without delivering them - e-mails
+#   are printed and kept in 'messages' list of the server
+# Used instead of real mail server in development and testing
+#   (MAIL_SERVER=localhost, MAIL_PORT=1025, MAIL_USE_SSL=0)
+class SMTPSink(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, echo=True):
+        super().__init__(address, SMTPSinkHandler)
+        self.messages = []
+        self.echo = echo
+
+
+# Handler of one SMTP connection to SMTPSink
+# Supports commands needed by flask_mail (including authentication,
+#   which always succeeds)
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 FlyHigh SMTP sink')
+        sender, recipients, data = None, [], None
+        for line in self.rfile:
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            if data is not None:
+                if line == '.':
+                    message = {'sender': sender, 'recipients': recipients,
+                               'data': '\n'.join(data)}
+                    self.server.messages.append(message)
+                    if self.server.echo:
+                        click.echo('From: {} To: {}\n{}\n'.format(
+                            sender, ', '.join(recipients), message['data']))
+                    sender, recipients, data = None, [], None
+                    self.reply('250 OK')
+                else:
+                    data.append(line[1:] if line.startswith('.') else line)
+                continue
+
+            command = line[:4].upper()
+            if command == 'EHLO':
+                self.reply('250-FlyHigh')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif command == 'HELO':
+                self.reply('250 FlyHigh')
+            elif command == 'AUTH':
+                self.reply('235 Authentication successful')
+            elif command == 'MAIL':
+                sender = line.partition(':')[2].strip()
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                recipients.append(line.partition(':')[2].strip())
+                self.reply('250 OK')
+            elif command == 'DATA':
+                data = []
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+            elif command == 'RSET':
+                sender, recipients, data = None, [], None
+                self.reply('250 OK')
+            elif command == 'NOOP':
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+# Command line commands for mail outbox
+# Usage: 'flask outbox status', 'flask outbox worker'
+#   and 'flask outbox smtp-sink'
+@click.group('outbox')
+def outbox_cli():
+    """Manage outgoing e-mails."""
+
+
+@outbox_cli.command('status')
+@with_appcontext
+def status_command():
+    """Show number of queued, sending and failed e-mails."""
+    from flyhighblog import mail_outbox
+    for state, count in mail_outbox.stats().items():
+        click.echo('{}: {}'.format(state, count))
+
+
+@outbox_cli.command('worker')
+@click.option('--threads', default=1, show_default=True)
+@with_appcontext
+def worker_command(threads):
+    """Send queued e-mails until interrupted."""
+    from flyhighblog import mail_outbox
+    mail_outbox.app.config['MAIL_OUTBOX_THREADS'] = threads
+    mail_outbox.start()
+    click.echo('Sending e-mails with {} thread(s)'.format(threads))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+
+@outbox_cli.command('smtp-sink')
+@click.option('--host', default='localhost', show_default=True)
+@click.option('--port', default=1025, show_default=True)
+def smtp_sink_command(host, port):
+    """Run local SMTP server printing e-mails instead of sending them."""
+    server = SMTPSink((host, port))
+    click.echo('SMTP sink listening on {}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
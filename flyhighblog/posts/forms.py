@@ -6,6 +6,8 @@ from flask_wtf.file import FileField, FileAllowed
 from wtforms import (StringField, SubmitField, TextAreaField)
 # Importing field validators
 from wtforms.validators import (DataRequired)
+# Importing validator of uploaded pictures
+from flyhighblog.images import ImageWithinBudget
 
 
 # Defining form for creating new post
@@ -16,7 +18,8 @@ class PostForm(FlaskForm):
     # For new post, uploading picture is required
     picture = FileField('Upload post picture',
                         validators=[DataRequired(),
-                                    FileAllowed(['jpg', 'png', 'jpeg'])])
+                                    FileAllowed(['jpg', 'png', 'jpeg']),
+                                    ImageWithinBudget()])
     submit = SubmitField('Post')
 
 
@@ -28,5 +31,6 @@ class UpdatePostForm(FlaskForm):
     # When updating post, if picture is not changed, originally uploaded
     #   picture is kept
     picture = FileField('Change post picture',
-                        validators=[FileAllowed(['jpg', 'png', 'jpeg'])])
+                        validators=[FileAllowed(['jpg', 'png', 'jpeg']),
+                                    ImageWithinBudget()])
     submit = SubmitField('Update')
@@ -1,34 +1,29 @@
 # Importing functions for manipulating dates
 from datetime import datetime
+# Importing click for defining command line commands
+import click
 # Importing required flask methods and functions
 from flask import (render_template, redirect, url_for, flash,
-                   session, request, abort, Blueprint)
+                   session, request, abort, Blueprint, current_app)
 # Importing Tools for working with MongoDB ObjectIds
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
+# Importing MongoDB bulk write operation
+from pymongo import UpdateOne
 # Importing variables from other application packages
-from flyhighblog import mongo
+from flyhighblog import mongo, page_cache, image_queue
 from flyhighblog.posts.forms import PostForm, UpdatePostForm
-from flyhighblog.posts.utils import (post_picture,
-                                     post_picture_check_and_delete)
+from flyhighblog.posts.utils import (post_picture_check_and_delete,
+                                     post_excerpt, backfill_post_excerpts)
+from flyhighblog.main.utils import (add_author_data, invalidate_authors,
+                                    post_author, author_snapshot,
+                                    AUTHOR_SNAPSHOT_FIELDS)
 
 
 # Creating Blueprint object
 posts = Blueprint('posts', __name__)
 
 
-# Setting new variable to the context of templates - can be used
-#   in the base.html
-# users_all variable is used to generate list of authors for navbar
-@posts.context_processor
-def context_processor():
-    # Users data is pulled from database and sorted by their first name
-    users = mongo.db.users.find().sort('first_name')
-    # Converting MongoDB object to list of dictionaries
-    users = [dict(user) for user in users]
-    return dict(users_all=users)
-
-
 # Route for rendering New Post form; accessible only for
 #   registered and logged users
 @posts.route('/post/new', methods=['GET', 'POST'])
@@ -43,18 +38,41 @@ def new_post():
         # Check if form inputs are valid
         if form.validate_on_submit():
 
-            # Resize and save picture to database
-            picture_fn = post_picture(form.picture.data)
+            # Picture is resized in background; until it is ready,
+            #   default picture is displayed
+            job_id = ObjectId()
 
-            # Save information from the form to database
+            # Save information from the form to database (together with
+            #   author snapshot, see POST_AUTHOR_SNAPSHOT)
             post_doc = {
                     'title': form.title.data,
                     'date_posted': datetime.utcnow(),
                     'content': form.content.data,
-                    'author': session['user_id'],
-                    'picture': picture_fn,
+                    'excerpt': post_excerpt(form.content.data),
+                    'picture': None,
+                    'picture_job': job_id,
                     }
-            mongo.db.posts.insert_one(post_doc)
+            post_doc.update(post_author(session['user_id']))
+            post_id = mongo.db.posts.insert_one(post_doc).inserted_id
+
+            # Increasing post count of the author (count of author created
+            #   before post counts were introduced is set by counting posts,
+            #   see initialise_post_counts)
+            mongo.db.users.update_one({'_id': ObjectId(session['user_id']),
+                                       'post_count': {'$exists': True}},
+                                      {'$inc': {'post_count': 1}})
+
+            # New post needs to be displayed on cached pages (and post
+            #   count in author directory)
+            invalidate_authors()
+            page_cache.invalidate()
+
+            # Resize and save picture to database (in background); done
+            #   last, so as the post is complete even if the job cannot
+            #   be created (post then records picture error, see
+            #   post_picture_failed)
+            image_queue.enqueue('post_picture', post_id, form.picture.data,
+                                job_id=job_id)
 
             # Flash message informing about successful creation of post
             flash('Your post has been created!', 'success')
@@ -76,7 +94,9 @@ def new_post():
 
 
 # Route for displaying post; accessible also for non-registered users
+# Page is cached for anonymous users
 @posts.route('/post/<post_id>')
+@page_cache.cached
 def post(post_id):
     # Check validity of ObjectId and return 404 if invalid
     try:
@@ -91,16 +111,10 @@ def post(post_id):
 
     # Converting MongoDB object to dictionary
     post = dict(post)
-    user = mongo.db.users.find_one({'_id': ObjectId(post['author'])})
 
     # Amending post dictionary so as it contains required user
-    #   specific data
-    post['first_name'] = user['first_name'].title()
-    post['last_name'] = user['last_name'].title()
-    if 'profile_img' in user:
-        post['profile_image'] = user['profile_img']
-    else:
-        post['profile_image'] = None
+    #   specific data (from author snapshot if the post carries it)
+    add_author_data([post])
 
     # Rendering post.html
     return render_template('post.html', title=post['title'], post=post)
@@ -129,7 +143,7 @@ def update_post(post_id):
             abort(404)
 
         # If logged user is not author of post, return 403
-        if post['author'] != session['user_id']:
+        if str(post['author']) != session['user_id']:
             abort(403)
 
         # Defining form variable - UpdatePostForm
@@ -141,18 +155,15 @@ def update_post(post_id):
             # Checking if there are picture data in the form
             if form.picture.data:
 
-                # Checking if user already inserted post picture in the past.
-                # If yes, delete the old file from the database
-                post_picture_check_and_delete(post)
-
-                # Resize and save picture to database
-                picture_fn = post_picture(form.picture.data)
-
-                # Save file name reference to post document
+                # New picture is resized in background; old picture is
+                #   displayed (and then deleted) until new one is ready
+                #   (error of previous upload is cleared)
+                job_id = ObjectId()
                 posts.update({'_id': ObjectId(post_id)},
                              {'$set': {
-                                        'picture': picture_fn,
-                                      }
+                                        'picture_job': job_id,
+                                      },
+                              '$unset': {'picture_error': ''}
                               })
 
             # Update only those post details that have been changed
@@ -161,9 +172,20 @@ def update_post(post_id):
                          {'$set': {
                                     'title': form.title.data,
                                     'content': form.content.data,
+                                    'excerpt': post_excerpt(form.content.data),
                                   }
                           })
 
+            # Updated post needs to be displayed on cached pages
+            page_cache.invalidate()
+
+            # Resize and save picture to database (in background); done
+            #   last, so as the post is updated even if the job cannot
+            #   be created
+            if form.picture.data:
+                image_queue.enqueue('post_picture', ObjectId(post_id),
+                                    form.picture.data, job_id=job_id)
+
             # Generate flash message on successful post update
             flash('Post has been updated!', 'success')
 
@@ -209,15 +231,25 @@ def delete_post(post_id):
             abort(404)
 
         # If logged user is not author of post, return 403
-        if post['author'] != session['user_id']:
+        if str(post['author']) != session['user_id']:
             abort(403)
 
         # Checking if user already inserted post picture in the past.
         # If yes, delete the old file from the database
         post_picture_check_and_delete(post)
 
-        # Delete post from database
-        mongo.db.posts.delete_one({'_id': ObjectId(post_id)})
+        # Delete post from database and decrease post count of the author
+        #   (only if the post was not deleted meanwhile by another request)
+        if mongo.db.posts.delete_one(
+                {'_id': ObjectId(post_id)}).deleted_count:
+            mongo.db.users.update_one({'_id': ObjectId(post['author']),
+                                       'post_count': {'$exists': True}},
+                                      {'$inc': {'post_count': -1}})
+
+        # Deleted post must not be displayed on cached pages (and post
+        #   count in author directory)
+        invalidate_authors()
+        page_cache.invalidate()
 
         # Flash message informing user that the post was deleted
         flash('Post has been deleted.', 'success')
@@ -233,3 +265,75 @@ def delete_post(post_id):
         flash('Please login to access this page.', 'info')
         # Redirect to login page
         return redirect(url_for('users.login', next=request.endpoint))
+
+
+# Command for creating excerpts of existing posts
+# Usage: 'flask posts backfill-excerpts [--all]'
+# Missing excerpts are also created on application start (see
+#   migrations.py); '--all' recreates excerpts of all posts
+@posts.cli.command('backfill-excerpts')
+@click.option('--all', 'all_posts', is_flag=True,
+              help='Recreate excerpts of all posts, not only missing ones.')
+@click.option('--batch-size', default=500, show_default=True)
+def backfill_excerpts(all_posts, batch_size):
+    """Create excerpts of existing posts."""
+    updated = backfill_post_excerpts({} if all_posts else None,
+                                     batch_size=batch_size)
+    page_cache.invalidate()
+    click.echo('Done, {} posts updated'.format(updated))
+
+
+# Command line command for converting existing posts to author snapshot
+#   schema (see POST_AUTHOR_SNAPSHOT) - author is saved as ObjectId and
+#   author data are copied to the post
+# Posts are streamed in batches; authors of each batch are pulled in one
+#   query and posts are updated by one bulk write
+# Posts of authors who no longer exist are left unchanged
+# Usage: 'flask posts backfill-authors'
+@posts.cli.command('backfill-authors')
+@click.option('--all', 'all_posts', is_flag=True,
+              help='Refresh author snapshots of all posts, not only '
+                   'missing ones.')
+@click.option('--batch-size', default=500, show_default=True)
+def backfill_authors(all_posts, batch_size):
+    """Save author data to existing posts."""
+    # Snapshots are kept up to date only with POST_AUTHOR_SNAPSHOT
+    #   switched on (see update_author_snapshots)
+    if not current_app.config['POST_AUTHOR_SNAPSHOT']:
+        click.echo('Warning: POST_AUTHOR_SNAPSHOT is switched off, author '
+                   'data of posts will not be updated when authors change '
+                   'their accounts')
+    query = {} if all_posts else {'author_snapshot': {'$exists': False}}
+    cursor = mongo.db.posts.find(query, {'author': 1},
+                                 batch_size=batch_size)
+    updated = 0
+
+    def update(batch):
+        author_ids = list({ObjectId(post['author']) for post in batch})
+        authors = {user['_id']: user for user in mongo.db.users.find(
+            {'_id': {'$in': author_ids}},
+            dict.fromkeys(AUTHOR_SNAPSHOT_FIELDS, 1))}
+        # Post is updated only if its author was not changed meanwhile
+        requests = []
+        for post in batch:
+            user = authors.get(ObjectId(post['author']))
+            if user is not None:
+                requests.append(UpdateOne(
+                    {'_id': post['_id'], 'author': post['author']},
+                    {'$set': {'author': user['_id'],
+                              'author_snapshot': author_snapshot(user)}}))
+        if not requests:
+            return 0
+        return mongo.db.posts.bulk_write(requests,
+                                         ordered=False).modified_count
+
+    batch = []
+    for post in cursor:
+        batch.append(post)
+        if len(batch) == batch_size:
+            updated += update(batch)
+            batch = []
+            click.echo('{} posts updated'.format(updated))
+    if batch:
+        updated += update(batch)
+    click.echo('Done, {} posts updated'.format(updated))
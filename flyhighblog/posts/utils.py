@@ -1,65 +1,122 @@
 # Importing os to have access to sytem-based functions and variables
 import os
-# Importing required flask methods and functions
-from flask import current_app
-# Importing tool for Image processing
-from PIL import Image
+# Importing tool for binding function arguments
+from functools import partial
 # Importing tool for generating secure random numbers
 import secrets
+# Importing MongoDB bulk write operations
+from pymongo import UpdateOne
 # Importing variables from other application packages
-from flyhighblog import mongo
-# Importing Tools for working with MongoDB ObjectIds
-from bson.objectid import ObjectId
+from flyhighblog import mongo, page_cache, image_queue
+from flyhighblog.images import (POST_PICTURE_WIDTHS, resize_to_width,
+                                ingest_image, delete_images,
+                                image_files, main_variant)
+
+
+# Maximum length of post excerpt displayed in lists of posts
+EXCERPT_LENGTH = 400
+
+
+# Function for creating post excerpt - beginning of post content
+#   displayed in lists of posts
+# Content is clipped at the last whitespace before EXCERPT_LENGTH,
+#   so as the words are not cut
+def post_excerpt(content):
+    if len(content) <= EXCERPT_LENGTH:
+        return content
+    excerpt = content[:EXCERPT_LENGTH]
+    if ' ' in excerpt:
+        excerpt = excerpt[:excerpt.rindex(' ')]
+    return excerpt.rstrip() + '...'
+
+
+# Function for creating excerpts of posts matching 'query' (posts without
+#   excerpt by default), e.g. posts created before excerpts were
+#   introduced
+# Posts are streamed from database and updated in batches
+# Returns number of updated posts
+def backfill_post_excerpts(query=None, batch_size=500):
+    if query is None:
+        query = {'excerpt': {'$exists': False}}
+    cursor = mongo.db.posts.find(query, {'content': 1},
+                                 batch_size=batch_size)
+    updated = 0
+    batch = []
+    for post in cursor:
+        batch.append(UpdateOne({'_id': post['_id']},
+                               {'$set': {'excerpt':
+                                         post_excerpt(post['content'])}}))
+        if len(batch) == batch_size:
+            updated += mongo.db.posts.bulk_write(batch,
+                                                 ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += mongo.db.posts.bulk_write(batch,
+                                             ordered=False).modified_count
+    return updated
 
 
 # Function for resizing and upload
 #   of post pictures to database
+# Picture is saved in several widths (POST_PICTURE_WIDTHS), each of them
+#   in original format and as WebP
+# Returns filename of main picture (the widest variant in original format)
+#   and list of all variants
 def post_picture(form_picture_data):
     # Create random filename while keeping original file extension
     random_hex = secrets.token_hex(8)
-    post_image = form_picture_data
-    _, f_ext = os.path.splitext(post_image.filename)
-    picture_fn = random_hex + f_ext
+    _, f_ext = os.path.splitext(form_picture_data.filename)
+
+    # Resizing image to all widths - aspect ratio kept - and saving
+    #   resized images to database
+    sizes = [('-{}'.format(width), partial(resize_to_width, width=width), {})
+             for width in POST_PICTURE_WIDTHS]
+    variants = ingest_image(form_picture_data, random_hex, sizes,
+                            (max(POST_PICTURE_WIDTHS), None))
 
-    # Set temporary path for post pictures
-    picture_path = os.path.join(current_app.root_path,
-                                'static/img/post-image',
-                                picture_fn)
+    # Main picture - the widest variant in original format
+    picture_fn = main_variant(variants, f_ext,
+                              width=max(POST_PICTURE_WIDTHS))
 
-    # Resizing image - width 1000, aspect ratio kept
-    basewidth = 1000
-    i = Image.open(post_image)
-    wpercent = (basewidth/float(i.size[0]))
-    hsize = int((float(i.size[1])*float(wpercent)))
-    i = i.resize((basewidth, hsize), Image.ANTIALIAS)
+    # Return picture filename and list of variants
+    return picture_fn, variants
 
-    # Saving resized image to temporary folder
-    i.save(picture_path)
 
-    # Open saved resized picture for read mode (r)
-    #   with binary I/O (b)
-    with open(picture_path, 'rb') as f:
-        # Save resized picture to database
-        mongo.save_file(picture_fn, f)
+# Function for processing uploaded post picture in background
+# Processed picture replaces the original post picture only if the job is
+#   still the latest picture upload of the post; otherwise (post deleted
+#   or another picture uploaded meanwhile) processed picture is deleted
+@image_queue.handler('post_picture')
+def process_post_picture(job, original):
+    picture_fn, picture_variants = post_picture(original)
+    post = mongo.db.posts.find_one_and_update(
+        {'_id': job['target'], 'picture_job': job['_id']},
+        {'$set': {'picture': picture_fn,
+                  'picture_variants': picture_variants},
+         '$unset': {'picture_job': '', 'picture_error': ''}})
+    if post is None:
+        delete_images(image_files(picture_fn, picture_variants))
+    else:
+        # Deleting previous picture of the post
+        post_picture_check_and_delete(post)
+        # New picture needs to be displayed on cached pages
+        page_cache.invalidate()
 
-    # Delete resized picture from temporaty folder
-    os.remove(picture_path)
 
-    # Return picture filename
-    return picture_fn
+# Function for recording that uploaded post picture could not be processed
+# Post keeps its previous (or default) picture and its author is told
+#   on the post page that the picture needs to be uploaded again
+@image_queue.failure_handler('post_picture')
+def post_picture_failed(job, error):
+    mongo.db.posts.update_one(
+        {'_id': job['target'], 'picture_job': job['_id']},
+        {'$set': {'picture_error': str(error)},
+         '$unset': {'picture_job': ''}})
 
 
 # Function for checking if user already inserted post picture in the past.
-# If yes, delete the file from the database
+# If yes, delete the file (and all its variants) from the database
 def post_picture_check_and_delete(post):
-    if 'picture' in post:
-        image = mongo.db.fs.files.find_one(
-                                           {'filename':
-                                            post['picture']}
-                                           )
-        image_id = image['_id']
-        # Deleting file from fs.files
-        mongo.db.fs.files.delete_one({'_id': ObjectId(image_id)})
-        # Deleting file from fs.chunks
-        mongo.db.fs.chunks.delete_many({'files_id':
-                                        ObjectId(image_id)})
+    if post.get('picture'):
+        delete_images(image_files(post['picture'],
+                                  post.get('picture_variants')))
@@ -0,0 +1,210 @@
+# Importing os to have access to sytem-based functions and variables
+import os
+# Importing sys for reading stacks of running threads
+import sys
+# Importing JSON encoder for request details saved with profiles
+import json
+# Importing time functions for measuring requests
+import time
+# Importing deterministic profiler
+import cProfile
+# Importing counter of sampled stacks
+from collections import Counter
+# Importing functions for manipulating dates
+from datetime import datetime
+# Importing threads for sampling stacks
+from threading import Thread, Event, get_ident
+# Importing click for defining command line commands
+import click
+# Importing required flask methods and functions
+from flask import request, g, current_app
+# Importing Flask command line helpers
+from flask.cli import with_appcontext
+# Importing signed tokens authorizing profiling
+from itsdangerous import URLSafeTimedSerializer, BadData
+# Importing formatting of MongoDB commands
+from flyhighblog.instrumentation import format_command
+
+
+# Header of requests carrying profiling token (see 'flask profiler token')
+TOKEN_HEADER = 'X-Profile-Token'
+
+
+# Sampling profiler of one thread
+# Stack of the thread is sampled every 'interval' seconds by a background
+#   thread; stacks are counted in folded format ('outer;inner count'),
+#   which is read by flamegraph tools (flamegraph.pl, speedscope)
+class StackSampler:
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(
+                    code.co_name,
+                    os.path.join(os.path.basename(
+                        os.path.dirname(code.co_filename)),
+                        os.path.basename(code.co_filename)),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def save(self, path):
+        path += '.folded'
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.items():
+                f.write('{} {}\n'.format(stack, count))
+        return path
+
+
+# Deterministic profiler (cProfile) of current thread; statistics are saved
+#   in pstats format (flamegraphs can be made by e.g. flameprof)
+class FunctionProfiler:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def save(self, path):
+        path += '.prof'
+        self.profile.dump_stats(path)
+        return path
+
+
+# Profiling of requests in production
+# Requests are profiled only if PROFILER is switched on (otherwise no
+#   hook is registered, so as requests do not pay anything) and only if
+#   they come from an address listed in PROFILER_ALLOW or carry a valid
+#   token in 'X-Profile-Token' header (see 'flask profiler token')
+# Profile of each profiled request is saved to PROFILER_DIR together with
+#   request details (route, arguments, duration) and log of MongoDB
+#   commands of the request (see instrumentation.py); name of the profile
+#   is returned in 'X-Profile' response header
+class RequestProfiler:
+    def __init__(self):
+        self.app = None
+
+    # Setting profiler parameters from application config
+    def init_app(self, app):
+        self.app = app
+        app.cli.add_command(profiler_cli)
+        if not app.config['PROFILER']:
+            return
+        os.makedirs(app.config['PROFILER_DIR'], exist_ok=True)
+        app.before_request(self.start_request)
+        app.after_request(self.add_profile_header)
+        app.teardown_request(self.finish_request)
+
+    # Serializer of profiling tokens
+    def serializer(self):
+        return URLSafeTimedSerializer(self.app.config['SECRET_KEY'],
+                                      salt='profiler')
+
+    # Function for generating token authorizing profiling of requests
+    #   of given path ('' = all paths)
+    def token(self, path=''):
+        return self.serializer().dumps({'path': path})
+
+    # Checking if current request may be profiled
+    def is_authorized(self):
+        if request.remote_addr in self.app.config['PROFILER_ALLOW']:
+            return True
+        token = request.headers.get(TOKEN_HEADER)
+        if not token:
+            return False
+        try:
+            path = self.serializer().loads(
+                token,
+                max_age=self.app.config['PROFILER_TOKEN_MAX_AGE'])['path']
+        except (BadData, KeyError, TypeError):
+            return False
+        return not path or path == request.path
+
+    def start_request(self):
+        if not self.is_authorized():
+            return
+        if self.app.config['PROFILER_MODE'] == 'deterministic':
+            profiler = FunctionProfiler()
+        else:
+            profiler = StackSampler(
+                get_ident(), self.app.config['PROFILER_INTERVAL'] / 1000)
+        g.profile = {'profiler': profiler,
+                     'name': '{}-{}-{}'.format(
+                         datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f'),
+                         request.endpoint or 'none', os.getpid()),
+                     'started': time.perf_counter()}
+        profiler.start()
+
+    def add_profile_header(self, response):
+        profile = g.get('profile')
+        if profile is not None:
+            response.headers['X-Profile'] = profile['name']
+        return response
+
+    # Saving profile and request details of profiled request
+    def finish_request(self, error=None):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        profile['profiler'].stop()
+        duration = time.perf_counter() - profile['started']
+        path = os.path.join(self.app.config['PROFILER_DIR'], profile['name'])
+        profile_file = profile['profiler'].save(path)
+
+        from flyhighblog import query_instrumentation
+        queries = query_instrumentation.current()
+        details = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'rule': request.url_rule.rule if request.url_rule else None,
+            'view_args': request.view_args,
+            'args': request.args.to_dict(flat=False),
+            'error': repr(error) if error is not None else None,
+            'duration_ms': round(duration * 1000, 2),
+            'profile': os.path.basename(profile_file),
+            'queries': None if queries is None else [
+                {'duration_ms': round(command_duration * 1000, 2),
+                 'command': format_command(name, command)}
+                for command_duration, name, command in queries.commands],
+        }
+        with open(path + '.json', 'w') as f:
+            json.dump(details, f, indent=2, default=str)
+        current_app.logger.info('Request %s %s profiled: %s', request.method,
+                                request.path, profile_file)
+
+
+# Command line commands for request profiling
+# Usage: 'flask profiler token [PATH]'
+@click.group('profiler')
+def profiler_cli():
+    """Profile requests."""
+
+
+@profiler_cli.command('token')
+@click.argument('path', default='')
+@with_appcontext
+def token_command(path):
+    """Generate token authorizing profiling of requests of PATH."""
+    from flyhighblog import request_profiler
+    click.echo('{}: {}'.format(TOKEN_HEADER, request_profiler.token(path)))
@@ -0,0 +1,214 @@
+# Importing functions for manipulating dates
+from datetime import datetime, timedelta
+# Importing click for defining command line commands
+import click
+# Importing Flask command line helpers
+from flask.cli import with_appcontext
+# Importing Tools for working with MongoDB ObjectIds
+from bson.objectid import ObjectId
+# Importing variables from other application packages
+from flyhighblog import mongo, file_store
+from flyhighblog.images import delete_images
+
+
+# Documents referencing files stored in GridFS - collection, field with
+#   filename of main file and field with list of variants (see
+#   store_image in images.py)
+REFERENCES = {
+    'posts': ('picture', 'picture_variants'),
+    'users': ('profile_img', 'profile_img_variants'),
+}
+
+
+# Function for collecting files referenced by posts, users and image
+#   jobs (uploaded originals)
+# Documents are streamed in batches; only their file references are kept
+# Returns set of file ids and set of filenames (files saved before file
+#   ids were recorded are referenced by filename only)
+def referenced_files(batch_size=1000):
+    file_ids = set()
+    filenames = set()
+    for collection, (field, variants_field) in REFERENCES.items():
+        documents = mongo.db[collection].find(
+            {}, {field: 1, variants_field: 1}, batch_size=batch_size)
+        for document in documents:
+            if document.get(field):
+                filenames.add(document[field])
+            for variant in document.get(variants_field) or []:
+                if variant.get('file_id'):
+                    file_ids.add(variant['file_id'])
+                else:
+                    filenames.add(variant['filename'])
+
+    jobs = mongo.db.image_jobs.find({}, {'original': 1, 'original_id': 1},
+                                    batch_size=batch_size)
+    for job in jobs:
+        filenames.add(job['original'])
+        if job.get('original_id'):
+            file_ids.add(job['original_id'])
+    return file_ids, filenames
+
+
+# Function for deleting files which are not referenced by any document
+#   (e.g. document write failed after the file was saved) and chunks
+#   which do not belong to any file (e.g. deleting of file interrupted)
+# Only files uploaded (or re-used, see save_shared_file in images.py) more
+#   than 'min_age' seconds ago are deleted, so as files of uploads
+#   in progress (saved before the document referencing them) are kept
+# fs.files is streamed and orphans are deleted in bulk by 'batch_size'
+#   files; 'progress' is called with statistics after each batch
+# If 'dry_run' is True, orphans are only counted
+# Returns statistics - number of scanned files, number and size of
+#   deleted files and number of deleted orphaned chunks
+def collect_garbage(min_age=3600, batch_size=1000, dry_run=False,
+                    progress=None):
+    stats = {'scanned': 0, 'deleted': 0, 'bytes': 0, 'chunks': 0}
+    cutoff = datetime.utcnow() - timedelta(seconds=min_age)
+    file_ids, filenames = referenced_files(batch_size)
+
+    def delete(orphans):
+        if not dry_run:
+            delete_images(orphans)
+        if progress is not None:
+            progress(stats)
+
+    orphans = []
+    files = mongo.db.fs.files.find(
+        {'uploadDate': {'$lt': cutoff},
+         '$or': [{'referenced': {'$exists': False}},
+                 {'referenced': {'$lt': cutoff}}]},
+        {'filename': 1, 'length': 1}, batch_size=batch_size)
+    for file in files:
+        stats['scanned'] += 1
+        if file['_id'] in file_ids or file['filename'] in filenames:
+            continue
+        orphans.append({'filename': file['filename'],
+                        'file_id': file['_id']})
+        stats['deleted'] += 1
+        stats['bytes'] += file.get('length', 0)
+        if len(orphans) >= batch_size:
+            delete(orphans)
+            orphans = []
+    delete(orphans)
+
+    # Chunks are written before their file document, therefore only
+    #   chunks of files older than 'min_age' are checked
+    chunk_files = mongo.db.fs.chunks.aggregate(
+        [{'$match': {'files_id': {'$lt': ObjectId.from_datetime(cutoff)}}},
+         {'$group': {'_id': '$files_id'}}],
+        allowDiskUse=True, batchSize=batch_size)
+    batch = []
+    for chunk_file in chunk_files:
+        batch.append(chunk_file['_id'])
+        if len(batch) >= batch_size:
+            stats['chunks'] += delete_orphaned_chunks(batch, dry_run)
+            batch = []
+    stats['chunks'] += delete_orphaned_chunks(batch, dry_run)
+    return stats
+
+
+# Function for deleting chunks of files (given by list of ids) which are
+#   not present in fs.files
+# Returns number of orphaned chunks
+def delete_orphaned_chunks(file_ids, dry_run=False):
+    existing = {file['_id'] for file in mongo.db.fs.files.find(
+        {'_id': {'$in': file_ids}}, {'_id': 1})}
+    missing = [file_id for file_id in file_ids if file_id not in existing]
+    if not missing:
+        return 0
+    query = {'files_id': {'$in': missing}}
+    if dry_run:
+        return mongo.db.fs.chunks.count_documents(query)
+    return mongo.db.fs.chunks.delete_many(query).deleted_count
+
+
+# Function for moving files saved in other backends to 'target' backend
+#   (see filestore.py)
+# Files are streamed one by one from the source backend to the target
+#   backend and then their documents are switched to the target backend,
+#   so as files can be served during the migration; fs.files is read
+#   in batches of 'batch_size' documents and 'progress' is called with
+#   statistics after each batch
+# Returns statistics - number of scanned files, number and size of moved
+#   files
+def migrate_files(target, batch_size=100, progress=None):
+    stats = {'scanned': 0, 'moved': 0, 'bytes': 0}
+    backend = file_store.backends[target]
+    if target == 'gridfs':
+        query = {'storage': {'$exists': True}}
+    else:
+        query = {'storage': {'$ne': target}}
+
+    for document in mongo.db.fs.files.find(query, batch_size=batch_size):
+        stats['scanned'] += 1
+        source = file_store.backend_of(document)
+        if target == 'gridfs':
+            # Chunks left by interrupted migration of the file
+            backend.discard([document])
+        fileobj = source.open(document)
+        try:
+            fields = backend.write(document, fileobj)
+        finally:
+            fileobj.close()
+
+        # Document is switched only if the file was not deleted or moved
+        #   meanwhile; otherwise new copy is deleted
+        unset = {field: '' for field in source.fields
+                 if field not in fields}
+        result = mongo.db.fs.files.update_one(
+            {'_id': document['_id'],
+             'storage': document.get('storage', {'$exists': False})},
+            {'$set': fields, '$unset': unset} if unset else {'$set': fields})
+        if result.matched_count:
+            source.discard([document])
+            stats['moved'] += 1
+            stats['bytes'] += document['length']
+        else:
+            backend.discard([dict(document, **fields)])
+
+        if progress is not None and stats['scanned'] % batch_size == 0:
+            progress(stats)
+    return stats
+
+
+# Command line commands for maintenance of stored files
+# Usage: 'flask storage gc' and 'flask storage migrate <backend>'
+@click.group('storage')
+def storage_cli():
+    """Maintain files stored in database."""
+
+
+@storage_cli.command('gc')
+@click.option('--min-age', default=3600, show_default=True,
+              help='Keep files uploaded less than this many seconds ago.')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--dry-run', is_flag=True,
+              help='Only report orphaned files.')
+@with_appcontext
+def gc_command(min_age, batch_size, dry_run):
+    """Delete files not referenced by posts, users or image jobs."""
+    def progress(stats):
+        click.echo('Scanned {scanned} files, orphaned {deleted} '
+                   '({bytes} bytes)'.format(**stats))
+
+    stats = collect_garbage(min_age, batch_size, dry_run, progress)
+    click.echo('{} {} orphaned files ({} bytes) and {} orphaned chunks'
+               .format('Found' if dry_run else 'Deleted', stats['deleted'],
+                       stats['bytes'], stats['chunks']))
+
+
+@storage_cli.command('migrate')
+@click.argument('target', type=click.Choice(['gridfs', 'filesystem']))
+@click.option('--batch-size', default=100, show_default=True)
+@with_appcontext
+def migrate_command(target, batch_size):
+    """Move stored files to TARGET backend."""
+    if target not in file_store.backends:
+        raise click.ClickException('STORAGE_DIR is not set')
+
+    def progress(stats):
+        click.echo('Moved {moved} files ({bytes} bytes)'.format(**stats))
+
+    stats = migrate_files(target, batch_size, progress)
+    click.echo('Moved {moved} files ({bytes} bytes) to {target}'.format(
+        target=target, **stats))
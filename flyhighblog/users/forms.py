@@ -8,13 +8,42 @@ from wtforms import (StringField, PasswordField,
 # Importing field validators
 from wtforms.validators import (DataRequired, Length, Email,
                                 EqualTo, ValidationError)
-# Importing mongo for validating duplicated username/email during
-#   registration and user account info update
+# Importing mongo for validating duplicated username/email (if unique
+#   indexes are not available) and existence of email address during
+#   password reset request
 from flyhighblog import mongo
+# Importing check of unique indexes of users
+from flyhighblog.indexes import index_built
 # Importing Tools for working with MongoDB ObjectIds
 from bson.objectid import ObjectId
 # Importing required flask methods and functions
 from flask import session
+# Importing validator of uploaded pictures
+from flyhighblog.images import ImageWithinBudget
+
+
+# Validation messages for duplicated username/email
+# Uniqueness of username and email is guaranteed by unique indexes in
+#   database; duplicates are reported by database when user data
+#   are written (see add_duplicate_key_error in users/utils.py)
+USERNAME_EXISTS = 'Username already exists. Please choose different one.'
+EMAIL_EXISTS = ('Account with this e-mail address is already registered. '
+                'Please log in or create an account with different '
+                'e-mail address.')
+
+
+# Function for checking if username/email is used by another user than
+#   user with 'user_id'
+# Uniqueness is checked by the form only if unique index of the field
+#   could not be created on application start (e.g. existing users share
+#   e-mail address, see 'flask indexes report')
+def is_taken(field, value, index, user_id=None):
+    if index_built('users', index):
+        return False
+    query = {field: value}
+    if user_id is not None:
+        query['_id'] = {'$ne': ObjectId(user_id)}
+    return mongo.db.users.count_documents(query, limit=1) > 0
 
 
 # Defining form for registration of users including form validation parameters
@@ -36,18 +65,13 @@ class RegistrationForm(FlaskForm):
 
     # Validation of username - if exists, return validation error
     def validate_username(self, username):
-        if mongo.db.users.count_documents({'username': username.data},
-                                          limit=1):
-            raise ValidationError(
-                'Username already exists. Please choose different one.')
+        if is_taken('username', username.data, 'users_username_unique'):
+            raise ValidationError(USERNAME_EXISTS)
 
     # Validation of email - if exists, return validation error
     def validate_email(self, email):
-        if mongo.db.users.count_documents({'email': email.data}, limit=1):
-            raise ValidationError(
-                'Account with this e-mail address is already registered. '
-                'Please log in or create an account with different'
-                'e-mail address.')
+        if is_taken('email', email.data.lower(), 'users_email_unique'):
+            raise ValidationError(EMAIL_EXISTS)
 
 
 # Defining form for user login including form validation parameters
@@ -71,27 +95,23 @@ class UpdateAccountForm(FlaskForm):
     email = StringField('E-mail',
                         validators=[DataRequired(), Email()])
     picture = FileField('Update Profile Picture',
-                        validators=[FileAllowed(['jpg', 'png', 'jpeg'])])
+                        validators=[FileAllowed(['jpg', 'png', 'jpeg']),
+                                    ImageWithinBudget()])
     submit = SubmitField('Update')
 
-    # Validation of username - if exists, return validation error
+    # Validation of username - if used by another user, return
+    #   validation error
     def validate_username(self, username):
-        user = mongo.db.users.find_one({'_id':  ObjectId(session['user_id'])})
-        if username.data != user['username']:
-            if mongo.db.users.count_documents({'username': username.data},
-                                              limit=1):
-                raise ValidationError(
-                    'Username already exists. Please choose different one.')
+        if is_taken('username', username.data, 'users_username_unique',
+                    session['user_id']):
+            raise ValidationError(USERNAME_EXISTS)
 
-    # Validation of email - if exists, return validation error
+    # Validation of email - if used by another user, return validation
+    #   error
     def validate_email(self, email):
-        user = mongo.db.users.find_one({'_id':  ObjectId(session['user_id'])})
-        if email.data != user['email']:
-            if mongo.db.users.count_documents({'email': email.data}, limit=1):
-                raise ValidationError(
-                    'Account with this e-mail address is already registered. '
-                    'Please log in or create an account with different'
-                    'e-mail address.')
+        if is_taken('email', email.data.lower(), 'users_email_unique',
+                    session['user_id']):
+            raise ValidationError(EMAIL_EXISTS)
 
 
 # Defining form for requesting password reset
@@ -1,41 +1,34 @@
+# Importing click for defining command line commands
+import click
 # Importing required flask methods and functions
 from flask import (render_template, redirect, url_for, flash, session, request,
                    Blueprint)
-# Importing Flask pagination function
-from flask_paginate import Pagination
 # Importing Werkzeug Security Functions
 from werkzeug.security import generate_password_hash, check_password_hash
 # Importing Tools for working with MongoDB ObjectIds
 from bson.objectid import ObjectId
+# Importing error raised when unique index is violated
+from pymongo.errors import DuplicateKeyError
 # Importing variables from other application packages
-from flyhighblog import mongo
+from flyhighblog import mongo, page_cache, image_queue
 from flyhighblog.users.forms import (RegistrationForm, LoginForm,
                                      UpdateAccountForm,
                                      RequestPasswordResetForm,
                                      PasswordResetForm)
 from flyhighblog.users.utils import (verify_reset_token,
                                      send_email,
-                                     profile_image,
-                                     profile_image_check_and_delete)
-from flyhighblog.main.utils import get_items
+                                     add_duplicate_key_error,
+                                     recount_post_counts,
+                                     initialise_post_counts)
+from flyhighblog.main.utils import (paginate_posts, add_author_data,
+                                    invalidate_authors, author_query,
+                                    update_author_snapshots)
 
 
 # Creating Blueprint object
 users = Blueprint('users', __name__)
 
 
-# Setting new variable to the context of templates - can be used
-#   in the base.html.
-# users_all variable is used to generate list of authors for navbar
-@users.context_processor
-def context_processor():
-    # Users data is pulled from database and sorted by their first name
-    users = mongo.db.users.find().sort('first_name')
-    # Converting MongoDB object to list of dictionaries
-    users = [dict(user) for user in users]
-    return dict(users_all=users)
-
-
 # Register route - form for registration of new users
 @users.route('/register', methods=['GET', 'POST'])
 def register():
@@ -63,16 +56,27 @@ def register():
                     'username': form.username.data,
                     'email': form.email.data.lower(),
                     'password': hashpass,
+                    'post_count': 0,
                     }
         # Sending data to database
-        mongo.db.users.insert_one(user_doc)
+        # Duplicated username/email is rejected by unique indexes and
+        #   reported to user as validation error
+        try:
+            mongo.db.users.insert_one(user_doc)
+        except DuplicateKeyError as error:
+            add_duplicate_key_error(form, error)
+        else:
+            # New author needs to be listed in navbar (including navbar
+            #   of cached pages)
+            invalidate_authors()
+            page_cache.invalidate()
 
-        # Defining flash message for successful registration
-        flash('Account has been created! You can now log in.',
-              'success')
+            # Defining flash message for successful registration
+            flash('Account has been created! You can now log in.',
+                  'success')
 
-        # Redirecting to login.html
-        return redirect(url_for('users.login'))
+            # Redirecting to login.html
+            return redirect(url_for('users.login'))
 
     # Render register.html with respective registration form
     # 'title' variable customizes web-page title
@@ -159,33 +163,57 @@ def account():
         # Check if form inputs are valid
         if form.validate_on_submit():
 
+            # Update only those user details that have been changed
+            # All other details shall remain same
+            # Duplicated username/email is rejected by unique indexes and
+            #   reported to user as validation error
+            try:
+                users.update({'_id': ObjectId(session['user_id'])},
+                             {'$set': {
+                                'first_name': form.firstname.data.lower(),
+                                'last_name': form.lastname.data.lower(),
+                                'username': form.username.data,
+                                'email': form.email.data.lower(),
+                             }
+                             })
+            except DuplicateKeyError as error:
+                add_duplicate_key_error(form, error)
+                return render_template('account.html', title='Account',
+                                       user=user, form=form)
+
             # Checking if there are picture data in the form
             if form.picture.data:
 
-                # Checking if user already set profile image in the past.
-                # If yes, delete the old file from the database
-                profile_image_check_and_delete(user)
-
-                # Resize and save picture to database
-                picture_fn = profile_image(form.picture.data)
-
-                # Save file name reference to user document
+                # New profile image is resized in background; old profile
+                #   image is displayed (and then deleted) until new one
+                #   is ready (error of previous upload is cleared)
+                job_id = ObjectId()
                 users.update({'_id': ObjectId(session['user_id'])},
                              {'$set': {
-                                        'profile_img': picture_fn,
-                             }
+                                        'profile_img_job': job_id,
+                             },
+                              '$unset': {'profile_img_error': ''}
                              })
 
-            # Update only those user details that have been changed
-            # All other details shall remain same
-            users.update({'_id': ObjectId(session['user_id'])},
-                         {'$set': {
-                                    'first_name': form.firstname.data.lower(),
-                                    'last_name': form.lastname.data.lower(),
-                                    'username': form.username.data,
-                                    'email': form.email.data.lower(),
-                                   }
-                          })
+            # Changed user details need to be reflected in author
+            #   snapshots of user's posts (one bulk update, only if name
+            #   or username changed; new profile image updates snapshots
+            #   when it is processed), in navbar and on cached pages
+            if (user['first_name'], user['last_name'], user['username']) != \
+                    (form.firstname.data.lower(), form.lastname.data.lower(),
+                     form.username.data):
+                update_author_snapshots(session['user_id'])
+            invalidate_authors()
+            page_cache.invalidate()
+
+            # Resize and save picture to database (in background); done
+            #   last, so as account is updated even if the job cannot be
+            #   created (user then records profile image error, see
+            #   profile_image_failed)
+            if form.picture.data:
+                image_queue.enqueue('profile_image',
+                                    ObjectId(session['user_id']),
+                                    form.picture.data, job_id=job_id)
 
             # Generate flash message on user info update
             flash('Your account has been updated!', 'success')
@@ -215,50 +243,51 @@ def account():
 
 
 # Route for displaying posts written by particular users
+# Page is cached for anonymous users
 @users.route('/user/<string:username>')
+@page_cache.cached
 def user_posts(username):
     # Filtering posts saved in database by username
-    user = mongo.db.users.find_one({'username': username})
+    user = mongo.db.users.find_one_or_404({'username': username})
     user_id = str(user['_id'])
     first_name = user['first_name'].title()
     last_name = user['last_name'].title()
-    posts = mongo.db.posts.find({'author': user_id}).sort('date_posted', -1)
 
-    # Converting MongoDB object to list of dictionaries
-    posts = [dict(post) for post in posts]
+    # Total count of user's posts is maintained in user document (see
+    #   new_post and delete_post); count of user created before post
+    #   counts were introduced is initialised once, so as it is maintained
+    #   from then on (see initialise_post_counts)
+    posts_count = user.get('post_count')
+    if posts_count is None or 'post_count_claim' in user:
+        initialise_post_counts({'_id': user['_id']})
+        user = mongo.db.users.find_one({'_id': user['_id']})
+        posts_count = user.get('post_count')
+        # Count being initialised by another worker is not complete yet
+        if posts_count is None or 'post_count_claim' in user:
+            posts_count = mongo.db.posts.count_documents(
+                author_query(user_id))
+
+    # Posts of the requested page (numbered or cursor mode) are pulled
+    #   from database and sorted by date in descending order
+    posts_page = paginate_posts(author_query(user_id), per_page=5,
+                                total=posts_count)
+    posts = posts_page['posts']
 
     # Amending list of dictionaries so as it contains required user
-    #   specific data
-    for post in posts:
-        user = mongo.db.users.find_one({'_id': ObjectId(post['author'])})
-        post['first_name'] = user['first_name'].title()
-        post['last_name'] = user['last_name'].title()
-        post['username'] = user['username']
-
-    # Pagination parameters
-    page = int(request.args.get('page', 1))
-    per_page = 5
-    offset = (page - 1) * per_page
-
-    total = len(posts)
-
-    pagination_posts = get_items(posts, offset=offset, per_page=per_page)
-
-    # Pagination options - refer to https://pythonhosted.org/Flask-paginate/
-    pagination = Pagination(page=page, per_page=per_page, total=total,
-                            css_framework='bootstrap4', inner_window=1,
-                            outer_window=0)
+    #   specific data (author has already been pulled from database)
+    add_author_data(posts, authors=[user])
 
     # Rendering index.html template with list of all posts pulled from MongoDB
     # 'title' variable customizes web-page title
     return render_template('user_posts.html',
+                           username=username,
                            first_name=first_name,
                            last_name=last_name,
-                           posts=pagination_posts,
-                           posts_count=total,
-                           page=page,
-                           per_page=per_page,
-                           pagination=pagination,
+                           posts=posts,
+                           posts_count=posts_count,
+                           pagination=posts_page['pagination'],
+                           newer_cursor=posts_page['newer_cursor'],
+                           older_cursor=posts_page['older_cursor'],
                            title='User Posts')
 
 
@@ -334,3 +363,17 @@ def reset_password(token):
     # Render password reset page
     return render_template('reset_password.html',
                            title='Reset Password', form=form)
+
+
+# Command line command for recounting posts of all users
+# Sets counts of users created before post counts were introduced (this
+#   is also done on application start, see migrations.py) and repairs
+#   counts after posts were changed directly in database
+# Usage: 'flask users recount-posts'
+@users.cli.command('recount-posts')
+@click.option('--batch-size', default=500, show_default=True)
+def recount_posts(batch_size):
+    """Recompute post counts of all users."""
+    updated = recount_post_counts(batch_size=batch_size)
+    invalidate_authors()
+    click.echo('Done, {} users updated'.format(updated))
@@ -4,16 +4,26 @@ import os
 from flask import url_for, current_app
 # Importing tool for generating secure random numbers
 import secrets
-# Importing tool for Image processing
-from PIL import Image
+# Importing tool for binding function arguments
+from functools import partial
+# Importing functions for manipulating dates
+from datetime import datetime, timedelta
 # Importing Tools for working with MongoDB ObjectIds
 from bson.objectid import ObjectId
+# Importing MongoDB bulk write operation
+from pymongo import UpdateOne
 # Importing Serializer for Password reset
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 # Importing flask_mail message
 from flask_mail import Message
 # Importing variables from other application packages
-from flyhighblog import mongo, mail
+from flyhighblog import mongo, mail_outbox, page_cache, image_queue
+from flyhighblog.images import (PROFILE_IMAGE_SIZE, PROFILE_IMAGE_DENSITIES,
+                                resize_to_fit, ingest_image,
+                                delete_images, image_files,
+                                main_variant)
+from flyhighblog.users.forms import USERNAME_EXISTS, EMAIL_EXISTS
+from flyhighblog.main.utils import update_author_snapshots
 
 
 # Function for generating password reset token
@@ -34,6 +44,7 @@ def verify_reset_token(token):
 
 
 # Function for sending password reset email
+# E-mail is sent in background (see MailOutbox in outbox.py)
 def send_email(user):
     token = get_reset_token(user)
     msg = Message('Password Reset Request',
@@ -46,55 +57,192 @@ def send_email(user):
                this email and no changes will be made.
                '''.format(url_for('users.reset_password',
                                   token=token, _external=True))
-    mail.send(msg)
+    mail_outbox.enqueue(msg)
+
+
+# Function for translating duplicate key error raised by unique indexes
+#   of users collection into validation error of respective form field
+# Violated index is identified by its key pattern (MongoDB 4.2+) or by
+#   its name in the error message
+def add_duplicate_key_error(form, error):
+    key_pattern = (error.details or {}).get('keyPattern', {})
+    if 'username' in key_pattern or 'users_username_unique' in str(error):
+        form.username.errors.append(USERNAME_EXISTS)
+    elif 'email' in key_pattern or 'users_email_unique' in str(error):
+        form.email.errors.append(EMAIL_EXISTS)
+    else:
+        raise error
 
 
 # Function for resizing and upload
 #   of profile_images to database
+# Profile image is saved in sizes for standard and high density displays
+#   (PROFILE_IMAGE_DENSITIES), each of them in original format and as WebP
+# Returns filename of main profile image (standard density variant
+#   in original format) and list of all variants
 def profile_image(form_picture_data):
     # Create random filename while keeping original file extension
     random_hex = secrets.token_hex(8)
-    profile_image = form_picture_data
-    _, f_ext = os.path.splitext(profile_image.filename)
-    picture_fn = random_hex + f_ext
-
-    # Set temporary path for profile pictures
-    picture_path = os.path.join(current_app.root_path,
-                                'static/img/profile-image',
-                                picture_fn)
-
-    # Resizing image
-    output_size = (125, 125)
-    i = Image.open(profile_image)
-    i.thumbnail(output_size)
-
-    # Saving resized image to temporary folder
-    i.save(picture_path)
-
-    # Open saved resized picture for read mode (r)
-    #   with binary I/O (b)
-    with open(picture_path, 'rb') as f:
-        # Save resized picture to database
-        mongo.save_file(picture_fn, f)
-
-    # Delete resized picture from temporaty folder
-    os.remove(picture_path)
-
-    # Return picture filename
-    return picture_fn
+    _, f_ext = os.path.splitext(form_picture_data.filename)
+
+    # Resizing image to all sizes and saving resized images to database
+    sizes = [('-{}x'.format(density),
+              partial(resize_to_fit, size=PROFILE_IMAGE_SIZE * density),
+              {'density': density})
+             for density in PROFILE_IMAGE_DENSITIES]
+    largest = PROFILE_IMAGE_SIZE * max(PROFILE_IMAGE_DENSITIES)
+    variants = ingest_image(form_picture_data, random_hex, sizes,
+                            (largest, largest))
+
+    # Main profile image - standard density variant in original format
+    picture_fn = main_variant(variants, f_ext, density=1)
+
+    # Return picture filename and list of variants
+    return picture_fn, variants
+
+
+# Function for processing uploaded profile image in background
+# Processed image replaces the original profile image only if the job is
+#   still the latest profile image upload of the user; otherwise
+#   processed image is deleted
+@image_queue.handler('profile_image')
+def process_profile_image(job, original):
+    picture_fn, picture_variants = profile_image(original)
+    user = mongo.db.users.find_one_and_update(
+        {'_id': job['target'], 'profile_img_job': job['_id']},
+        {'$set': {'profile_img': picture_fn,
+                  'profile_img_variants': picture_variants},
+         '$unset': {'profile_img_job': '', 'profile_img_error': ''}})
+    if user is None:
+        delete_images(image_files(picture_fn, picture_variants))
+    else:
+        # New profile image needs to be displayed in author snapshots
+        #   of user's posts before previous profile image is deleted
+        update_author_snapshots(job['target'])
+        # Deleting previous profile image of the user
+        profile_image_check_and_delete(user)
+        # New profile image needs to be displayed on cached pages
+        page_cache.invalidate()
+
+
+# Function for recording that uploaded profile image could not be processed
+# User keeps previous (or default) profile image and is told on account
+#   page that the image needs to be uploaded again
+@image_queue.failure_handler('profile_image')
+def profile_image_failed(job, error):
+    mongo.db.users.update_one(
+        {'_id': job['target'], 'profile_img_job': job['_id']},
+        {'$set': {'profile_img_error': str(error)},
+         '$unset': {'profile_img_job': ''}})
 
 
 # Function for checking if user already inserted profile image in the past.
-# If yes, delete the file from the database
+# If yes, delete the file (and all its variants) from the database
 def profile_image_check_and_delete(user):
-    if 'profile_img' in user:
-        image = mongo.db.fs.files.find_one(
-                                           {'filename':
-                                            user['profile_img']}
-                                           )
-        image_id = image['_id']
-        # Deleting file from fs.files
-        mongo.db.fs.files.delete_one({'_id': ObjectId(image_id)})
-        # Deleting file from fs.chunks
-        mongo.db.fs.chunks.delete_many({'files_id':
-                                        ObjectId(image_id)})
+    if user.get('profile_img'):
+        delete_images(image_files(user['profile_img'],
+                                  user.get('profile_img_variants')))
+
+
+# Number of minutes after which initialisation of post count which was
+#   not completed (e.g. worker crashed) is redone by recount_post_counts
+POST_COUNT_CLAIM_MINUTES = 10
+
+
+# Function for initialising post counts of users matching 'query' (all
+#   users by default) which do not have any (users created before post
+#   counts were introduced)
+# Post counts are maintained by new_post and delete_post only for users
+#   which already have a count; count of the user is therefore set to 0
+#   first, so as posts created or deleted from then on are counted by
+#   new_post and delete_post, and only posts created up to that moment are
+#   then counted and added to it
+# Users initialised by this call are marked by 'post_count_claim', so as
+#   users initialised by concurrent calls (other workers) are not counted
+#   twice
+# Returns number of initialised users
+def initialise_post_counts(query=None, batch_size=500):
+    claim = ObjectId()
+    mongo.db.users.update_many(
+        dict(query or {}, post_count={'$exists': False}),
+        {'$set': {'post_count': 0, 'post_count_claim': claim}})
+    created_before = datetime.utcnow()
+
+    initialised = 0
+    user_ids = []
+    cursor = mongo.db.users.find({'post_count_claim': claim}, {'_id': 1},
+                                 batch_size=batch_size)
+    for user in cursor:
+        user_ids.append(user['_id'])
+        if len(user_ids) == batch_size:
+            initialised += add_post_counts(user_ids, claim, created_before)
+            user_ids = []
+    if user_ids:
+        initialised += add_post_counts(user_ids, claim, created_before)
+    return initialised
+
+
+# Function for adding posts created before 'created_before' to post counts
+#   of users initialised by initialise_post_counts
+# Returns number of updated users
+def add_post_counts(user_ids, claim, created_before):
+    # Author is saved as string id or ObjectId (see post_author)
+    authors = user_ids + [str(user_id) for user_id in user_ids]
+    counts = {}
+    for group in mongo.db.posts.aggregate([
+            {'$match': {'author': {'$in': authors},
+                        'date_posted': {'$lte': created_before}}},
+            {'$group': {'_id': '$author', 'count': {'$sum': 1}}}]):
+        author_id = str(group['_id'])
+        counts[author_id] = counts.get(author_id, 0) + group['count']
+    return mongo.db.users.bulk_write(
+        [UpdateOne({'_id': user_id, 'post_count_claim': claim},
+                   {'$inc': {'post_count': counts.get(str(user_id), 0)},
+                    '$unset': {'post_count_claim': ''}})
+         for user_id in user_ids], ordered=False).modified_count
+
+
+# Function for recounting posts of users matching 'query' (all users by
+#   default) and saving the counts to their 'post_count'
+# Users without a count are initialised first (see initialise_post_counts);
+#   users whose initialisation was not completed in POST_COUNT_CLAIM_MINUTES
+#   are recounted, users being initialised by another call are skipped
+# Posts are counted by one aggregation; a user whose count changed
+#   meanwhile (post created or deleted) is skipped, so as the change is
+#   not overwritten - running the function again updates such users
+# Returns number of updated users
+def recount_post_counts(query=None, batch_size=500):
+    updated = initialise_post_counts(query, batch_size=batch_size)
+
+    # Author is saved as string id or ObjectId (see post_author)
+    counts = {}
+    for group in mongo.db.posts.aggregate(
+            [{'$group': {'_id': '$author', 'count': {'$sum': 1}}}]):
+        author_id = str(group['_id'])
+        counts[author_id] = counts.get(author_id, 0) + group['count']
+
+    stale_claim = ObjectId.from_datetime(
+        datetime.utcnow() - timedelta(minutes=POST_COUNT_CLAIM_MINUTES))
+    cursor = mongo.db.users.find(
+        dict(query or {}, **{'$or': [
+            {'post_count_claim': {'$exists': False}},
+            {'post_count_claim': {'$lt': stale_claim}}]}),
+        {'post_count': 1, 'post_count_claim': 1}, batch_size=batch_size)
+    batch = []
+    for user in cursor:
+        count = counts.get(str(user['_id']), 0)
+        if user.get('post_count') == count and \
+                'post_count_claim' not in user:
+            continue
+        batch.append(UpdateOne({'_id': user['_id'],
+                                'post_count': user.get('post_count')},
+                               {'$set': {'post_count': count},
+                                '$unset': {'post_count_claim': ''}}))
+        if len(batch) == batch_size:
+            updated += mongo.db.users.bulk_write(batch,
+                                                 ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += mongo.db.users.bulk_write(batch,
+                                             ordered=False).modified_count
+    return updated
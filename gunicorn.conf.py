@@ -0,0 +1,63 @@
+# Configuration of gunicorn - WSGI server running the application
+#   in production ('gunicorn app:app', see Procfile)
+# gunicorn reads this file from current folder, settings given on command
+#   line take precedence
+# Application is served by WEB_CONCURRENCY worker processes (set by Heroku
+#   according to dyno size) with GUNICORN_THREADS threads each; every
+#   worker has its own MongoDB connection pool (MONGO_MAX_POOL_SIZE should
+#   not be lower than number of threads)
+
+# Importing os to have access to sytem-based functions and variables
+import os
+# Importing glob for finding files of multiprocess metrics
+import glob
+
+
+# Address and port the server listens on
+bind = '{}:{}'.format(os.environ.get('IP', '0.0.0.0'),
+                      os.environ.get('PORT', '8000'))
+
+# Worker processes and threads of each worker
+# Requests spend most of their time waiting for database, which releases
+#   the GIL, so as threads of one worker serve requests concurrently;
+#   work holding the GIL (rendering templates, hashing passwords) is
+#   spread over worker processes
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+
+# Worker which does not respond for 'timeout' seconds is restarted
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 2))
+
+# Loading application once before forking workers (faster start, less
+#   memory); workers then create their own MongoDB client (post_fork)
+preload_app = os.getenv('GUNICORN_PRELOAD', '0') == '1'
+
+# Access log is written to standard output if switched on
+accesslog = '-' if os.getenv('GUNICORN_ACCESS_LOG', '0') == '1' else None
+
+
+# Removing metrics of previous run, so as counters of workers which do not
+#   exist any more are not exported (see metrics.py)
+def on_starting(server):
+    directory = os.environ.get('prometheus_multiproc_dir')
+    if directory:
+        for path in glob.glob(os.path.join(directory, '*.db')):
+            os.remove(path)
+
+
+# Preparing worker forked from master process, which loaded application
+#   (MongoDB client of master process is not fork-safe)
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from flyhighblog import init_worker
+        init_worker(server.app.wsgi())
+
+
+# Marking metrics of exited worker as dead
+def child_exit(server, worker):
+    if os.environ.get('prometheus_multiproc_dir'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)